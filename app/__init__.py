@@ -0,0 +1,5 @@
+import time
+
+# Instante en que empieza a importarse el paquete: sirve para medir el tiempo
+# de importación de la aplicación en el informe de arranque (ver `startup`).
+IMPORT_STARTED_AT = time.perf_counter()
@@ -0,0 +1,253 @@
+import time
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+from .config import (
+    RATE_LIMIT_USER_PER_SECOND,
+    RATE_LIMIT_USER_BURST,
+    RATE_LIMIT_GLOBAL_PER_SECOND,
+    RATE_LIMIT_GLOBAL_BURST,
+    ADMISSION_MAX_IN_FLIGHT,
+    ADMISSION_MAX_PER_USER,
+    ADMISSION_MAX_QUEUE,
+    ADMISSION_QUEUE_TIMEOUT_SECONDS,
+    ADMISSION_BACKEND,
+    ADMISSION_MEMORY_MAX_BUCKETS,
+    REDIS_URL,
+)
+from .observability import log_evento
+
+# =========================================================================
+# Control de admisión de /api/chat, en tres capas (de la más barata a la más cara):
+#   1. Token bucket por usuario y global (ritmo sostenido + ráfaga).
+#   2. Tope de ejecuciones simultáneas del mismo usuario.
+#   3. Tope de ejecuciones del agente en vuelo en este worker, con una cola de
+#      espera acotada y con timeout.
+# Lo que no entra se rechaza AL MOMENTO (429/503 con Retry-After) en lugar de
+# dejar un stream colgado o acabar en errores de cuota de Gemini para todos.
+# =========================================================================
+
+
+class Rechazo(Exception):
+    """Petición no admitida. `status` es 429 (límite de ritmo) o 503 (servidor ocupado)."""
+
+    def __init__(self, motivo: str, status: int, retry_after: float):
+        super().__init__(motivo)
+        self.motivo = motivo
+        self.status = status
+        self.retry_after = max(1, int(retry_after + 0.999))
+
+
+class BucketBackend(ABC):
+    """Dónde se guardan los token buckets. `consumir` devuelve 0 si hay ficha o los segundos hasta la próxima."""
+
+    @abstractmethod
+    async def consumir(self, clave: str, tasa: float, capacidad: int) -> float:
+        ...
+
+
+class MemoriaBucketBackend(BucketBackend):
+    """
+    Buckets en un dict del proceso: cada worker lleva su propia cuenta. Guarda
+    como máximo `max_buckets` (LRU): el usuario que lleva más tiempo sin escribir
+    es el que tiene el bucket lleno, y descartarlo equivale a dejarlo como está.
+    """
+
+    def __init__(self, max_buckets: int = ADMISSION_MEMORY_MAX_BUCKETS):
+        self.max_buckets = max(1, max_buckets)
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()  # clave -> (fichas, instante)
+
+    async def consumir(self, clave: str, tasa: float, capacidad: int) -> float:
+        # Sin awaits entre leer y escribir: es atómico dentro del event loop.
+        ahora = time.monotonic()
+        fichas, instante = self._buckets.get(clave, (float(capacidad), ahora))
+        fichas = min(capacidad, fichas + (ahora - instante) * tasa)
+        espera = 0.0
+        if fichas >= 1:
+            fichas -= 1
+        else:
+            espera = (1 - fichas) / tasa if tasa > 0 else float("inf")
+        self._buckets[clave] = (fichas, ahora)
+        self._buckets.move_to_end(clave)
+        while len(self._buckets) > self.max_buckets:
+            self._buckets.popitem(last=False)
+        return espera
+
+
+# Recarga + consumo atómicos en Redis, con el reloj del propio Redis (sin desfase entre workers).
+_SCRIPT_TOKEN_BUCKET = """
+local tasa = tonumber(ARGV[1])
+local capacidad = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local ahora = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local estado = redis.call('HMGET', KEYS[1], 'fichas', 'instante')
+local fichas = tonumber(estado[1]) or capacidad
+local instante = tonumber(estado[2]) or ahora
+fichas = math.min(capacidad, fichas + (ahora - instante) * tasa)
+local espera = 0
+if fichas >= 1 then
+    fichas = fichas - 1
+else
+    espera = (1 - fichas) / tasa
+end
+redis.call('HSET', KEYS[1], 'fichas', fichas, 'instante', ahora)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacidad / tasa) + 1)
+return tostring(espera)
+"""
+
+
+class RedisBucketBackend(BucketBackend):
+    """
+    Buckets compartidos entre todos los workers (y réplicas) a través de Redis
+    o de cualquier servidor compatible (Valkey, KeyDB...). El cliente se importa
+    y se conecta de forma perezosa: `redis` solo es necesario con este backend.
+    """
+
+    def __init__(self, url: str = REDIS_URL, prefijo: str = "admision:"):
+        self.url = url
+        self.prefijo = prefijo
+        self._cliente = None
+        self._script = None
+
+    async def consumir(self, clave: str, tasa: float, capacidad: int) -> float:
+        try:
+            if self._script is None:
+                import redis.asyncio as redis
+                self._cliente = redis.from_url(self.url)
+                self._script = self._cliente.register_script(_SCRIPT_TOKEN_BUCKET)
+            return float(await self._script(keys=[self.prefijo + clave], args=[tasa, capacidad]))
+        except Exception as e:
+            # Si Redis no responde, se deja pasar: el tope de concurrencia del worker sigue protegiendo.
+            log_evento("admision.redis_no_disponible", logging.WARNING, error=str(e))
+            return 0.0
+
+
+def crear_bucket_backend(nombre: str = ADMISSION_BACKEND) -> BucketBackend:
+    if nombre == "memory":
+        return MemoriaBucketBackend()
+    if nombre == "redis":
+        return RedisBucketBackend()
+    raise ValueError(f"ADMISSION_BACKEND desconocido: '{nombre}' (usa memory o redis)")
+
+
+@dataclass
+class EstadisticasAdmision:
+    admitidas: int = 0
+    limitadas_usuario: int = 0
+    limitadas_global: int = 0
+    concurrencia_usuario: int = 0
+    cola_llena: int = 0
+    timeout_cola: int = 0
+
+    def as_dict(self) -> dict:
+        return dict(self.__dict__)
+
+
+class Permiso:
+    """Plaza de ejecución concedida. `liberar` es idempotente."""
+
+    def __init__(self, control: "ControlAdmision", usuario: str):
+        self._control = control
+        self._usuario = usuario
+        self._liberado = False
+
+    def liberar(self) -> None:
+        if not self._liberado:
+            self._liberado = True
+            self._control._liberar(self._usuario)
+
+
+class ControlAdmision:
+    """Ver el comentario del módulo. Una instancia por worker (`control_admision`)."""
+
+    def __init__(self, backend: Optional[BucketBackend] = None,
+                 max_en_vuelo: int = ADMISSION_MAX_IN_FLIGHT,
+                 max_por_usuario: int = ADMISSION_MAX_PER_USER,
+                 max_cola: int = ADMISSION_MAX_QUEUE,
+                 timeout_cola: float = ADMISSION_QUEUE_TIMEOUT_SECONDS):
+        self.backend = backend or crear_bucket_backend()
+        self.max_en_vuelo = max_en_vuelo
+        self.max_por_usuario = max_por_usuario
+        self.max_cola = max_cola
+        self.timeout_cola = timeout_cola
+        self._semaforo: Optional[asyncio.Semaphore] = None
+        self._en_vuelo = 0
+        self._esperando = 0
+        self._por_usuario: dict[str, int] = {}
+        self.stats = EstadisticasAdmision()
+
+    async def admitir(self, usuario: str) -> Permiso:
+        """Devuelve un `Permiso` que hay que liberar al terminar el stream, o lanza `Rechazo`."""
+        # 1. Ritmo: primero el del usuario (un cliente en bucle no gasta la cuota
+        #    de los demás) y luego el global (protege la cuota de Gemini)
+        espera = await self.backend.consumir(f"usuario:{usuario}", RATE_LIMIT_USER_PER_SECOND, RATE_LIMIT_USER_BURST)
+        if espera > 0:
+            self.stats.limitadas_usuario += 1
+            raise Rechazo("Estás enviando mensajes demasiado rápido.", 429, espera)
+        espera = await self.backend.consumir("global", RATE_LIMIT_GLOBAL_PER_SECOND, RATE_LIMIT_GLOBAL_BURST)
+        if espera > 0:
+            self.stats.limitadas_global += 1
+            raise Rechazo("Hay mucha demanda en este momento.", 503, espera)
+
+        # 2. Concurrencia del usuario: cuenta también lo que tiene esperando en la cola
+        if self._por_usuario.get(usuario, 0) >= self.max_por_usuario:
+            self.stats.concurrencia_usuario += 1
+            raise Rechazo("Espera a que termine tu consulta anterior.", 429, 1)
+        self._por_usuario[usuario] = self._por_usuario.get(usuario, 0) + 1
+
+        # 3. Plazas del worker, con cola de espera acotada. La cuenta del usuario
+        #    se deshace con cualquier salida sin plaza (rechazo o petición cancelada).
+        try:
+            await self._ocupar_plaza()
+        except BaseException:
+            self._descontar_usuario(usuario)
+            raise
+        self._en_vuelo += 1
+        self.stats.admitidas += 1
+        return Permiso(self, usuario)
+
+    async def _ocupar_plaza(self) -> None:
+        if self._semaforo is None:
+            self._semaforo = asyncio.Semaphore(self.max_en_vuelo)
+        if not self._semaforo.locked():
+            await self._semaforo.acquire()
+            return
+        if self._esperando >= self.max_cola:
+            self.stats.cola_llena += 1
+            raise Rechazo("El asistente está ocupado.", 503, self.timeout_cola)
+        self._esperando += 1
+        try:
+            await asyncio.wait_for(self._semaforo.acquire(), self.timeout_cola)
+        except asyncio.TimeoutError:
+            self.stats.timeout_cola += 1
+            raise Rechazo("El asistente está ocupado.", 503, self.timeout_cola)
+        finally:
+            self._esperando -= 1
+
+    def _descontar_usuario(self, usuario: str) -> None:
+        restantes = self._por_usuario.get(usuario, 1) - 1
+        if restantes > 0:
+            self._por_usuario[usuario] = restantes
+        else:
+            self._por_usuario.pop(usuario, None)
+
+    def _liberar(self, usuario: str) -> None:
+        self._en_vuelo -= 1
+        self._descontar_usuario(usuario)
+        self._semaforo.release()
+
+    def stats_dict(self) -> dict:
+        return {
+            **self.stats.as_dict(),
+            "en_vuelo": self._en_vuelo,
+            "esperando": self._esperando,
+            "max_en_vuelo": self.max_en_vuelo,
+            "backend": type(self.backend).__name__,
+        }
+
+
+control_admision = ControlAdmision()
@@ -0,0 +1,190 @@
+import re
+import time
+import threading
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+from .config import (
+    ANSWER_CACHE_TTL_SECONDS,
+    ANSWER_CACHE_MAX_ENTRIES,
+    ANSWER_CACHE_SIMILARITY,
+)
+
+# Preguntas que solo tienen sentido con el historial ("y por qué?", "pero de qué artículo es?").
+# Su respuesta depende de la conversación, así que nunca se cachean.
+_INICIOS_DEPENDIENTES = ("y ", "pero ", "entonces ", "eso ", "esto ", "donde dice", "de que articulo")
+_MIN_PALABRAS = 3
+
+# Palabras que no cambian lo que se pregunta. Las negaciones ("no", "sin",
+# "excepto"...) NO están: "qué cubre" y "qué no cubre" tienen respuestas distintas.
+_PALABRAS_VACIAS = {
+    "que", "cual", "cuales", "como", "cuanto", "cuanta", "cuantos", "cuantas", "donde", "cuando", "quien",
+    "de", "del", "la", "el", "los", "las", "lo", "un", "una", "unos", "unas", "en", "y", "e", "o", "u",
+    "a", "al", "por", "para", "con", "se", "me", "mi", "mis", "tu", "tus", "su", "sus", "le", "les",
+    "es", "son", "esta", "estan", "hay", "tiene", "tienen", "tengo", "este", "ese", "esa",
+    "puedo", "puede", "saber", "decir", "dime", "explica", "explicame", "favor",
+}
+
+
+def normalizar_pregunta(texto: str) -> str:
+    """Minúsculas, sin tildes, sin signos de puntuación y con espacios colapsados."""
+    texto = unicodedata.normalize("NFKD", texto.lower())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    texto = re.sub(r"[^\w\s]", " ", texto)
+    return re.sub(r"\s+", " ", texto).strip()
+
+
+def terminos_clave(pregunta_normalizada: str) -> frozenset:
+    """
+    Palabras con contenido de la pregunta: sin las vacías, en singular
+    aproximado ("coberturas" = "cobertura") y con negaciones y códigos de póliza.
+    """
+    terminos = set()
+    for palabra in pregunta_normalizada.split():
+        if palabra in _PALABRAS_VACIAS:
+            continue
+        if palabra.endswith(("iones", "dades")):
+            palabra = palabra[:-2]
+        elif len(palabra) > 3 and palabra.endswith("s"):
+            palabra = palabra[:-1]
+        terminos.add(palabra)
+    return frozenset(terminos)
+
+
+def es_pregunta_autonoma(pregunta_normalizada: str) -> bool:
+    """True si la pregunta se entiende sin contexto y por tanto es cacheable."""
+    if len(pregunta_normalizada.split()) < _MIN_PALABRAS:
+        return False
+    return not pregunta_normalizada.startswith(_INICIOS_DEPENDIENTES)
+
+
+@dataclass
+class _Entrada:
+    respuesta: str
+    creada: float
+    embedding: Optional[np.ndarray] = None
+    terminos: frozenset = frozenset()
+
+
+@dataclass
+class EstadisticasCache:
+    exact_hits: int = 0
+    semantic_hits: int = 0
+    misses: int = 0
+    invalidaciones: int = 0
+    descartes_terminos: int = 0  # Similares por embedding pero con otros términos clave (miss)
+
+    def as_dict(self) -> dict:
+        total = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "invalidaciones": self.invalidaciones,
+            "descartes_terminos": self.descartes_terminos,
+            "hit_rate": round((self.exact_hits + self.semantic_hits) / total, 4) if total else 0.0,
+        }
+
+
+class AnswerCache:
+    """
+    Caché de respuestas finales del agente con dos niveles:
+
+    1. Exacto: la pregunta normalizada es idéntica a una ya respondida.
+    2. Semántico: el embedding de la pregunta tiene similitud coseno >=
+       `umbral` con el de una pregunta cacheada Y ambas tienen los mismos
+       términos clave (`terminos_clave`): la similitud sola no distingue
+       "qué cubre" de "qué no cubre" ni hospitalización de ambulatoria.
+
+    Las entradas caducan por TTL, se expulsan por LRU al superar `max_entries`
+    y se descartan todas cuando cambia la versión del índice de pólizas.
+    """
+
+    def __init__(self, ttl_seconds: int = ANSWER_CACHE_TTL_SECONDS,
+                 max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+                 umbral: float = ANSWER_CACHE_SIMILARITY):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.umbral = umbral
+        self.version: Optional[str] = None
+        self.stats = EstadisticasCache()
+        self._entradas: "OrderedDict[str, _Entrada]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def asegurar_version(self, version: str) -> None:
+        """Vacía la caché si el índice de pólizas fue re-indexado desde la última vez."""
+        with self._lock:
+            if self.version is not None and version != self.version:
+                self._entradas.clear()
+                self.stats.invalidaciones += 1
+            self.version = version
+
+    def buscar_exacta(self, clave: str) -> Optional[str]:
+        with self._lock:
+            entrada = self._vigente(clave)
+            if entrada is None:
+                return None
+            self._entradas.move_to_end(clave)
+            self.stats.exact_hits += 1
+            return entrada.respuesta
+
+    def buscar_semantica(self, clave: str, embedding: list[float]) -> Optional[str]:
+        """`clave` es la pregunta normalizada: sus términos clave deben coincidir con los de la cacheada."""
+        consulta = _unitario(embedding)
+        terminos = terminos_clave(clave)
+        with self._lock:
+            self._purgar_caducadas()
+            candidatas = [(k, e) for k, e in self._entradas.items() if e.embedding is not None]
+            if candidatas:
+                matriz = np.stack([e.embedding for _, e in candidatas])
+                similitudes = matriz @ consulta
+                parecidas = [i for i in np.argsort(-similitudes) if similitudes[i] >= self.umbral]
+                for i in parecidas:
+                    if candidatas[i][1].terminos == terminos:
+                        self._entradas.move_to_end(candidatas[i][0])
+                        self.stats.semantic_hits += 1
+                        return candidatas[i][1].respuesta
+                if parecidas:
+                    self.stats.descartes_terminos += 1
+            self.stats.misses += 1
+            return None
+
+    def registrar_miss(self) -> None:
+        with self._lock:
+            self.stats.misses += 1
+
+    def guardar(self, clave: str, respuesta: str, embedding: Optional[list[float]] = None) -> None:
+        with self._lock:
+            vector = _unitario(embedding) if embedding is not None else None
+            terminos = terminos_clave(clave) if embedding is not None else frozenset()
+            self._entradas[clave] = _Entrada(respuesta, time.monotonic(), vector, terminos)
+            self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.max_entries:
+                self._entradas.popitem(last=False)
+
+    def stats_dict(self) -> dict:
+        with self._lock:
+            return {**self.stats.as_dict(), "entradas": len(self._entradas), "version_indice": self.version}
+
+    def _vigente(self, clave: str) -> Optional[_Entrada]:
+        entrada = self._entradas.get(clave)
+        if entrada is not None and time.monotonic() - entrada.creada > self.ttl_seconds:
+            del self._entradas[clave]
+            return None
+        return entrada
+
+    def _purgar_caducadas(self) -> None:
+        ahora = time.monotonic()
+        caducadas = [k for k, e in self._entradas.items() if ahora - e.creada > self.ttl_seconds]
+        for clave in caducadas:
+            del self._entradas[clave]
+
+
+def _unitario(vector) -> np.ndarray:
+    v = np.asarray(vector, dtype=np.float32)
+    norma = np.linalg.norm(v)
+    return v / norma if norma else v
@@ -0,0 +1,270 @@
+import os
+import re
+import gzip
+import json
+import threading
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+from .answer_cache import normalizar_pregunta
+from .config import ARTICLE_INDEX_DIR
+from .executors import run_blocking
+from .observability import log_evento
+
+# =========================================================================
+# Índice estructural de las pólizas: qué artículos tiene cada póliza, con su
+# título, sus páginas y su texto completo. Lo construye la ingesta
+# (`scripts/ingest_data.py`) y permite responder sin embeddings ni búsqueda
+# vectorial a las preguntas que nombran una ubicación precisa:
+#   - "Artículo 2 de la POL320190074"  -> diccionario (póliza, artículo): O(1).
+#   - "¿de qué artículo es este texto?" -> huellas de n-gramas de palabras:
+#     cada n-grama del pasaje apunta a los artículos que lo contienen.
+# Los chunks de la base vectorial ignoran los límites de los artículos; este
+# índice no.
+# =========================================================================
+
+_FICHERO = "articulos.json.gz"
+_TAM_NGRAMA = 5  # Palabras por n-grama de las huellas
+
+# "ARTÍCULO 2º: COBERTURA", "ARTICULO N° 3: DEFINICIONES", "ARTÍCULO 1º. REGLAS ...-",
+# "Artículo 4. Cobertura. Este seguro cubre...". Las citas dentro del texto
+# ("Artículo 12° de estas Condiciones", "artículo 4 de...") no llevan el
+# separador tras el número y no cuentan como encabezado.
+_ENCABEZADO = re.compile(
+    r"^\s*(?:ART[IÍ]CULO|Art[ií]culo)\s+(?:N\s*[º°o]\.?\s*)?(\d{1,3})\s*[º°]?\s*[:.]-?\s*(.*)$")
+_CODIGO_POLIZA = re.compile(r"\bPOL\s?(\d{6,})\b", re.IGNORECASE)
+# Referencias en una pregunta: "artículo 2", "art. 5", "articulo nº 3"
+_REFERENCIA_ARTICULO = re.compile(r"\bart(?:[ií]culo|\.)?\s*(?:n\s*[º°o]\.?\s*)?(\d{1,3})\b", re.IGNORECASE)
+_MAX_TITULO = 120
+
+
+@dataclass
+class Articulo:
+    poliza: str  # Código del depósito de pólizas, p. ej. "POL320190074"
+    numero: int
+    titulo: str
+    pagina_inicio: int  # 1-based, como se ven en el PDF
+    pagina_fin: int
+    texto: str
+    archivo: str = ""
+    # Algunos PDFs incluyen varios condicionados (las cláusulas adicionales
+    # vuelven a numerar desde 1): 0 es el principal, 1 el siguiente...
+    seccion: int = 0
+
+    @property
+    def paginas(self) -> str:
+        if self.pagina_inicio == self.pagina_fin:
+            return f"página {self.pagina_inicio}"
+        return f"páginas {self.pagina_inicio}-{self.pagina_fin}"
+
+
+def codigo_de_poliza(archivo: str, texto: str = "") -> str:
+    """Código de la póliza: del nombre del fichero y, si no lo lleva, del propio texto."""
+    for fuente in (os.path.basename(archivo), texto):
+        encontrado = _CODIGO_POLIZA.search(fuente)
+        if encontrado:
+            return f"POL{encontrado.group(1)}"
+    return os.path.splitext(os.path.basename(archivo))[0].upper()
+
+
+def codigos_de_poliza(texto: str) -> list[str]:
+    """Códigos de póliza citados en `texto`, en orden de aparición y sin repetir."""
+    return list(dict.fromkeys(f"POL{m.group(1)}" for m in _CODIGO_POLIZA.finditer(texto)))
+
+
+def producto_de_poliza(primera_pagina: str) -> str:
+    """
+    Producto de la póliza: el título de la portada, antes de "Incorporada al
+    Depósito de Pólizas..." (p. ej. "SEGURO PARA PRESTACIONES MÉDICAS DE ALTO COSTO").
+    """
+    lineas = []
+    for linea in primera_pagina.splitlines():
+        if _CODIGO_POLIZA.search(linea) or _ENCABEZADO.match(linea):
+            break
+        if linea.strip():
+            lineas.append(linea.strip())
+    return " ".join(lineas)[:_MAX_TITULO]
+
+
+def _titulo(resto: str) -> str:
+    # El título acaba en el primer punto ("Cobertura. Este seguro cubre...") o al final de la línea
+    titulo = resto.strip().rstrip("-").strip()
+    if "." in titulo:
+        titulo = titulo.split(".", 1)[0]
+    return titulo.strip(" .:-")[:_MAX_TITULO]
+
+
+def extraer_articulos(paginas: list[str], archivo: str) -> list[Articulo]:
+    """
+    Divide el texto de un PDF (una cadena por página) en artículos. El texto
+    anterior al primer encabezado (portada, cabeceras) no pertenece a ninguno.
+    """
+    poliza = codigo_de_poliza(archivo, paginas[0] if paginas else "")
+    articulos: list[Articulo] = []
+    lineas: list[str] = []
+    seccion = 0
+    for n_pagina, texto_pagina in enumerate(paginas, start=1):
+        for linea in texto_pagina.splitlines():
+            encabezado = _ENCABEZADO.match(linea)
+            if encabezado:
+                numero = int(encabezado.group(1))
+                if articulos:
+                    articulos[-1].texto = "\n".join(lineas).strip()
+                    # Si la numeración retrocede empieza otro condicionado del mismo PDF
+                    if numero <= articulos[-1].numero:
+                        seccion += 1
+                articulos.append(Articulo(poliza, numero, _titulo(encabezado.group(2)), n_pagina, n_pagina,
+                                          "", os.path.basename(archivo), seccion))
+                lineas = [linea.strip()]
+            elif articulos:
+                lineas.append(linea)
+                if linea.strip():
+                    articulos[-1].pagina_fin = n_pagina  # Última página con texto del artículo
+    if articulos:
+        articulos[-1].texto = "\n".join(lineas).strip()
+    return articulos
+
+
+def _ngramas(texto_normalizado: str, n: int = _TAM_NGRAMA) -> list[tuple]:
+    palabras = texto_normalizado.split()
+    if len(palabras) <= n:
+        return [tuple(palabras)] if palabras else []
+    return [tuple(palabras[i:i + n]) for i in range(len(palabras) - n + 1)]
+
+
+@dataclass
+class Localizacion:
+    articulo: Articulo
+    cobertura: float  # Fracción de los n-gramas del pasaje que aparecen en el artículo
+    exacta: bool  # El pasaje (normalizado) aparece tal cual en el artículo
+
+
+class IndiceArticulos:
+    """
+    Artículos de todas las pólizas, en memoria. `obtener` es una consulta a
+    un diccionario; `localizar` recorre solo los n-gramas del pasaje.
+    """
+
+    def __init__(self, articulos: list[Articulo]):
+        self.articulos = articulos
+        self._por_clave: dict[tuple[str, int], list[Articulo]] = {}
+        self._normalizados: list[str] = []
+        self._huellas: dict[int, list[int]] = {}  # hash del n-grama -> artículos que lo contienen
+        for i, articulo in enumerate(articulos):
+            self._por_clave.setdefault((articulo.poliza, articulo.numero), []).append(articulo)
+            normalizado = normalizar_pregunta(articulo.texto)
+            self._normalizados.append(normalizado)
+            for huella in {hash(g) for g in _ngramas(normalizado)}:
+                self._huellas.setdefault(huella, []).append(i)
+
+    @property
+    def polizas(self) -> list[str]:
+        return sorted({a.poliza for a in self.articulos})
+
+    def obtener(self, poliza: str, numero: int) -> list[Articulo]:
+        """El artículo `numero` de `poliza` (uno por condicionado del PDF, el principal primero)."""
+        return self._por_clave.get((poliza.upper(), numero), [])
+
+    def localizar(self, pasaje: str, min_cobertura: float, max_resultados: int = 3,
+                  polizas: Optional[set[str]] = None) -> list[Localizacion]:
+        """Artículos que contienen `pasaje`, de mayor a menor coincidencia (solo de `polizas`, si se indican)."""
+        normalizado = normalizar_pregunta(pasaje)
+        huellas = {hash(g) for g in _ngramas(normalizado)}
+        if not huellas:
+            return []
+        coincidencias: dict[int, int] = {}
+        for huella in huellas:
+            for i in self._huellas.get(huella, ()):
+                coincidencias[i] = coincidencias.get(i, 0) + 1
+        if polizas is not None:
+            coincidencias = {i: n for i, n in coincidencias.items() if self.articulos[i].poliza in polizas}
+        candidatos = sorted(coincidencias.items(), key=lambda p: -p[1])
+        resultado = []
+        for i, n in candidatos[:max_resultados]:
+            cobertura = n / len(huellas)
+            if cobertura < min_cobertura:
+                break
+            resultado.append(Localizacion(self.articulos[i], round(cobertura, 3),
+                                          normalizado in self._normalizados[i]))
+        return resultado
+
+    def guardar(self, directorio: str) -> None:
+        # Escritura atómica: el backend puede estar leyendo el fichero anterior
+        os.makedirs(directorio, exist_ok=True)
+        ruta = os.path.join(directorio, _FICHERO)
+        with gzip.open(ruta + ".tmp", "wt", encoding="utf-8") as f:
+            json.dump([asdict(a) for a in self.articulos], f, ensure_ascii=False)
+        os.replace(ruta + ".tmp", ruta)
+
+    @classmethod
+    def cargar(cls, directorio: str) -> "IndiceArticulos":
+        with gzip.open(os.path.join(directorio, _FICHERO), "rt", encoding="utf-8") as f:
+            return cls([Articulo(**a) for a in json.load(f)])
+
+
+class CargadorArticulos:
+    """
+    Mantiene el índice de artículos del disco en memoria y lo recarga cuando
+    la ingesta lo reescribe, como `BM25Cargador`. Sin índice devuelve None y
+    las herramientas siguen con la búsqueda normal.
+    """
+
+    def __init__(self, directorio: str):
+        self.directorio = directorio
+        self._indice: Optional[IndiceArticulos] = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def obtener(self) -> Optional[IndiceArticulos]:
+        ruta = os.path.join(self.directorio, _FICHERO)
+        try:
+            mtime = os.path.getmtime(ruta)
+        except OSError:
+            return None
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    self._indice = IndiceArticulos.cargar(self.directorio)
+                    self._mtime = mtime
+                    log_evento("articulos.indice_cargado", muestrear=False,
+                               articulos=len(self._indice.articulos), polizas=len(self._indice.polizas))
+        return self._indice
+
+    async def aobtener(self) -> Optional[IndiceArticulos]:
+        """`obtener` desde el event loop: la (re)carga, que rehace las huellas de todo el corpus, va al pool."""
+        try:
+            mtime = os.path.getmtime(os.path.join(self.directorio, _FICHERO))
+        except OSError:
+            return None
+        if mtime == self._mtime:
+            return self._indice
+        return await run_blocking(self.obtener)
+
+
+def referencias(texto: str) -> list[tuple[str, int]]:
+    """
+    Pares (póliza, artículo) citados en `texto`: "artículo 2 de la POL320190074".
+    Solo cuenta si hay un único código de póliza (si no, no se sabe a cuál se
+    refiere cada artículo).
+    """
+    polizas = codigos_de_poliza(texto)
+    if len(polizas) != 1:
+        return []
+    poliza = polizas[0]
+    numeros = dict.fromkeys(int(m.group(1)) for m in _REFERENCIA_ARTICULO.finditer(texto))
+    return [(poliza, numero) for numero in numeros]
+
+
+@dataclass
+class EstadisticasArticulos:
+    por_referencia: int = 0  # Artículo citado por póliza y número
+    localizadas_exactas: int = 0
+    localizadas_aproximadas: int = 0
+    sin_coincidencia: int = 0  # Siguieron por la búsqueda normal
+
+    def as_dict(self) -> dict:
+        return dict(self.__dict__)
+
+
+cargador_articulos = CargadorArticulos(ARTICLE_INDEX_DIR)
+estadisticas_articulos = EstadisticasArticulos()
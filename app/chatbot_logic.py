@@ -1,60 +1,218 @@
 import os
+import re
+import json
+import time
+import hashlib
 import asyncio
-from typing import AsyncGenerator
-import chromadb
-from langchain_community.tools.ddg_search import DuckDuckGoSearchRun
-from langchain.memory import ConversationBufferMemory
+import logging
+import functools
+from typing import AsyncGenerator, Optional
 from langchain.agents import AgentExecutor, create_tool_calling_agent
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
 from langchain_core.prompts import ChatPromptTemplate
-from langchain.callbacks.base import AsyncCallbackHandler
-from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain.tools import Tool
 
+from .answer_cache import AnswerCache, normalizar_pregunta, es_pregunta_autonoma
+from .article_index import Articulo, IndiceArticulos, cargador_articulos, estadisticas_articulos, referencias
+from .config import (
+    ANSWER_CACHE_ENABLED,
+    ARTICLE_INDEX_ENABLED,
+    ARTICLE_LOCATE_MIN_COVERAGE,
+    ARTICLE_LOCATE_MIN_WORDS,
+    ARTICLE_MAX_TOKENS,
+    CONTEXT_COMPACTION_ENABLED,
+    CONTEXT_MAX_TOKENS_PER_CHUNK,
+    HISTORY_HYDRATE_MESSAGES,
+    ROUTER_RESULTS,
+    RECOMBINER_MAX_TOPICS,
+    RECOMBINER_RESULTS_PER_TOPIC,
+    RECOMBINER_CONTEXT_TOKENS,
+)
+from .context import (
+    ahorro_turno,
+    ajustar_a_presupuesto,
+    compactar_fragmentos,
+    compactar_prompt,
+    deduplicar_fragmentos,
+    intercalar,
+    limpiar_fragmento,
+    recortar_alrededor,
+)
+from .db import crud
+from .db.database import SessionLocal
+from .db.history_writer import history_writer
+from .executors import run_blocking
+from .hybrid_search import polizas_del_filtro
+from .memory_store import SessionMemoryStore
+from .news_search import buscador_noticias
+from .observability import (
+    DURACION_ETAPA,
+    PETICIONES_CHAT,
+    TOKENS_STREAM,
+    TTFT,
+    etapa,
+    instrumentacion_llm,
+    log_evento,
+    medido,
+)
+from .policy_scope import alcance_polizas, alcance_turno, filtro_del_turno
+from .prefetch import RecuperacionAnticipada
+from .retrieval import Retriever
+from .router import INTENCION_AGENTE, INTENCION_POLIZA, RouterIntenciones, usara_consulta_de_polizas
+from .singleflight import vuelos_chat, vuelos_herramientas
+from .streaming import EventoChat, stream_con_backpressure
+from .vector_store import crear_vector_store
+
 # =========================================================================
 # === INICIO: LÓGICA ORIGINAL DEL EQUIPO DE IA (Adaptada para Docker) ===
 # =========================================================================
 
-def cargar_chromadb():
+# Las llamadas al LLM hechas DENTRO de una herramienta con esta etiqueta se
+# reenvían al usuario token a token (las demás no: son pasos intermedios).
+ETIQUETA_STREAM_USUARIO = "stream_al_usuario"
+
+def cargar_vector_store():
     """
-    Se conecta al servicio de ChromaDB que corre en Docker.
+    Prepara el backend vectorial elegido en VECTOR_STORE_BACKEND: el servicio
+    ChromaDB de Docker (por defecto), ChromaDB embebido o el índice NumPy local.
+    Ninguno abre conexiones aquí: lo hacen en la primera consulta.
     """
-    try:
-        # CORRECCIÓN CLAVE: Apuntamos al servicio 'chromadb' de Docker
-        client = chromadb.HttpClient(host='chromadb', port=8000)
-        collection = client.get_collection("polizas_seguros")
-        print("✅ Base de datos ChromaDB cargada y conectada desde Docker.")
-        return collection
-    except Exception as e:
-        # En un entorno de servidor, es mejor lanzar la excepción para que se registre.
-        print(f"❌ Error fatal al cargar ChromaDB: {e}")
-        raise e
+    return crear_vector_store()
+
+def _titulo_articulo(articulo: Articulo) -> str:
+    return f"Artículo {articulo.numero}: {articulo.titulo} de la póliza {articulo.poliza} ({articulo.paginas})"
+
+def consultar_articulos(query: str, indice: Optional[IndiceArticulos],
+                        where: Optional[dict] = None) -> Optional[str]:
+    """
+    Atajo de `consultar_polizas` por el índice de artículos (`app/article_index.py`),
+    sin embeddings ni base vectorial: el artículo citado por póliza y número
+    ("artículo 2 de la POL320190074"), o el artículo al que pertenece un pasaje
+    literal. None si la consulta no es de ese tipo o el índice no la encuentra.
+    `indice` viene de `cargador_articulos.aobtener()` (la carga no bloquea el event loop).
+
+    Respeta el alcance del turno (`where`): solo responde con artículos de sus
+    pólizas, y con un filtro que no sea solo de pólizas deja paso a la búsqueda.
+    """
+    if indice is None:
+        return None
+    polizas = None
+    if where:
+        polizas = polizas_del_filtro(where)
+        if polizas is None:
+            return None
+        polizas = {poliza.upper() for poliza in polizas}
+    with etapa("articulos.consulta"):
+        citas = [ref for ref in referencias(query) if polizas is None or ref[0] in polizas]
+        citados = [articulos for articulos in (indice.obtener(*ref) for ref in citas) if articulos]
+        if citados:
+            estadisticas_articulos.por_referencia += 1
+            presupuesto = ARTICLE_MAX_TOKENS // len(citados)
+            partes = []
+            for articulos in citados:
+                principal, otros = articulos[0], articulos[1:]
+                texto = recortar_alrededor(limpiar_fragmento(principal.texto), query, presupuesto)
+                parte = f"{_titulo_articulo(principal)}:\n{texto}"
+                if otros:
+                    # Cláusulas adicionales del mismo PDF que vuelven a numerar desde 1
+                    parte += (f"\n(El documento incluye otros condicionados con un Artículo {principal.numero}: "
+                              + "; ".join(f"{a.titulo}, {a.paginas}" for a in otros) + ")")
+                partes.append(parte)
+            fuentes = sorted({a[0].archivo for a in citados})
+            return "\n\n".join(partes) + f"\n\nFuentes: {', '.join(fuentes)}"
+
+        if len(query.split()) < ARTICLE_LOCATE_MIN_WORDS:
+            return None
+        localizaciones = indice.localizar(query, ARTICLE_LOCATE_MIN_COVERAGE, polizas=polizas)
+        if not localizaciones:
+            estadisticas_articulos.sin_coincidencia += 1
+            return None
+        mejor = localizaciones[0]
+        if mejor.exacta:
+            estadisticas_articulos.localizadas_exactas += 1
+            coincidencia = "el texto aparece literalmente"
+        else:
+            estadisticas_articulos.localizadas_aproximadas += 1
+            coincidencia = f"coincide el {mejor.cobertura:.0%} del texto"
+        # El mismo condicionado puede estar depositado en varias pólizas
+        empatadas = [l.articulo for l in localizaciones[1:] if l.cobertura == mejor.cobertura]
+        respuesta = f"El texto pertenece al {_titulo_articulo(mejor.articulo)}; {coincidencia}."
+        if empatadas:
+            respuesta += " También aparece en: " + "; ".join(_titulo_articulo(a) for a in empatadas) + "."
+        extracto = recortar_alrededor(limpiar_fragmento(mejor.articulo.texto), query, ARTICLE_MAX_TOKENS // 3)
+        fuentes = sorted({mejor.articulo.archivo, *(a.archivo for a in empatadas)})
+        return f"{respuesta}\n\nExtracto del artículo:\n{extracto}\n\nFuentes: {', '.join(fuentes)}"
+
+async def consultar_polizas(retriever: Retriever, query: str, n_results: int = 3) -> Optional[str]:
+    """
+    Busca `query` en los documentos de pólizas y devuelve los fragmentos con sus
+    fuentes, o None si no hay información suficiente. La usan la herramienta
+    `ConsultaPDF` y la respuesta directa del router.
+
+    Si la consulta cita un artículo o es un pasaje literal, responde el índice
+    de artículos. Si no, los fragmentos recuperados se compactan (ver
+    `app/context.py`) antes de llegar al LLM.
+
+    La búsqueda se limita a las pólizas del turno (`app/policy_scope.py`), y
+    las llamadas con la misma consulta y el mismo alcance que coinciden en el
+    tiempo comparten una sola ejecución (`app/singleflight.py`).
+    """
+    where = filtro_del_turno()
+    return await vuelos_herramientas.ejecutar(
+        ("ConsultaPDF", normalizar_pregunta(query), n_results, _clave_filtro(where)),
+        lambda: _consultar_polizas(retriever, query, n_results, where),
+    )
 
-def crear_tool_chromadb(collection):
+def _clave_filtro(where: Optional[dict]) -> str:
+    return json.dumps(where, sort_keys=True) if where else ""
+
+async def _consultar_polizas(retriever: Retriever, query: str, n_results: int,
+                             where: Optional[dict]) -> Optional[str]:
+    if ARTICLE_INDEX_ENABLED:
+        articulo = consultar_articulos(query, await cargador_articulos.aobtener(), where)
+        if articulo is not None:
+            return articulo
+    # En el agente, la búsqueda de la pregunta suele estar ya en marcha (ver `_eventos_del_agente`)
+    adelantado = await recuperacion_anticipada.tomar(query, n_results, where)
+    if adelantado is not None:
+        documentos, metadatas = adelantado
+    else:
+        documentos, metadatas = await alcance_polizas.buscar(retriever, query, n_results, where)
+    if CONTEXT_COMPACTION_ENABLED and documentos:
+        compactacion = compactar_fragmentos(documentos, query, CONTEXT_MAX_TOKENS_PER_CHUNK)
+        documentos = compactacion.textos
+        if metadatas:
+            metadatas = [metadatas[i] for i in compactacion.posiciones]
+    contenido = "\n\n".join(documentos)
+    if len(contenido.strip()) < 50:
+        return None
+
+    metadatos = ""
+    if metadatas:
+        fuentes = {os.path.basename(m['source']) for m in metadatas if m and 'source' in m}
+        if fuentes:
+            metadatos = f"\n\nFuentes: {', '.join(fuentes)}"
+    return f"Información encontrada en documentos de pólizas:\n\n{contenido}{metadatos}"
+
+def crear_tool_chromadb(retriever: Retriever):
     """
     Crea la herramienta de LangChain para consultar la base de datos de pólizas.
     """
-    def consulta_chromadb(query: str) -> str:
+    @medido("tool.ConsultaPDF")
+    async def consulta_chromadb(query: str) -> str:
         try:
-            results = collection.query(query_texts=[query], n_results=3)
-            if not results['documents'][0]:
+            resultado = await consultar_polizas(retriever, query)
+            if resultado is None:
                 return "No encontré información relevante en los documentos de pólizas."
-            
-            contenido = "\n\n".join(results['documents'][0])
-            if len(contenido.strip()) < 50:
-                 return "No encontré información clara en los documentos de pólizas."
-
-            metadatos = ""
-            if results['metadatas'] and results['metadatas'][0]:
-                fuentes = {os.path.basename(m['source']) for m in results['metadatas'][0] if m and 'source' in m}
-                if fuentes:
-                    metadatos = f"\n\nFuentes: {', '.join(fuentes)}"
-            return f"Información encontrada en documentos de pólizas:\n\n{contenido}{metadatos}"
+            return resultado
         except Exception as e:
             return f"Error consultando ChromaDB: {e}"
     
     return Tool(
         name="ConsultaPDF",
-        func=consulta_chromadb,
+        func=None,
+        coroutine=consulta_chromadb,
         description="HERRAMIENTA OBLIGATORIA: Busca información en documentos PDF de pólizas de seguros. DEBES usarla para TODA pregunta. Contiene 267 chunks de información sobre seguros, pólizas, coberturas, etc."
     )
 
@@ -63,46 +221,108 @@ def crear_tool_buscador_noticias():
     Crea una herramienta de búsqueda de noticias robusta que maneja queries vacíos.
     """
     # 1. Creamos una función "envoltorio" (wrapper)
-    def buscar_noticias_seguras(query: str) -> str:
+    @medido("tool.buscar_noticias_del_sector")
+    async def buscar_noticias_seguras(query: str) -> str:
         # 2. La validación clave para evitar el crash
         if not query or not isinstance(query, str) or len(query.strip()) < 3:
             return "Para poder buscar noticias, necesito que me indiques un tema claro. Por ejemplo: 'noticias sobre seguros de ciberseguridad'."
         
-        # 3. Si la validación pasa, ejecutamos la búsqueda real
-        print(f"🔎 Buscando noticias en internet sobre: '{query}'")
-
-        search_tool = DuckDuckGoSearchRun() 
-        return search_tool.run(query)
+        # 3. Si la validación pasa, ejecutamos la búsqueda real: con plazo, caché
+        #    y circuit breaker; si no hay resultados a tiempo, devuelve un aviso.
+        log_evento("noticias.busqueda", query=query)
+        return await buscador_noticias.buscar(query)
 
     # 4. Creamos la herramienta con nuestra función segura
     return Tool(
         name="buscar_noticias_del_sector",
-        func=buscar_noticias_seguras,
+        func=None,
+        coroutine=buscar_noticias_seguras,
         description="Úsala cuando el usuario pida 'noticias', 'actualidad' o 'novedades' sobre un TEMA ESPECÍFICO de seguros. Esta herramienta requiere un término de búsqueda claro."
     )
-def crear_tool_recombinador(collection, llm):
-    def recombinar_coberturas(temas_a_combinar: str) -> str:
+# Separadores entre temas: comas, punto y coma, "+", y las conjunciones "y"/"e"/"junto con"
+# como palabras completas (no la letra "y" dentro de "ley" o "muy").
+_SEPARADORES_TEMAS = re.compile(r"\s*(?:[,;+]|\by\b|\be\b|\bjunto con\b)\s*", re.IGNORECASE)
+
+
+def extraer_temas(texto: str, max_temas: int = RECOMBINER_MAX_TOPICS) -> list[str]:
+    """'hospitalización, urgencias y ley de seguros' -> ['hospitalización', 'urgencias', 'ley de seguros']"""
+    temas, vistos = [], set()
+    for tema in _SEPARADORES_TEMAS.split(texto):
+        tema = tema.strip(" .:'\"")
+        clave = normalizar_pregunta(tema)
+        if clave and clave not in vistos:
+            vistos.add(clave)
+            temas.append(tema)
+    return temas[:max_temas]
+
+
+def _articulos_citados(tema: str, indice: Optional[IndiceArticulos]) -> Optional[tuple[list[str], list[dict]]]:
+    """(textos, metadatos) de los artículos que cita `tema`, o None si no cita ninguno del índice."""
+    if indice is None:
+        return None
+    articulos = [articulos[0] for articulos in (indice.obtener(*ref) for ref in referencias(tema)) if articulos]
+    if not articulos:
+        return None
+    estadisticas_articulos.por_referencia += 1
+    return ([limpiar_fragmento(a.texto) for a in articulos],
+            [{"source": a.archivo, "poliza": a.poliza, "articulo": a.numero} for a in articulos])
+
+
+def crear_tool_recombinador(retriever: Retriever, llm):
+    @medido("tool.crear_nueva_cobertura_combinada")
+    async def recombinar_coberturas(temas_a_combinar: str) -> str:
         """
         Busca varios textos de cobertura sobre los temas dados y los fusiona en uno nuevo.
         Ejemplo de input: 'cobertura de hospitalización y cobertura ambulatoria'
         """
-        print(f"🤖 Recombinando coberturas para los temas: {temas_a_combinar}")
+        # Dos peticiones con los mismos temas (y alcance) a la vez comparten búsqueda y redacción
+        where = filtro_del_turno()
+        return await vuelos_herramientas.ejecutar(
+            ("crear_nueva_cobertura_combinada", normalizar_pregunta(temas_a_combinar), _clave_filtro(where)),
+            lambda: _recombinar(temas_a_combinar, where),
+        )
+
+    async def _recombinar(temas_a_combinar: str, where: Optional[dict]) -> str:
+        log_evento("recombinador.inicio", temas=temas_a_combinar)
         try:
-            # 1. Buscar fragmentos de texto para cada tema
-            temas = [tema.strip() for tema in temas_a_combinar.split("y")]
-            textos_encontrados = []
-            for tema in temas:
-                query = f"Artículo 2 sobre cobertura de {tema}"
-                results = collection.query(query_texts=[query], n_results=2)
-                if results and results.get('documents') and results['documents'][0]:
-                    textos_encontrados.extend(results['documents'][0])
-            
+            # 1. Buscar fragmentos para TODOS los temas a la vez (una sola
+            #    consulta al backend vectorial en lugar de una por tema)
+            temas = extraer_temas(temas_a_combinar)
+            if not temas:
+                return "Indícame qué coberturas quieres combinar, por ejemplo: 'hospitalización y urgencias'."
+            #    Los temas que citan un artículo concreto ("artículo 2 de la
+            #    POL320190074") se toman enteros del índice de artículos.
+            t0 = time.perf_counter()
+            indice = await cargador_articulos.aobtener() if ARTICLE_INDEX_ENABLED else None
+            resultados = [_articulos_citados(tema, indice) for tema in temas]
+            pendientes = [i for i, resultado in enumerate(resultados) if resultado is None]
+            if pendientes:
+                consultas = [f"Artículo 2 sobre cobertura de {temas[i]}" for i in pendientes]
+                buscados = await alcance_polizas.buscar_varios(retriever, consultas,
+                                                               RECOMBINER_RESULTS_PER_TOPIC, where)
+                for i, resultado in zip(pendientes, buscados):
+                    resultados[i] = resultado
+            retriever.latencias.registrar("recombinador", time.perf_counter() - t0)
+
+            # 2. Fragmentos intercalados por tema, sin duplicados y dentro del presupuesto
+            por_tema = [list(zip(documentos, metadatas)) for documentos, metadatas in resultados]
+            candidatos, ids_vistos = [], set()
+            for texto, metadata in intercalar(por_tema):
+                id_chunk = (metadata.get("source"), metadata.get("chunk_id")) if metadata.get("chunk_id") is not None else None
+                if id_chunk is not None:
+                    if id_chunk in ids_vistos:
+                        continue
+                    ids_vistos.add(id_chunk)
+                candidatos.append(texto)
+            unicos = [candidatos[i] for i in deduplicar_fragmentos(candidatos)]
+            textos_encontrados = ajustar_a_presupuesto(unicos, RECOMBINER_CONTEXT_TOKENS)
+
             if not textos_encontrados:
                 return "No encontré suficientes textos de cobertura sobre los temas que mencionaste para poder crear una nueva póliza."
 
             contexto_unificado = "\n\n== FIN DE UN DOCUMENTO ==\n\n".join(textos_encontrados)
 
-            # 2. Usar el LLM con un prompt específico para la tarea de fusión
+            # 3. Usar el LLM con un prompt específico para la tarea de fusión
             prompt_fusion = f"""Eres un abogado experto en seguros. Tu tarea es redactar un nuevo y único 'ARTÍCULO 2: COBERTURA' para una póliza de salud.
             Debes basarte EXCLUSIVAMENTE en los siguientes fragmentos de pólizas existentes. Combina las ideas, elimina redundancias y crea un texto coherente, claro y completo.
             El resultado debe ser un solo artículo unificado.
@@ -115,29 +335,31 @@ def crear_tool_recombinador(collection, llm):
             NUEVO ARTÍCULO 2: COBERTURA (Redacción unificada):
             """
             
-            # 3. Invocar al LLM para la tarea de generación
-            response = llm.invoke(prompt_fusion)
-            return response.content
+            # 4. La fusión se marca para que sus tokens lleguen al usuario según
+            #    se generan (ver `_eventos_del_agente`); la herramienta es
+            #    `return_direct`, así que su salida ES la respuesta del agente.
+            response = await llm.ainvoke(prompt_fusion, config={"tags": [ETIQUETA_STREAM_USUARIO]})
+            return _texto_del_chunk(response)
 
         except Exception as e:
             return f"Ocurrió un error durante el proceso de recombinación: {e}"
 
     return Tool(
         name="crear_nueva_cobertura_combinada",
-        func=recombinar_coberturas,
+        func=None,
+        coroutine=recombinar_coberturas,
+        return_direct=True,
         description="Herramienta avanzada. Úsala SOLO cuando el usuario pida explícitamente 'crear una nueva póliza', 'combinar coberturas', 'fusionar artículos' o 'crear un ejemplo de cobertura' a partir de temas existentes."
     )
 
-def crear_agente_executor(tools, llm):
-    """
-    Crea el agente y su ejecutor usando el método moderno y robusto `create_tool_calling_agent`.
-    """
-    # 1. El Prompt. Es más estructurado.
-    #    Aquí definimos el personaje y las reglas de forma inamovible.
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", """Eres "Asistente Protege+", un especialista amable, empático y muy competente en pólizas de seguros. Tu objetivo es hacer que el usuario se sienta acompañado y comprendido.
+# Prompt de sistema del agente. Viaja en TODAS las llamadas al LLM de cada
+# iteración del agente, así que se envía compactado (sin la sangría del código)
+# y como un mensaje ya construido: al no ser una plantilla, es idéntico byte a
+# byte en cada petición y forma un prefijo estable que el proveedor puede
+# reutilizar (caché implícita de prompts).
+PROMPT_SISTEMA_AGENTE = compactar_prompt("""Eres "Asistente Protege+", un especialista amable, empático y muy competente en pólizas de seguros. Tu objetivo es hacer que el usuario se sienta acompañado y comprendido.
         == TUS HERRAMIENTAS Y CUÁNDO USARLAS ==
-        1.  `consultar_polizas_seguros`: Tu herramienta por defecto. Si la pregunta es sobre coberturas, condiciones, artículos o cualquier detalle de una póliza, esta es tu elección.
+        1.  `ConsultaPDF`: Tu herramienta por defecto. Si la pregunta es sobre coberturas, condiciones, artículos o cualquier detalle de una póliza, esta es tu elección.
         2.  `buscar_noticias_del_sector`: Si el usuario menciona 'noticias', 'actualidad' o 'novedades' sobre un tema, usa esta herramienta. Asegúrate de extraer el tema de la pregunta del usuario para usarlo como término de búsqueda.
         3.  `crear_nueva_cobertura_combinada`: Misión especial. Úsala SOLO si el usuario pide explícitamente 'crear', 'combinar', 'fusionar' o 'hacer un ejemplo' de una nueva cobertura a partir de otras existentes.
 
@@ -149,26 +371,34 @@ def crear_agente_executor(tools, llm):
         == REGLAS DE ORO (INQUEBRANTABLES) ==
         1.  **IDENTIDAD:** Eres "Asistente Protege+". Nunca menciones que eres una IA, un modelo o de Google. Si te preguntan sobre tu naturaleza, responde con amabilidad: "Soy Asistente Protege+, tu especialista en pólizas. Mi propósito es ayudarte a navegar tus documentos de seguro. ¿En qué te puedo ayudar?".
         2.  **FOCO:** Tu mundo son los seguros. Si la pregunta es de otro tema, recházala cortésmente.
-        3.  **USO DE HERRAMIENTAS:** Para cualquier pregunta sobre seguros, tu acción principal es usar la herramienta `consultar_polizas_seguros`.
+        3.  **USO DE HERRAMIENTAS:** Para cualquier pregunta sobre seguros, tu acción principal es usar la herramienta `ConsultaPDF`.
 
         == ESTRUCTURA DE RESPUESTA (Cuando encuentras información) ==
         1.  Confirma la recepción de la pregunta.
         2.  Presenta la información de forma clara, resumiendo y usando viñetas.
         3.  Cierra con una pregunta abierta para invitar a seguir la conversación.
 
-        # ================================================================= #
-        # === REGLA CRÍTICA: MANEJO DE CONVERSACIÓN Y MEMORIA CONTEXTUAL ==== #
-        # ================================================================= #
+        == REGLA CRÍTICA: MANEJO DE CONVERSACIÓN Y MEMORIA CONTEXTUAL ==
         PRESTA MUCHA ATENCIÓN al historial del chat (`chat_history`). Las preguntas cortas del usuario como 'y por qué?', 'dónde dice eso?', 'pero de que articulo es?' o 'y sobre la cobertura X?' NO tienen sentido por sí solas.
         ANTES DE RESPONDER, DEBES leer los mensajes anteriores para entender el contexto completo.
 
         EJEMPLO DE RAZONAMIENTO CORRECTO:
         - Historial: El usuario acaba de enviar el texto "Los reembolsos se efectuarán...".
         - Pregunta Actual: "pero de que articulo es?"
-        - TU PENSAMIENTO: 'La pregunta 'de qué artículo es' se refiere al texto sobre 'reembolsos' que el usuario me dio justo antes. Mi tarea es tomar ese texto y buscarlo con mi herramienta `consultar_polizas_seguros` para encontrar su ubicación en la póliza.'
-        
+        - TU PENSAMIENTO: 'La pregunta 'de qué artículo es' se refiere al texto sobre 'reembolsos' que el usuario me dio justo antes. Mi tarea es tomar ese texto y buscarlo con mi herramienta `ConsultaPDF` para encontrar su ubicación en la póliza.'
+
         Si el usuario te da un texto de la póliza y luego te pregunta dónde está, TU DEBER es usar la herramienta para buscar ESE texto.
-        """),
+        """)
+MENSAJE_SISTEMA_AGENTE = SystemMessage(content=PROMPT_SISTEMA_AGENTE)
+
+def crear_agente_executor(tools, llm):
+    """
+    Crea el agente y su ejecutor usando el método moderno y robusto `create_tool_calling_agent`.
+    """
+    # 1. El Prompt. Es más estructurado.
+    #    Aquí definimos el personaje y las reglas de forma inamovible.
+    prompt = ChatPromptTemplate.from_messages([
+        MENSAJE_SISTEMA_AGENTE,
         ("placeholder", "{chat_history}"),
         ("human", "{input}"),
         ("placeholder", "{agent_scratchpad}"),
@@ -178,99 +408,495 @@ def crear_agente_executor(tools, llm):
     agent = create_tool_calling_agent(llm, tools, prompt)
 
     # 3. Creamos el ejecutor del agente, que maneja el ciclo de ejecución.
-    #    La memoria se pasa aquí.
-    memory = ConversationBufferMemory(
-        memory_key="chat_history", 
-        return_messages=True, 
-        output_key="output"
-    )
-    
+    #    NO lleva memoria propia: es un runnable sin estado que se construye una
+    #    sola vez y se comparte entre todas las peticiones. El historial de cada
+    #    sesión se inyecta en `chat_history` desde `memory_store`.
+    #    Sin `verbose`: cada paso se mide y se traza en `app/observability.py`.
     return AgentExecutor(
         agent=agent, 
         tools=tools, 
-        verbose=True, 
-        memory=memory,
+        verbose=False, 
         handle_parsing_errors=True # Muy importante para producción
     )
 
-# --- CONFIGURACIÓN GLOBAL  ---
-
+def crear_agente_con_memoria(agent_executor, memory_store: SessionMemoryStore):
+    """
+    Envuelve el ejecutor (compartido) para que cargue y guarde el historial de
+    la sesión indicada en `config={"configurable": {"session_id": ...}}`.
+    """
+    return RunnableWithMessageHistory(
+        agent_executor,
+        memory_store.get_history,
+        input_messages_key="input",
+        history_messages_key="chat_history",
+        output_messages_key="output",
+    )
 
+def crear_llm():
+    """
+    Configura el cliente de Gemini. La importación del SDK se hace aquí (y no
+    al importar el módulo) porque es de las más lentas de la aplicación.
+    """
+    from langchain_google_genai import ChatGoogleGenerativeAI
 
-collection = cargar_chromadb()
+    google_api_key = os.getenv("GOOGLE_API_KEY") 
+    if not google_api_key:
+        raise ValueError("La variable de entorno GOOGLE_API_KEY no está configurada.")
 
+    return ChatGoogleGenerativeAI(
+        model="gemini-1.5-flash-latest", # O el modelo de Gemini que prefieras
+        google_api_key=google_api_key,
+        temperature=0.1,
+        convert_system_message_to_human=True # Útil para compatibilidad con algunos agentes
+    )
 
+def crear_resumidor(llm):
+    """
+    Devuelve la función con la que `memory_store` condensa los turnos antiguos
+    de una conversación en un resumen breve (se ejecuta en segundo plano).
+    """
+    async def resumir_historial(resumen_previo: str, mensajes) -> str:
+        turnos = "\n".join(
+            f"{'Usuario' if isinstance(m, HumanMessage) else 'Asistente'}: {m.content}" for m in mensajes
+        )
+        prompt_resumen = f"""Resume la siguiente conversación entre un usuario y un asistente de pólizas de seguros.
+        Conserva SOLO lo necesario para entender preguntas posteriores: pólizas, coberturas, artículos y datos concretos mencionados, y lo que el usuario quiere saber.
+        Escribe un único párrafo breve, en español, sin saludos.
 
+        RESUMEN ANTERIOR:
+        {resumen_previo or "(ninguno)"}
 
-# 2. Crear las herramientas
-tool_chromadb = crear_tool_chromadb(collection)
-tool_web = crear_tool_web()
-tools = [tool_chromadb, tool_web]
+        NUEVOS TURNOS:
+        {turnos}
 
-# 3. Configurar el LLM
-# Usamos una variable de entorno para la URL de Ollama, con un valor por defecto
-# para que Docker pueda comunicarse con el Ollama que corre en el host (tu PC).
+        RESUMEN ACTUALIZADO:
+        """
+        respuesta = await llm.ainvoke(prompt_resumen, config={"callbacks": [instrumentacion_llm]})
+        return _texto_del_chunk(respuesta)
+
+    return resumir_historial
+
+# --- CONFIGURACIÓN GLOBAL ---
+# Importar este módulo NO abre conexiones ni crea clientes: solo prepara
+# objetos baratos. Lo costoso (LLM, herramientas, agente) se construye una
+# sola vez en `inicializar_agente`, que el lifespan de FastAPI lanza al
+# arrancar (ver `app/main.py`) o, en su defecto, la primera petición.
+
+# 1. Preparar el acceso (asíncrono y perezoso) a la base de datos vectorial,
+#    con la búsqueda híbrida (vectores + BM25) y las cachés delante.
+vector_store = cargar_vector_store()
+retriever = Retriever(vector_store)
+
+# 2. Router de intenciones: reutiliza los embeddings (memoizados) del retriever
+router = RouterIntenciones(retriever.embeddings)
+# ...y búsqueda adelantada de la pregunta mientras el agente decide qué hacer
+recuperacion_anticipada = RecuperacionAnticipada(functools.partial(alcance_polizas.buscar, retriever))
+
+# 3. Memoria por sesión y caché de respuestas (exacta + semántica)
+memory_store = SessionMemoryStore()
+answer_cache = AnswerCache()
+
+# 4. LLM, herramientas y agente: se rellenan en `inicializar_agente`
+llm = None
+tools = None
+agent_executor = None
+agente_con_memoria = None
+_lock_inicializacion = asyncio.Lock()
+
+
+async def inicializar_agente():
+    """Construye el LLM, las herramientas y el agente UNA sola vez (idempotente)."""
+    global llm, tools, agent_executor, agente_con_memoria
+    if agente_con_memoria is not None:
+        return
+    async with _lock_inicializacion:
+        if agente_con_memoria is not None:
+            return
+        # Crear el cliente y el grafo del agente es CPU + importaciones: fuera del event loop.
+        nuevo_llm = await run_blocking(crear_llm)
+        nuevas_tools = [
+            crear_tool_chromadb(retriever),
+            crear_tool_buscador_noticias(),
+            crear_tool_recombinador(retriever, nuevo_llm) 
+        ]
+        executor = await run_blocking(crear_agente_executor, nuevas_tools, nuevo_llm)
+        llm, tools, agent_executor = nuevo_llm, nuevas_tools, executor
+        agente_con_memoria = crear_agente_con_memoria(executor, memory_store)
+        memory_store.resumidor = crear_resumidor(nuevo_llm)
+        log_evento("agente.inicializado", muestrear=False, herramientas=[tool.name for tool in nuevas_tools])
 
-google_api_key = os.getenv("GOOGLE_API_KEY") 
-if not google_api_key:
-    raise ValueError("La variable de entorno GOOGLE_API_KEY no está configurada.")
+# =========================================================================
+# === FIN: LÓGICA ORIGINAL --- INICIO: CAPA DE CONEXIÓN WEB (Streaming) ===
+# =========================================================================
 
-llm = ChatGoogleGenerativeAI(
-    model="gemini-1.5-flash-latest", # O el modelo de Gemini que prefieras
-    google_api_key=google_api_key,
 
-    temperature=0.0,
+# Mensajes de progreso que se muestran mientras corre cada herramienta.
+MENSAJES_ESTADO = {
+    "ConsultaPDF": "Consultando las pólizas…",
+    "buscar_noticias_del_sector": "Buscando noticias del sector…",
+    "crear_nueva_cobertura_combinada": "Combinando coberturas…",
+}
 
-    temperature=0.1,
-    convert_system_message_to_human=True # Útil para compatibilidad con algunos agentes
 
-)
+def _texto_del_chunk(chunk) -> str:
+    """Extrae el texto de un `AIMessageChunk` (Gemini puede devolver str o lista de partes)."""
+    contenido = chunk.content
+    if isinstance(contenido, str):
+        return contenido
+    return "".join(
+        parte.get("text", "") if isinstance(parte, dict) else str(parte)
+        for parte in contenido
+    )
 
 
-print("✅ Lógica del agente y herramientas inicializadas.")
+async def _eventos_del_agente(question: str, session_id: str, herramientas_usadas: set,
+                              anticipar: bool = True) -> AsyncGenerator[EventoChat, None]:
+    """
+    Recorre `astream_events` del agente y traduce cada evento relevante:
+    - `on_chat_model_stream` del agente  -> EventoChat("token", ...)
+    - `on_tool_start`                    -> EventoChat("estado", ...)
+    Los tokens de LLMs invocados DENTRO de una herramienta no se reenvían,
+    salvo los marcados con ETIQUETA_STREAM_USUARIO (p. ej. la redacción del
+    recombinador, cuya salida es directamente la respuesta final).
+    Los nombres de las herramientas ejecutadas se añaden a `herramientas_usadas`.
+    Al terminar se registran los tokens de prompt del turno en `memory_store`.
+
+    Con `anticipar`, la búsqueda de la pregunta en las pólizas arranca a la vez
+    que la primera llamada del agente (`app/prefetch.py`), si la pregunta se
+    entiende sin el historial, no es de noticias ni de combinar coberturas y
+    no cita un artículo (eso lo resuelve el índice de artículos sin buscar).
+    """
+    await inicializar_agente()
+    prefetch = None
+    clave = normalizar_pregunta(question)
+    if anticipar and es_pregunta_autonoma(clave) and usara_consulta_de_polizas(clave) \
+            and not referencias(question):
+        prefetch = recuperacion_anticipada.iniciar(question, where=filtro_del_turno())
+    # `instrumentacion_llm` mide cada llamada al LLM del turno (también las de las herramientas)
+    config = {"configurable": {"session_id": session_id}, "callbacks": [instrumentacion_llm]}
+    herramientas_directas = {t.name for t in tools if t.return_direct}
+    herramientas_activas = 0
+    tokens_prompt = 0
+    streameado_en_herramienta = False
+    eventos = agente_con_memoria.astream_events({"input": question}, config=config, version="v2")
+    try:
+        async for evento in eventos:
+            tipo = evento["event"]
+            if tipo == "on_chat_model_end" and herramientas_activas == 0:
+                # Gemini informa de los tokens reales de entrada de cada llamada del agente
+                uso = getattr(evento["data"].get("output"), "usage_metadata", None) or {}
+                tokens_prompt += uso.get("input_tokens", 0)
+            elif tipo == "on_tool_start":
+                herramientas_activas += 1
+                herramientas_usadas.add(evento["name"])
+                streameado_en_herramienta = False
+                mensaje = MENSAJES_ESTADO.get(evento["name"])
+                if mensaje:
+                    yield EventoChat("estado", mensaje)
+            elif tipo == "on_tool_end":
+                herramientas_activas = max(0, herramientas_activas - 1)
+                if evento["name"] in herramientas_directas and not streameado_en_herramienta:
+                    # Salida directa que no pasó por el LLM (p. ej. un mensaje de error)
+                    salida = evento["data"].get("output")
+                    texto = str(getattr(salida, "content", salida) or "")
+                    if texto:
+                        yield EventoChat("token", texto)
+            elif tipo == "on_chat_model_stream" and (
+                    herramientas_activas == 0 or ETIQUETA_STREAM_USUARIO in evento.get("tags", [])):
+                texto = _texto_del_chunk(evento["data"]["chunk"]).replace("```", "")
+                if texto:
+                    if herramientas_activas:
+                        streameado_en_herramienta = True
+                    yield EventoChat("token", texto)
+    finally:
+        await eventos.aclose()
+        recuperacion_anticipada.terminar(prefetch)
+    memory_store.registrar_turno(session_id, memory_store.get_history(session_id).tokens_ultima_vista,
+                                 tokens_prompt or None)
+
+
+# Prompt de las respuestas directas del router: mismo personaje, reglas e
+# historial que el agente, pero sin herramientas (la información ya va incluida).
+# Compactado igual que el del agente.
+PROMPT_RESPUESTA_DIRECTA = ChatPromptTemplate.from_messages([
+    ("system", compactar_prompt("""Eres "Asistente Protege+", un especialista amable, empático y muy competente en pólizas de seguros.
+    - **Tono:** Profesional pero cercano. Usa un lenguaje claro y evita la jerga compleja.
+    - **IDENTIDAD:** Nunca menciones que eres una IA, un modelo o de Google.
+    - **FUENTES:** Responde EXCLUSIVAMENTE con la información que se te da. Si no basta para responder, dilo con amabilidad y sugiere cómo reformular la pregunta.
+    - **ESTRUCTURA:** Confirma la pregunta, presenta la información de forma clara (resumiendo y con viñetas) y cierra con una pregunta abierta.
+    """)),
+    ("placeholder", "{chat_history}"),
+    ("human", compactar_prompt("""INFORMACIÓN DISPONIBLE:
+    ---
+    {contexto}
+    ---
+
+    PREGUNTA DEL USUARIO: {input}
+    """)),
+])
+
+
+async def _eventos_directos(question: str, session_id: str, intencion: str,
+                            herramientas_usadas: set) -> AsyncGenerator[EventoChat, None]:
+    """
+    Atajo del router: la herramienta que corresponde a la intención y UNA sola
+    llamada al LLM, sin el paso previo en el que el agente decide qué hacer.
+    Si la consulta de pólizas no encuentra nada, se recurre al agente completo.
+    El historial de la sesión va en el prompt y el turno se añade a la memoria
+    al terminar (como haría el agente).
+    """
+    await inicializar_agente()
+    nombre_herramienta = "ConsultaPDF" if intencion == INTENCION_POLIZA else "buscar_noticias_del_sector"
+    herramientas_usadas.add(nombre_herramienta)
+    yield EventoChat("estado", MENSAJES_ESTADO[nombre_herramienta])
+
+    if intencion == INTENCION_POLIZA:
+        contexto = await consultar_polizas(retriever, question, n_results=ROUTER_RESULTS)
+        if contexto is None:
+            router.registrar_recurso_al_agente()
+            # Sin búsqueda adelantada: la misma consulta acaba de volver vacía
+            async for evento in _eventos_del_agente(question, session_id, herramientas_usadas, anticipar=False):
+                yield evento
+            return
+    else:
+        contexto = await buscador_noticias.buscar(question)
+
+    historial = memory_store.get_history(session_id)
+    partes, tokens_prompt = [], 0
+    cadena = PROMPT_RESPUESTA_DIRECTA | llm
+    config = {"callbacks": [instrumentacion_llm], "run_name": f"respuesta_directa_{intencion}"}
+    entrada = {"contexto": contexto, "input": question, "chat_history": historial.messages}
+    async for chunk in cadena.astream(entrada, config=config):
+        tokens_prompt += (getattr(chunk, "usage_metadata", None) or {}).get("input_tokens", 0)
+        texto = _texto_del_chunk(chunk).replace("```", "")
+        if texto:
+            partes.append(texto)
+            yield EventoChat("token", texto)
+
+    respuesta = "".join(partes).strip()
+    if respuesta:
+        historial.add_messages([HumanMessage(content=question), AIMessage(content=respuesta)])
+    memory_store.registrar_turno(session_id, historial.tokens_ultima_vista, tokens_prompt or None)
+
+
+# Herramientas cuyas respuestas caducan enseguida: si se usaron, no se cachea.
+HERRAMIENTAS_NO_CACHEABLES = {"buscar_noticias_del_sector"}
+
+
+async def _buscar_en_cache(question: str, clave: str, semantica: bool = True):
+    """
+    Consulta los dos niveles de la caché de respuestas.
+    Devuelve (respuesta o None, embedding de la pregunta o None).
 
+    Sin `semantica` (turnos acotados a unas pólizas) solo vale la clave exacta:
+    una pregunta parecida sobre otras pólizas no tiene la misma respuesta.
+    """
+    answer_cache.asegurar_version(await vector_store.version())
+    respuesta = answer_cache.buscar_exacta(clave)
+    if respuesta is not None:
+        return respuesta, None
+    if not semantica:
+        answer_cache.registrar_miss()
+        return None, None
+    embedding = await retriever.embedding(question)
+    return answer_cache.buscar_semantica(clave, embedding), embedding
+
+
+async def _hidratar_sesion(session_id: str) -> None:
+    """Si la sesión no está en memoria (reinicio, TTL...), recupera sus últimos mensajes de la base de datos."""
+    if memory_store.contiene(session_id):
+        return
+    try:
+        async with SessionLocal() as db:
+            mensajes = await crud.get_recent_messages(db, session_id, HISTORY_HYDRATE_MESSAGES)
+    except Exception as e:
+        log_evento("historial.error_hidratacion", logging.WARNING, session_id=session_id, error=str(e))
+        return
+    memory_store.hidratar(session_id, [
+        HumanMessage(content=m.content) if m.role == "human" else AIMessage(content=m.content)
+        for m in mensajes
+    ])
 
-tools = [
-    crear_tool_chromadb(collection),
-    crear_tool_buscador_noticias(),
-    crear_tool_recombinador(collection, llm) 
-]
 
-# =========================================================================
-# === FIN: LÓGICA ORIGINAL --- INICIO: CAPA DE CONEXIÓN WEB (Streaming) ===
-# =========================================================================
+def _persistir_turno(session_id: str, question: str, respuesta: str) -> None:
+    # Escritura diferida: no espera a la base de datos
+    history_writer.encolar(session_id, "human", question)
+    history_writer.encolar(session_id, "ai", respuesta)
 
 
-async def get_agent_response(question: str, session_id: str) -> AsyncGenerator[str, None]:
+async def get_agent_response(question: str, session_id: str) -> AsyncGenerator[EventoChat, None]:
+    """
+    Función puente que usa el agente `Tool Calling` (construido una sola vez al
+    arrancar) con el historial de la sesión `session_id`.
+
+    Devuelve los tokens del LLM a medida que se generan (y avisos de estado
+    mientras corren las herramientas), a través de una cola acotada que aplica
+    backpressure y cancela el agente si el cliente se desconecta.
+
+    Las preguntas autónomas (que no dependen del historial) pasan antes por la
+    caché de respuestas; si hay acierto no se llama ni a Gemini ni a ChromaDB.
+    Si no, el router (`app/router.py`) responde las preguntas claras de pólizas
+    o de noticias con una sola llamada al LLM y deja el resto al agente.
+    Las búsquedas del turno se limitan a las pólizas citadas en la pregunta o
+    en la conversación, o a las del usuario (`app/policy_scope.py`); esas
+    pólizas forman parte de la clave de la caché y del single-flight.
+
+    Si la misma pregunta autónoma ya se está respondiendo para otra petición
+    con el mismo historial (o ambas sin historial), este turno recibe ese mismo
+    stream en lugar de calcular el suyo (`app/singleflight.py`).
+
+    Cada turno completo se guarda en la base de datos en segundo plano, y una
+    sesión que no está en memoria se rehidrata desde ahí antes de responder.
+
+    El turno completo se mide como la etapa `chat.turno`, junto con el tiempo
+    hasta el primer token y un log estructurado (muestreado) por turno, que
+    incluye los tokens de contexto ahorrados al compactar los fragmentos.
     """
+    t0 = time.perf_counter()
+    medidas = {"origen": "agente", "herramientas": set(), "tokens": 0, "primer_token": None, "alcance": None}
+    ahorro = {"antes": 0, "despues": 0}
+    ahorro_turno.set(ahorro)
+    resultado = "error"
+    respuestas = _responder(question, session_id, medidas)
+    try:
+        with etapa("chat.turno") as span:
+            async for evento in respuestas:
+                if evento.tipo == "token":
+                    if medidas["primer_token"] is None:
+                        medidas["primer_token"] = time.perf_counter()
+                        TTFT.observar(medidas["primer_token"] - t0)
+                    medidas["tokens"] += 1
+                yield evento
+            if span is not None:
+                span.set_attribute("chat.origen", medidas["origen"])
+                span.set_attribute("chat.tokens", medidas["tokens"])
+        resultado = medidas["origen"]
+    except (asyncio.CancelledError, GeneratorExit):
+        resultado = "cancelada"
+        raise
+    finally:
+        await respuestas.aclose()  # Cancela el agente si el cliente se fue a mitad del stream
+        fin = time.perf_counter()
+        primer_token = medidas["primer_token"]
+        if primer_token is not None:
+            DURACION_ETAPA.observar(fin - primer_token, stage="chat.stream")
+        PETICIONES_CHAT.inc(result=resultado)
+        TOKENS_STREAM.inc(medidas["tokens"])
+        log_evento(
+            "chat.turno",
+            session_id=session_id,
+            resultado=resultado,
+            herramientas=sorted(medidas["herramientas"]),
+            alcance=medidas["alcance"],
+            tokens=medidas["tokens"],
+            tokens_contexto=ahorro["despues"],
+            tokens_contexto_ahorrados=ahorro["antes"] - ahorro["despues"],
+            ttft_ms=round((primer_token - t0) * 1000, 1) if primer_token is not None else None,
+            total_ms=round((fin - t0) * 1000, 1),
+        )
+
+
+async def _eventos_del_turno(question: str, session_id: str, clave: str, embedding,
+                             medidas: dict) -> AsyncGenerator[EventoChat, None]:
+    """Eventos de la respuesta generada para este turno: el router elige el atajo directo o el agente."""
+    # Router: las preguntas claras evitan el bucle del agente (una llamada al LLM menos)
+    herramientas_usadas = medidas["herramientas"]
+    intencion = await router.clasificar(clave, embedding)
+    if intencion == INTENCION_AGENTE:
+        eventos = _eventos_del_agente(question, session_id, herramientas_usadas)
+    else:
+        medidas["origen"] = f"directo_{intencion}"
+        eventos = _eventos_directos(question, session_id, intencion, herramientas_usadas)
+    try:
+        async for evento in eventos:
+            yield evento
+    finally:
+        await eventos.aclose()
+
 
-    Función puente que ahora usa el `AgentExecutor` con el agente `Tool Calling`.
+def _huella_historial(mensajes: list) -> str:
     """
-    # Creamos una instancia fresca del ejecutor para cada petición para mantener el estado aislado.
-    agent_executor = crear_agente_executor(tools, llm)
-
-    async for chunk in agent_executor.astream({"input": question}):
-        # La salida de astream puede variar, buscamos la respuesta final en 'output'
-        if "output" in chunk:
-            cleaned_output = chunk["output"].replace("```", "").strip()
-            if cleaned_output:
-                yield cleaned_output
-
-    Función "puente" que usa las funciones del equipo de IA para responder
-    a una petición web de forma asíncrona y con streaming, usando el método nativo
-    de LangChain `.astream()`.
+    Parte de la clave del single-flight del chat: el líder responde con SU
+    historial, así que solo se agrupan turnos con la misma conversación detrás.
+    Vacía para las sesiones sin historial (las de usuarios distintos se agrupan);
+    si no, un hash de los mensajes (un doble envío de la misma sesión coincide).
     """
-    # Creamos una instancia fresca del agente para cada petición.
-    # Ya no necesitamos pasarle el callback.
-    agent_executor = crear_agente(tools, llm)
-
-    # El método .astream() es un generador asíncrono que devuelve
-    # los pasos del pensamiento del agente en tiempo real.
-    async for chunk in agent_executor.astream({"input": question}):
-        # El agente devuelve diferentes tipos de "chunks" (pasos de acción, observaciones, etc.)
-        # A nosotros solo nos interesa el chunk final que contiene la respuesta del LLM.
-        # Este chunk se identifica porque tiene la clave "output".
-        if "output" in chunk:
-            # Hacemos yield de cada trozo de la respuesta final a medida que llega.
-            yield chunk["output"]
-
+    if not mensajes:
+        return ""
+    huella = hashlib.sha1()
+    for mensaje in mensajes:
+        huella.update(f"{mensaje.type}\x00{mensaje.content}\x01".encode("utf-8"))
+    return huella.hexdigest()
+
+
+async def _responder(question: str, session_id: str, medidas: dict) -> AsyncGenerator[EventoChat, None]:
+    """Cuerpo de `get_agent_response`. Anota en `medidas` el origen de la respuesta y las herramientas usadas."""
+    await _hidratar_sesion(session_id)
+    clave = normalizar_pregunta(question)
+    # Pólizas a las que se limitan las búsquedas del turno (de la pregunta, la conversación o "mis pólizas")
+    mensajes = memory_store.get_history(session_id).messages
+    alcance = await alcance_polizas.resolver(question, session_id, mensajes)
+    alcance_turno.set(alcance)
+    medidas["alcance"] = alcance.origen if alcance is not None else None
+    # La respuesta depende de las pólizas del alcance: van en la clave de la caché
+    clave_cache = clave if alcance is None else f"{clave} @{' '.join(alcance.polizas)}"
+    cacheable = ANSWER_CACHE_ENABLED and es_pregunta_autonoma(clave)
+    embedding = None
+    if cacheable:
+        try:
+            respuesta, embedding = await _buscar_en_cache(question, clave_cache, semantica=alcance is None)
+        except Exception as e:
+            # La caché es una optimización: si falla, respondemos con el agente.
+            log_evento("cache_respuestas.error", logging.WARNING, error=str(e))
+            answer_cache.registrar_miss()
+            respuesta, cacheable = None, False
+        if respuesta is not None:
+            # Registramos el turno en la memoria para que las preguntas de seguimiento funcionen.
+            memory_store.get_history(session_id).add_messages(
+                [HumanMessage(content=question), AIMessage(content=respuesta)]
+            )
+            _persistir_turno(session_id, question, respuesta)
+            medidas["origen"] = "cache"
+            yield EventoChat("token", respuesta)
+            return
+
+    herramientas_usadas = medidas["herramientas"]
+    vuelo = None
+    if es_pregunta_autonoma(clave):
+        try:
+            vuelo = (clave, await vector_store.version(), _clave_filtro(alcance.where if alcance else None),
+                     _huella_historial(mensajes))
+        except Exception as e:
+            log_evento("singleflight.error", logging.WARNING, error=str(e))
+    lider = True
+    if vuelo is not None:
+        # Single-flight: si la misma pregunta ya se está respondiendo con la
+        # misma conversación detrás (sesiones nuevas de otros usuarios, un
+        # doble envío...), este turno recibe ese mismo stream.
+        eventos, lider = vuelos_chat.suscribir(
+            vuelo, lambda: _eventos_del_turno(question, session_id, clave, embedding, medidas))
+        if not lider:
+            medidas["origen"] = "agrupada"
+    else:
+        eventos = stream_con_backpressure(_eventos_del_turno(question, session_id, clave, embedding, medidas))
+    partes = []
+    try:
+        async for evento in eventos:
+            if evento.tipo == "token":
+                partes.append(evento.contenido)
+            yield evento
+    finally:
+        await eventos.aclose()  # En single-flight, el último suscriptor en irse cancela el cálculo
+
+    # Solo llegamos aquí si el stream se completó (sin desconexión ni error).
+    respuesta = "".join(partes).strip()
+    if respuesta:
+        if not lider:
+            # El turno lo generó otra sesión: se registra también en la memoria de esta
+            memory_store.get_history(session_id).add_messages(
+                [HumanMessage(content=question), AIMessage(content=respuesta)]
+            )
+        _persistir_turno(session_id, question, respuesta)
+    # La respuesta agrupada ya la guarda en la caché la petición que la generó
+    if cacheable and lider and respuesta and not (herramientas_usadas & HERRAMIENTAS_NO_CACHEABLES):
+        answer_cache.guardar(clave_cache, respuesta, embedding)
@@ -0,0 +1,220 @@
+import re
+from contextvars import ContextVar
+from dataclasses import dataclass
+from itertools import zip_longest
+from typing import Optional
+
+from .answer_cache import normalizar_pregunta
+from .hybrid_search import tokenizar
+from .observability import TOKENS_CONTEXTO
+from .tokens import estimar_tokens, recortar_a_tokens
+
+# =========================================================================
+# Preparación del contexto que se envía al LLM: fragmentos recuperados sin
+# duplicados (los chunks se solapan entre sí por el `chunk_overlap` de la
+# ingesta) y recortados a un presupuesto de tokens.
+#
+# Compactación (`compactar_fragmentos`): el texto extraído de los PDF trae
+# líneas en blanco, cabeceras repetidas en cada página y frases partidas en
+# varias líneas. Se limpia, se descartan los fragmentos casi idénticos y cada
+# uno se recorta alrededor de las frases que mejor casan con la consulta.
+# Los tokens ahorrados se acumulan por turno (`ahorro_turno`) y en total.
+# =========================================================================
+
+_TAM_SHINGLE = 5  # Palabras por shingle para detectar solapes
+
+
+def _shingles(texto: str) -> set:
+    palabras = normalizar_pregunta(texto).split()
+    if len(palabras) <= _TAM_SHINGLE:
+        return {tuple(palabras)}
+    return {tuple(palabras[i:i + _TAM_SHINGLE]) for i in range(len(palabras) - _TAM_SHINGLE + 1)}
+
+
+def deduplicar_fragmentos(textos: list[str], umbral: float = 0.6) -> list[int]:
+    """
+    Devuelve las posiciones de `textos` que se conservan: se descarta un
+    fragmento si la mayor parte de sus shingles ya aparece en uno anterior
+    (copia exacta, o chunk vecino con mucho texto compartido). Se respeta el orden.
+    """
+    conservados, vistos = [], []
+    for i, texto in enumerate(textos):
+        shingles = _shingles(texto)
+        if not shingles:
+            continue
+        if any(len(shingles & otro) / len(shingles) >= umbral for otro in vistos):
+            continue
+        conservados.append(i)
+        vistos.append(shingles)
+    return conservados
+
+
+def intercalar(listas: list[list]) -> list:
+    """Round-robin entre listas (1º de cada una, luego 2º...): ningún tema se queda sin representación."""
+    return [x for grupo in zip_longest(*listas) for x in grupo if x is not None]
+
+
+def ajustar_a_presupuesto(textos: list[str], max_tokens: int) -> list[str]:
+    """Toma fragmentos en orden hasta agotar `max_tokens` (el primero se recorta si no cabe entero)."""
+    elegidos, usados = [], 0
+    for texto in textos:
+        coste = estimar_tokens(texto)
+        if not elegidos and coste > max_tokens:
+            texto = recortar_a_tokens(texto, max_tokens)
+            coste = max_tokens
+        elif usados + coste > max_tokens:
+            continue  # Puede que otro más corto sí quepa
+        elegidos.append(texto)
+        usados += coste
+    return elegidos
+
+
+# --- Compactación ---
+
+# Líneas que no aportan nada al LLM: cabecera del depósito de pólizas (el
+# código ya va en "Fuentes") y numeración de páginas.
+_LINEAS_RUIDO = re.compile(
+    r"^(incorporada al dep[oó]sito de p[oó]lizas.*"
+    r"|p[aá]gina\s+\d+(\s+de\s+\d+)?"
+    r"|-?\s*\d{1,3}\s*-?"
+    r"|\d{1,3}\s*/\s*\d{1,3})$",
+    re.IGNORECASE,
+)
+# Una línea que empieza así abre un bloque nuevo (no continúa la frase anterior)
+_INICIO_BLOQUE = re.compile(r"^(art[ií]culo|[A-Z]\)|\d+[.)]\s|[-•])", re.IGNORECASE)
+_FIN_FRASE = re.compile(r"(?<=[.;:])\s+")
+_LONGITUD_RAIZ = 5  # "reembolso" y "reembolsar" cuentan como el mismo término
+
+
+def limpiar_fragmento(texto: str) -> str:
+    """
+    Quita las líneas vacías y de ruido y une las frases partidas en varias
+    líneas. Se conserva un salto de línea antes y después de títulos y apartados.
+    """
+    bloques: list[str] = []
+    for linea in texto.splitlines():
+        linea = " ".join(linea.split())
+        if not linea or _LINEAS_RUIDO.match(linea):
+            continue
+        if (not bloques or _INICIO_BLOQUE.match(linea) or bloques[-1].endswith((".", ":"))
+                or bloques[-1].isupper()):  # Título en mayúsculas: va en su propia línea
+            bloques.append(linea)
+        elif bloques[-1].endswith("-"):
+            bloques[-1] = bloques[-1][:-1] + linea  # Palabra cortada con guion al final de línea
+        else:
+            bloques[-1] += " " + linea
+    return "\n".join(bloques)
+
+
+def _raices(texto: str) -> set:
+    return {t[:_LONGITUD_RAIZ] for t in tokenizar(texto) if len(t) > 2}
+
+
+def recortar_alrededor(texto: str, consulta: str, max_tokens: int) -> str:
+    """
+    Si `texto` supera `max_tokens`, se queda con la frase que más términos
+    comparte con `consulta` y la amplía con sus vecinas mientras quepan.
+    Sin coincidencias, se conserva el principio del fragmento.
+    """
+    if estimar_tokens(texto) <= max_tokens:
+        return texto
+    frases = [f for f in _FIN_FRASE.split(texto) if f.strip()]
+    terminos = _raices(consulta)
+    puntuaciones = [len(terminos & _raices(f)) for f in frases]
+    mejor = max(range(len(frases)), key=lambda i: puntuaciones[i])
+    if puntuaciones[mejor] == 0:
+        return recortar_a_tokens(texto, max_tokens)
+
+    inicio, fin = mejor, mejor + 1
+    usados = estimar_tokens(frases[mejor])
+    if usados > max_tokens:
+        return recortar_a_tokens(frases[mejor], max_tokens)
+    # Se amplía primero hacia delante (la frase que casa suele introducir lo que sigue)
+    while True:
+        candidatas = [i for i in (fin, inicio - 1) if 0 <= i < len(frases)]
+        coste = {i: estimar_tokens(frases[i]) for i in candidatas}
+        elegida = next((i for i in candidatas if usados + coste[i] <= max_tokens), None)
+        if elegida is None:
+            break
+        usados += coste[elegida]
+        if elegida == fin:
+            fin += 1
+        else:
+            inicio -= 1
+    recorte = " ".join(frases[inicio:fin])
+    return ("… " if inicio > 0 else "") + recorte + (" …" if fin < len(frases) else "")
+
+
+@dataclass
+class Compactacion:
+    textos: list[str]
+    posiciones: list[int]  # Posición en la lista original de cada texto conservado
+    tokens_antes: int
+    tokens_despues: int
+
+
+def compactar_fragmentos(textos: list[str], consulta: str, max_tokens_por_fragmento: int) -> Compactacion:
+    """Limpia, deduplica y recorta los fragmentos recuperados para `consulta`."""
+    limpios = [limpiar_fragmento(t) for t in textos]
+    posiciones = deduplicar_fragmentos(limpios)
+    compactos = [recortar_alrededor(limpios[i], consulta, max_tokens_por_fragmento) for i in posiciones]
+    resultado = Compactacion(
+        textos=compactos,
+        posiciones=posiciones,
+        tokens_antes=sum(estimar_tokens(t) for t in textos),
+        tokens_despues=sum(estimar_tokens(t) for t in compactos),
+    )
+    registrar_ahorro(resultado.tokens_antes, resultado.tokens_despues, len(textos) - len(posiciones))
+    return resultado
+
+
+def compactar_prompt(texto: str) -> str:
+    """
+    Versión compacta de un prompt escrito con sangría dentro del código: sin
+    la sangría, sin espacios al final de línea y sin líneas en blanco repetidas.
+    """
+    compactas = []
+    for linea in texto.strip().splitlines():
+        linea = linea.strip()
+        if not linea and compactas and not compactas[-1]:
+            continue
+        compactas.append(linea)
+    return "\n".join(compactas)
+
+
+# --- Ahorro de tokens ---
+
+@dataclass
+class EstadisticasContexto:
+    compactaciones: int = 0
+    fragmentos_duplicados: int = 0
+    tokens_antes: int = 0
+    tokens_despues: int = 0
+
+    def as_dict(self) -> dict:
+        return {
+            **self.__dict__,
+            "tokens_ahorrados": self.tokens_antes - self.tokens_despues,
+            "ratio": round(self.tokens_despues / self.tokens_antes, 3) if self.tokens_antes else None,
+        }
+
+
+estadisticas_contexto = EstadisticasContexto()
+
+# Acumulador del turno en curso. Es un dict mutable para que lo actualicen
+# también las herramientas, que el agente ejecuta en tareas hijas (con una
+# copia del contexto que apunta al mismo dict).
+ahorro_turno: ContextVar[Optional[dict]] = ContextVar("ahorro_turno", default=None)
+
+
+def registrar_ahorro(tokens_antes: int, tokens_despues: int, duplicados: int = 0) -> None:
+    estadisticas_contexto.compactaciones += 1
+    estadisticas_contexto.fragmentos_duplicados += duplicados
+    estadisticas_contexto.tokens_antes += tokens_antes
+    estadisticas_contexto.tokens_despues += tokens_despues
+    TOKENS_CONTEXTO.inc(tokens_antes, stage="antes")
+    TOKENS_CONTEXTO.inc(tokens_despues, stage="despues")
+    acumulado = ahorro_turno.get()
+    if acumulado is not None:
+        acumulado["antes"] += tokens_antes
+        acumulado["despues"] += tokens_despues
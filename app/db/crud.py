@@ -1,14 +1,70 @@
-from sqlalchemy.orm import Session
+from typing import Optional
+
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from . import models
-from app.security import get_password_hash
 
-def get_user_by_username(db: Session, username: str):
-    return db.query(models.User).filter(models.User.username == username).first()
+async def get_user_by_username(db: AsyncSession, username: str):
+    resultado = await db.execute(select(models.User).where(models.User.username == username))
+    return resultado.scalars().first()
 
-def create_user(db: Session, username: str, password: str):
-    hashed_password = get_password_hash(password)
+async def create_user(db: AsyncSession, username: str, hashed_password: str):
+    # El hash se calcula antes (ver `security.aget_password_hash`) fuera del event loop
     db_user = models.User(username=username, hashed_password=hashed_password)
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     return db_user
+
+async def get_or_create_conversation(db: AsyncSession, user_id: int) -> models.Conversation:
+    """Conversación más reciente del usuario (se crea la primera vez)."""
+    resultado = await db.execute(
+        select(models.Conversation)
+        .where(models.Conversation.user_id == user_id)
+        .order_by(models.Conversation.created_at.desc(), models.Conversation.id.desc())
+        .limit(1)
+    )
+    conversacion = resultado.scalars().first()
+    if conversacion is None:
+        conversacion = models.Conversation(user_id=user_id)
+        db.add(conversacion)
+        await db.flush()
+    return conversacion
+
+async def get_recent_messages(db: AsyncSession, username: str, limit: int) -> list[models.Message]:
+    """Últimos `limit` mensajes del usuario en orden cronológico (usa el índice (user_id, created_at))."""
+    resultado = await db.execute(
+        select(models.Message)
+        .join(models.User, models.User.id == models.Message.user_id)
+        .where(models.User.username == username)
+        .order_by(models.Message.created_at.desc(), models.Message.id.desc())
+        .limit(limit)
+    )
+    return list(reversed(resultado.scalars().all()))
+
+async def add_messages(db: AsyncSession, filas: list[dict]) -> None:
+    """Inserta varios mensajes en una sola sentencia (executemany). No hace commit."""
+    if filas:
+        await db.execute(models.Message.__table__.insert(), filas)
+
+async def get_user_id(db: AsyncSession, username: str) -> Optional[int]:
+    resultado = await db.execute(select(models.User.id).where(models.User.username == username))
+    return resultado.scalar()
+
+async def get_user_policies(db: AsyncSession, username: str) -> list[str]:
+    """Códigos de las pólizas del usuario ("mis pólizas"), en orden alfabético."""
+    resultado = await db.execute(
+        select(models.PolizaUsuario.poliza)
+        .join(models.User, models.User.id == models.PolizaUsuario.user_id)
+        .where(models.User.username == username)
+        .order_by(models.PolizaUsuario.poliza)
+    )
+    return list(resultado.scalars().all())
+
+async def set_user_policies(db: AsyncSession, user_id: int, polizas: list[str]) -> None:
+    """Sustituye las pólizas del usuario por `polizas`."""
+    await db.execute(delete(models.PolizaUsuario).where(models.PolizaUsuario.user_id == user_id))
+    if polizas:
+        await db.execute(models.PolizaUsuario.__table__.insert(),
+                         [{"user_id": user_id, "poliza": p} for p in polizas])
+    await db.commit()
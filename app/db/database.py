@@ -1,12 +1,48 @@
-from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./db/app_database.db"
+from app.config import DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_BUSY_TIMEOUT_MS
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SQLALCHEMY_DATABASE_URL = DATABASE_URL
+ES_SQLITE = SQLALCHEMY_DATABASE_URL.startswith("sqlite")
+
+if ES_SQLITE:
+    # aiosqlite ejecuta cada conexión en su propio hilo: el event loop nunca se bloquea.
+    engine = create_async_engine(SQLALCHEMY_DATABASE_URL)
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _pragmas_sqlite(dbapi_connection, connection_record):
+        # WAL: los lectores no esperan al escritor (el historial escribe mientras se hacen logins).
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")  # Seguro con WAL y mucho más rápido que FULL
+        cursor.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA cache_size=-16000")  # ~16 MB de caché de páginas
+        cursor.close()
+else:
+    # Postgres (u otra base con servidor): pool de conexiones reutilizadas.
+    engine = create_async_engine(
+        SQLALCHEMY_DATABASE_URL,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_pre_ping=True,
+    )
+
+# expire_on_commit=False: los objetos siguen siendo legibles tras el commit sin otra consulta.
+SessionLocal = async_sessionmaker(engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
+
+
+async def init_db() -> None:
+    """Crea las tablas que falten (usuarios, conversaciones, mensajes y pólizas de cada usuario)."""
+    from . import models  # noqa: F401  (registra los modelos en Base.metadata)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+
+async def close_db() -> None:
+    await engine.dispose()
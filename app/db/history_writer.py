@@ -0,0 +1,133 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Optional
+
+from app.config import HISTORY_WRITER_BATCH, HISTORY_WRITER_FLUSH_MS, HISTORY_WRITER_MAX_QUEUE
+from app.observability import log_evento
+from . import crud
+from .database import SessionLocal
+
+# Marca de fin en la cola: el bucle escribe el lote que tenga a medias y termina
+_FIN = object()
+
+
+class HistoryWriter:
+    """
+    Escritura diferida (write-behind) del historial de conversaciones.
+
+    `encolar` es síncrono y no espera a la base de datos: el turno se añade a
+    una cola acotada y el stream de la respuesta no paga ninguna latencia.
+    Una tarea en segundo plano vacía la cola por lotes (hasta `batch` mensajes
+    o `flush_ms` de espera) y guarda cada lote en UNA transacción.
+
+    Si la cola se llena (la base de datos no da abasto) se descartan mensajes
+    en lugar de acumular memoria sin límite; quedan contados en `descartados`.
+    """
+
+    def __init__(self, batch: int = HISTORY_WRITER_BATCH, flush_ms: float = HISTORY_WRITER_FLUSH_MS,
+                 max_queue: int = HISTORY_WRITER_MAX_QUEUE):
+        self.batch = batch
+        self.flush_segundos = flush_ms / 1000
+        self.max_queue = max_queue
+        self._cola: Optional[asyncio.Queue] = None
+        self._tarea: Optional[asyncio.Task] = None
+        # username -> (user_id, conversation_id): evita consultarlos en cada lote
+        self._conversaciones: dict[str, tuple[int, int]] = {}
+        self.escritos = 0
+        self.lotes = 0
+        self.descartados = 0
+        self.errores = 0
+
+    def iniciar(self) -> None:
+        if self._tarea is None:
+            self._cola = asyncio.Queue(maxsize=self.max_queue)
+            self._tarea = asyncio.create_task(self._bucle())
+
+    async def detener(self) -> None:
+        """Guarda lo que quede en la cola y termina la tarea de escritura."""
+        if self._tarea is None:
+            return
+        # Sin cancelar la tarea: una cancelación perdería el lote que ya sacó de la cola
+        await self._cola.put(_FIN)
+        await self._tarea
+        # Lo encolado después de la marca
+        pendientes = []
+        while not self._cola.empty():
+            pendientes.append(self._cola.get_nowait())
+        if pendientes:
+            await self._escribir(pendientes)
+        self._tarea = None
+
+    def encolar(self, username: str, role: str, content: str) -> None:
+        if self._cola is None:
+            return  # Sin base de datos (p. ej. en scripts): solo memoria
+        try:
+            self._cola.put_nowait((username, role, content, datetime.now(timezone.utc)))
+        except asyncio.QueueFull:
+            self.descartados += 1
+
+    async def _bucle(self) -> None:
+        loop = asyncio.get_running_loop()
+        fin = False
+        while not fin:
+            item = await self._cola.get()
+            if item is _FIN:
+                return
+            lote = [item]
+            limite = loop.time() + self.flush_segundos
+            while len(lote) < self.batch:
+                restante = limite - loop.time()
+                if restante <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._cola.get(), restante)
+                except asyncio.TimeoutError:
+                    break
+                if item is _FIN:
+                    fin = True
+                    break
+                lote.append(item)
+            await self._escribir(lote)
+
+    async def _escribir(self, lote: list[tuple]) -> None:
+        try:
+            async with SessionLocal() as db:
+                filas = []
+                for username, role, content, creado in lote:
+                    ids = await self._ids_conversacion(db, username)
+                    if ids is None:
+                        continue
+                    user_id, conversation_id = ids
+                    filas.append({"conversation_id": conversation_id, "user_id": user_id,
+                                  "role": role, "content": content, "created_at": creado})
+                await crud.add_messages(db, filas)
+                await db.commit()
+            self.escritos += len(filas)
+            self.lotes += 1
+        except Exception as e:
+            # El historial persistido es un extra: un fallo no debe tumbar el chat.
+            self.errores += 1
+            self._conversaciones.clear()  # Puede que alguna conversación recién creada no llegara a guardarse
+            log_evento("historial.error_escritura", logging.WARNING, mensajes=len(lote), error=str(e))
+
+    async def _ids_conversacion(self, db, username: str) -> Optional[tuple[int, int]]:
+        if username not in self._conversaciones:
+            user_id = await crud.get_user_id(db, username)
+            if user_id is None:
+                return None
+            conversacion = await crud.get_or_create_conversation(db, user_id)
+            self._conversaciones[username] = (user_id, conversacion.id)
+        return self._conversaciones[username]
+
+    def stats(self) -> dict:
+        return {
+            "en_cola": self._cola.qsize() if self._cola is not None else 0,
+            "escritos": self.escritos,
+            "lotes": self.lotes,
+            "descartados": self.descartados,
+            "errores": self.errores,
+        }
+
+
+history_writer = HistoryWriter()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, String, Text, UniqueConstraint, func
 from .database import Base
 
 class User(Base):
@@ -7,3 +7,35 @@ class User(Base):
     id = Column(Integer, primary_key=True, index=True)
     username = Column(String, unique=True, index=True)
     hashed_password = Column(String)
+
+class Conversation(Base):
+    __tablename__ = "conversations"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    __table_args__ = (Index("ix_conversations_user_created", "user_id", "created_at"),)
+
+class Message(Base):
+    __tablename__ = "messages"
+
+    id = Column(Integer, primary_key=True)
+    conversation_id = Column(Integer, ForeignKey("conversations.id", ondelete="CASCADE"), nullable=False)
+    # Denormalizado: leer el historial de un usuario no necesita un JOIN
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    role = Column(String(16), nullable=False)  # "human" | "ai"
+    content = Column(Text, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    __table_args__ = (Index("ix_messages_user_created", "user_id", "created_at"),)
+
+class PolizaUsuario(Base):
+    """Pólizas que el usuario marcó como suyas ("mis pólizas"): acotan sus búsquedas."""
+    __tablename__ = "user_policies"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    poliza = Column(String(32), nullable=False)  # Código del depósito, p. ej. "POL320190074"
+
+    __table_args__ = (UniqueConstraint("user_id", "poliza", name="uq_user_policies_user_poliza"),)
@@ -0,0 +1,237 @@
+import os
+import time
+import asyncio
+import threading
+from collections import deque
+
+import numpy as np
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+
+from .config import (
+    EMBEDDING_MODEL_DIR,
+    EMBEDDING_QUANTIZED,
+    EMBEDDING_MAX_LENGTH,
+    EMBEDDING_THREADS,
+    EMBEDDING_BATCH_WINDOW_MS,
+    EMBEDDING_MAX_BATCH,
+)
+from .executors import run_blocking
+from .observability import log_evento, percentil
+
+# =========================================================================
+# Motor de embeddings local: all-MiniLM-L6-v2 (el modelo por defecto de
+# ChromaDB) ejecutado con onnxruntime en CPU, opcionalmente cuantizado a int8.
+# Lo usan tanto las consultas del backend como la ingesta masiva, así los
+# vectores del índice y los de las preguntas salen del mismo modelo.
+# =========================================================================
+
+
+class EstadisticasEmbedding:
+    """Throughput de las pasadas del modelo y latencia de las peticiones."""
+
+    def __init__(self, ventana: int = 1000):
+        self.vectores = 0
+        self.pasadas = 0
+        self.segundos_modelo = 0.0
+        self.latencias_ms: deque = deque(maxlen=ventana)
+        self._lock = threading.Lock()
+
+    def registrar_pasada(self, n_vectores: int, segundos: float) -> None:
+        with self._lock:
+            self.vectores += n_vectores
+            self.pasadas += 1
+            self.segundos_modelo += segundos
+
+    def registrar_latencia(self, segundos: float) -> None:
+        with self._lock:
+            self.latencias_ms.append(segundos * 1000)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            latencias = sorted(self.latencias_ms)
+            return {
+                "vectores": self.vectores,
+                "pasadas_modelo": self.pasadas,
+                "vectores_por_pasada": round(self.vectores / self.pasadas, 2) if self.pasadas else 0.0,
+                "vectores_por_segundo": round(self.vectores / self.segundos_modelo, 1) if self.segundos_modelo else 0.0,
+                "latencia_p50_ms": percentil(latencias, 0.50),
+                "latencia_p95_ms": percentil(latencias, 0.95),
+            }
+
+
+class OnnxEmbeddingModel:
+    """
+    Tokenizador (`tokenizers`) + sesión de onnxruntime con mean pooling y
+    normalización L2, igual que `ONNXMiniLM_L6_V2` de ChromaDB. La carga es
+    perezosa y segura entre hilos.
+    """
+
+    def __init__(self, model_dir: str = EMBEDDING_MODEL_DIR, quantized: bool = EMBEDDING_QUANTIZED,
+                 max_length: int = EMBEDDING_MAX_LENGTH, threads: int = EMBEDDING_THREADS):
+        self.model_dir = model_dir
+        self.quantized = quantized
+        self.max_length = max_length
+        self.threads = threads
+        self.stats = EstadisticasEmbedding()
+        self._session = None
+        self._tokenizer = None
+        self._entradas = set()
+        self._lock = threading.Lock()
+
+    def cargar(self) -> None:
+        if self._session is not None:
+            return
+        with self._lock:
+            if self._session is not None:
+                return
+            import onnxruntime as ort
+            from tokenizers import Tokenizer
+
+            directorio = self.model_dir or _directorio_modelo_chroma()
+            ruta_modelo = os.path.join(directorio, "model.onnx")
+            if self.quantized:
+                ruta_modelo = _cuantizar(ruta_modelo)
+
+            tokenizer = Tokenizer.from_file(os.path.join(directorio, "tokenizer.json"))
+            tokenizer.enable_truncation(max_length=self.max_length)
+            tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+
+            opciones = ort.SessionOptions()
+            if self.threads:
+                opciones.intra_op_num_threads = self.threads
+            session = ort.InferenceSession(ruta_modelo, opciones, providers=["CPUExecutionProvider"])
+            self._entradas = {entrada.name for entrada in session.get_inputs()}
+            self._tokenizer = tokenizer
+            self._session = session
+            log_evento("embeddings.modelo_cargado", muestrear=False, modelo=ruta_modelo)
+
+    def encode(self, textos: list[str], batch_size: int = EMBEDDING_MAX_BATCH) -> np.ndarray:
+        self.cargar()
+        resultados = []
+        for inicio in range(0, len(textos), batch_size):
+            lote = textos[inicio:inicio + batch_size]
+            t0 = time.perf_counter()
+            resultados.append(self._pasada(lote))
+            self.stats.registrar_pasada(len(lote), time.perf_counter() - t0)
+        if not resultados:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.concatenate(resultados)
+
+    def _pasada(self, lote: list[str]) -> np.ndarray:
+        codificados = self._tokenizer.encode_batch(lote)
+        input_ids = np.array([c.ids for c in codificados], dtype=np.int64)
+        mascara = np.array([c.attention_mask for c in codificados], dtype=np.int64)
+        entradas = {
+            "input_ids": input_ids,
+            "attention_mask": mascara,
+            "token_type_ids": np.zeros_like(input_ids),
+        }
+        salida = self._session.run(None, {k: v for k, v in entradas.items() if k in self._entradas})[0]
+        # Mean pooling sobre los tokens reales y normalización L2
+        peso = mascara[..., None].astype(np.float32)
+        vectores = (salida * peso).sum(axis=1) / np.clip(peso.sum(axis=1), 1e-9, None)
+        vectores /= np.clip(np.linalg.norm(vectores, axis=1, keepdims=True), 1e-12, None)
+        return vectores.astype(np.float32)
+
+
+def _directorio_modelo_chroma() -> str:
+    """Descarga (si hace falta) el all-MiniLM-L6-v2 de ChromaDB y devuelve su carpeta."""
+    from chromadb.utils.embedding_functions import ONNXMiniLM_L6_V2
+
+    modelo = ONNXMiniLM_L6_V2()
+    modelo(["calentamiento"])  # fuerza la descarga y extracción del modelo
+    return os.path.join(str(modelo.DOWNLOAD_PATH), modelo.EXTRACTED_FOLDER_NAME)
+
+
+def _cuantizar(ruta_modelo: str) -> str:
+    """Genera (una sola vez) la versión int8 del modelo con cuantización dinámica."""
+    ruta_int8 = ruta_modelo.replace(".onnx", ".int8.onnx")
+    if not os.path.exists(ruta_int8):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        log_evento("embeddings.cuantizando", muestrear=False, modelo=ruta_modelo)
+        quantize_dynamic(ruta_modelo, ruta_int8, weight_type=QuantType.QInt8)
+    return ruta_int8
+
+
+class DynamicBatcher:
+    """
+    Agrupa las peticiones de embedding concurrentes (p. ej. de chats distintos)
+    que llegan dentro de `ventana_ms` en una sola pasada del modelo, hasta
+    `max_batch` textos. La pasada corre en el pool acotado de `executors`.
+    """
+
+    def __init__(self, modelo: OnnxEmbeddingModel, ventana_ms: float = EMBEDDING_BATCH_WINDOW_MS,
+                 max_batch: int = EMBEDDING_MAX_BATCH):
+        self.modelo = modelo
+        self.ventana = ventana_ms / 1000
+        self.max_batch = max_batch
+        self._cola = None
+        self._worker = None
+
+    async def embed(self, textos: list[str]) -> np.ndarray:
+        if self._worker is None or self._worker.done():
+            self._cola = asyncio.Queue()
+            self._worker = asyncio.create_task(self._bucle())
+        futuro = asyncio.get_running_loop().create_future()
+        t0 = time.perf_counter()
+        await self._cola.put((textos, futuro))
+        vectores = await futuro
+        self.modelo.stats.registrar_latencia(time.perf_counter() - t0)
+        return vectores
+
+    async def _bucle(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            lote = [await self._cola.get()]
+            total = len(lote[0][0])
+            limite = loop.time() + self.ventana
+            while total < self.max_batch:
+                restante = limite - loop.time()
+                if restante <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._cola.get(), restante)
+                except asyncio.TimeoutError:
+                    break
+                lote.append(item)
+                total += len(item[0])
+
+            textos = [t for peticion, _ in lote for t in peticion]
+            try:
+                vectores = await run_blocking(self.modelo.encode, textos, max(self.max_batch, len(textos)))
+            except Exception as e:
+                for _, futuro in lote:
+                    if not futuro.done():
+                        futuro.set_exception(e)
+                continue
+            inicio = 0
+            for peticion, futuro in lote:
+                if not futuro.done():
+                    futuro.set_result(vectores[inicio:inicio + len(peticion)])
+                inicio += len(peticion)
+
+
+class LocalEmbeddingFunction(EmbeddingFunction[Documents]):
+    """Función de embedding compatible con ChromaDB que usa el motor local (síncrona)."""
+
+    def __init__(self, modelo: "OnnxEmbeddingModel | None" = None, batch_size: int = EMBEDDING_MAX_BATCH):
+        self.modelo = modelo or modelo_embeddings
+        self.batch_size = batch_size
+
+    def __call__(self, input: Documents) -> Embeddings:
+        return [v for v in self.modelo.encode(list(input), self.batch_size)]
+
+
+# Instancias compartidas por todo el proceso
+modelo_embeddings = OnnxEmbeddingModel()
+batcher_embeddings = DynamicBatcher(modelo_embeddings)
+
+
+def obtener_funcion_embedding() -> LocalEmbeddingFunction:
+    return LocalEmbeddingFunction(modelo_embeddings)
+
+
+async def embed_textos(textos: list[str]) -> list[list[float]]:
+    """Embeddings de consultas, agrupados dinámicamente con las de otros chats."""
+    return [list(map(float, v)) for v in await batcher_embeddings.embed(textos)]
@@ -0,0 +1,16 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from .config import TOOLS_MAX_WORKERS
+
+# Pool de hilos compartido y acotado para todo lo que sigue siendo bloqueante.
+# Usar un pool propio (y no el executor por defecto del loop) evita que una
+# herramienta lenta deje sin hilos al resto de la aplicación.
+pool_bloqueante = ThreadPoolExecutor(max_workers=TOOLS_MAX_WORKERS, thread_name_prefix="tools")
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Ejecuta `func(*args, **kwargs)` en el pool acotado sin bloquear el event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(pool_bloqueante, functools.partial(func, *args, **kwargs))
@@ -0,0 +1,294 @@
+import os
+import gzip
+import json
+import math
+import time
+import threading
+from collections import Counter
+from typing import Optional
+
+import numpy as np
+
+from .answer_cache import normalizar_pregunta
+from .config import FILTER_MASK_CACHE_MAX_ENTRIES
+from .executors import run_blocking
+from .observability import log_evento
+from .retrieval_cache import LRUCache
+
+# =========================================================================
+# Búsqueda léxica BM25 + fusión con la búsqueda vectorial (RRF) + rerank.
+#
+# Los embeddings fallan con lo que es "exacto": números de artículo, códigos
+# de póliza como POL320180100 o términos legales. Un índice invertido BM25
+# sobre los mismos chunks los encuentra sin problema, y la fusión RRF combina
+# ambos rankings sin tener que calibrar sus puntuaciones.
+# =========================================================================
+
+_STOPWORDS = {
+    "de", "la", "el", "en", "y", "a", "los", "las", "del", "se", "que", "por", "un", "una",
+    "con", "no", "su", "al", "lo", "o", "para", "es", "como", "sus", "le", "ya", "este",
+    "esta", "si", "me", "mi", "sobre", "entre", "cual", "son", "ser", "hay",
+}
+
+
+def tokenizar(texto: str) -> list[str]:
+    """Normaliza (sin tildes ni puntuación) y descarta stopwords. Conserva números y códigos."""
+    return [t for t in normalizar_pregunta(texto).split() if t not in _STOPWORDS]
+
+
+class BM25Index:
+    """
+    Índice invertido BM25 en memoria.
+
+    Para cada término guarda una lista de postings (índice de documento, tf) en
+    arrays de NumPy contiguos, con offsets por término. Se persiste en dos
+    ficheros: `postings.npz` (arrays comprimidos) y `docs.json.gz` (ids,
+    textos, metadatos y vocabulario). Cada uno se reemplaza de forma atómica,
+    `docs.json.gz` el último, y ambos llevan la misma `generacion`: al cargar
+    se descarta una pareja de escrituras distintas.
+    """
+
+    def __init__(self, ids: list[str], textos: list[str], metadatas: list[dict],
+                 vocabulario: dict[str, int], offsets: np.ndarray, doc_idx: np.ndarray,
+                 tfs: np.ndarray, longitudes: np.ndarray, k1: float = 1.5, b: float = 0.75):
+        self.ids = ids
+        self.textos = textos
+        self.metadatas = metadatas
+        self.vocabulario = vocabulario
+        self.offsets = offsets
+        self.doc_idx = doc_idx
+        self.tfs = tfs
+        self.longitudes = longitudes
+        self.k1 = k1
+        self.b = b
+        self.longitud_media = float(longitudes.mean()) if len(longitudes) else 0.0
+        self.mascaras = MascarasFiltro(metadatas)  # filtro `where` -> documentos que lo cumplen
+
+    @classmethod
+    def construir(cls, ids: list[str], textos: list[str], metadatas: list[dict]) -> "BM25Index":
+        postings: dict[str, list[tuple[int, int]]] = {}
+        longitudes = np.zeros(len(textos), dtype=np.int32)
+        for i, texto in enumerate(textos):
+            tokens = tokenizar(texto)
+            longitudes[i] = len(tokens)
+            for termino, tf in Counter(tokens).items():
+                postings.setdefault(termino, []).append((i, tf))
+
+        terminos = sorted(postings)
+        vocabulario = {t: n for n, t in enumerate(terminos)}
+        offsets = np.zeros(len(terminos) + 1, dtype=np.int64)
+        for n, t in enumerate(terminos):
+            offsets[n + 1] = offsets[n] + len(postings[t])
+        doc_idx = np.empty(offsets[-1], dtype=np.int32)
+        tfs = np.empty(offsets[-1], dtype=np.int32)
+        for n, t in enumerate(terminos):
+            pares = np.asarray(postings[t], dtype=np.int32)
+            doc_idx[offsets[n]:offsets[n + 1]] = pares[:, 0]
+            tfs[offsets[n]:offsets[n + 1]] = pares[:, 1]
+        return cls(ids, textos, metadatas, vocabulario, offsets, doc_idx, tfs, longitudes)
+
+    def buscar(self, query: str, k: int = 10, where: Optional[dict] = None) -> list[int]:
+        """Índices de los `k` documentos con mayor puntuación BM25 (que cumplan `where`)."""
+        n_docs = len(self.ids)
+        if not n_docs:
+            return []
+        puntuaciones = np.zeros(n_docs, dtype=np.float32)
+        normalizador = self.k1 * (1 - self.b + self.b * self.longitudes / max(self.longitud_media, 1e-9))
+        for termino in set(tokenizar(query)):
+            n = self.vocabulario.get(termino)
+            if n is None:
+                continue
+            docs = self.doc_idx[self.offsets[n]:self.offsets[n + 1]]
+            tf = self.tfs[self.offsets[n]:self.offsets[n + 1]].astype(np.float32)
+            idf = math.log(1 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            puntuaciones[docs] += idf * tf * (self.k1 + 1) / (tf + normalizador[docs])
+
+        candidatos = np.flatnonzero(puntuaciones)
+        if where:
+            candidatos = candidatos[self.mascaras.mascara(where)[candidatos]]
+        if not len(candidatos):
+            return []
+        orden = candidatos[np.argsort(-puntuaciones[candidatos], kind="stable")]
+        return [int(i) for i in orden[:k]]
+
+    def guardar(self, directorio: str) -> None:
+        os.makedirs(directorio, exist_ok=True)
+        generacion = time.time_ns()
+        ruta_postings = os.path.join(directorio, "postings.npz")
+        np.savez_compressed(
+            ruta_postings + ".tmp.npz", generacion=np.int64(generacion),
+            offsets=self.offsets, doc_idx=self.doc_idx, tfs=self.tfs, longitudes=self.longitudes,
+        )
+        os.replace(ruta_postings + ".tmp.npz", ruta_postings)
+        # El último: su fecha de modificación es la que vigila `BM25Cargador`
+        ruta_docs = os.path.join(directorio, "docs.json.gz")
+        terminos = sorted(self.vocabulario, key=self.vocabulario.get)
+        with gzip.open(ruta_docs + ".tmp", "wt", encoding="utf-8") as f:
+            json.dump({"ids": self.ids, "textos": self.textos, "metadatas": self.metadatas,
+                       "terminos": terminos, "generacion": generacion}, f, ensure_ascii=False)
+        os.replace(ruta_docs + ".tmp", ruta_docs)
+
+    @classmethod
+    def cargar(cls, directorio: str, intentos: int = 3) -> "BM25Index":
+        for intento in range(intentos):
+            with np.load(os.path.join(directorio, "postings.npz")) as npz:
+                arrays = {nombre: npz[nombre] for nombre in npz.files}
+            with gzip.open(os.path.join(directorio, "docs.json.gz"), "rt", encoding="utf-8") as f:
+                docs = json.load(f)
+            generacion = int(arrays["generacion"]) if "generacion" in arrays else None
+            if generacion == docs.get("generacion"):
+                break
+            # Una ingesta reemplazó los ficheros entre las dos lecturas: se vuelve a leer
+            time.sleep(0.05 * (intento + 1))
+        else:
+            raise ValueError(f"El índice BM25 de {directorio} está a medio escribir")
+        vocabulario = {t: n for n, t in enumerate(docs["terminos"])}
+        return cls(docs["ids"], docs["textos"], docs["metadatas"], vocabulario,
+                   arrays["offsets"], arrays["doc_idx"], arrays["tfs"], arrays["longitudes"])
+
+
+class BM25Cargador:
+    """
+    Mantiene el índice BM25 del disco en memoria y lo recarga cuando la
+    ingesta lo reescribe (cambia la fecha de modificación). Si no existe,
+    devuelve None y la recuperación sigue siendo solo vectorial.
+    """
+
+    def __init__(self, directorio: str):
+        self.directorio = directorio
+        self._indice: Optional[BM25Index] = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def obtener(self) -> Optional[BM25Index]:
+        ruta = os.path.join(self.directorio, "docs.json.gz")
+        try:
+            mtime = os.path.getmtime(ruta)
+        except OSError:
+            return None
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    self._indice = BM25Index.cargar(self.directorio)
+                    self._mtime = mtime
+                    log_evento("bm25.indice_cargado", muestrear=False, chunks=len(self._indice.ids))
+        return self._indice
+
+    async def aobtener(self) -> Optional[BM25Index]:
+        """`obtener` desde el event loop: la (re)carga, que lee y descomprime el índice, va al pool."""
+        try:
+            mtime = os.path.getmtime(os.path.join(self.directorio, "docs.json.gz"))
+        except OSError:
+            return None
+        if mtime == self._mtime:
+            return self._indice
+        return await run_blocking(self.obtener)
+
+
+def fusion_rrf(rankings: list[list[str]], k: int = 60) -> list[str]:
+    """Reciprocal Rank Fusion: puntuación = Σ 1 / (k + posición) en cada ranking."""
+    puntuaciones: dict[str, float] = {}
+    for ranking in rankings:
+        for posicion, id_ in enumerate(ranking):
+            puntuaciones[id_] = puntuaciones.get(id_, 0.0) + 1.0 / (k + posicion + 1)
+    return sorted(puntuaciones, key=puntuaciones.get, reverse=True)
+
+
+class CrossEncoderReranker:
+    """Re-ordena (query, chunk) con un cross-encoder de sentence-transformers en CPU."""
+
+    def __init__(self, modelo: str):
+        self.nombre_modelo = modelo
+        self._modelo = None
+        self._lock = threading.Lock()
+
+    def puntuar(self, query: str, textos: list[str]) -> list[float]:
+        if self._modelo is None:
+            with self._lock:
+                if self._modelo is None:
+                    from sentence_transformers import CrossEncoder
+                    self._modelo = CrossEncoder(self.nombre_modelo, device="cpu")
+        return [float(p) for p in self._modelo.predict([(query, t) for t in textos])]
+
+
+def cumple_filtro(metadata: dict, where: dict) -> bool:
+    """Evalúa en Python el subconjunto de filtros `where` de ChromaDB que usamos."""
+    for clave, condicion in where.items():
+        if clave == "$and":
+            if not all(cumple_filtro(metadata, c) for c in condicion):
+                return False
+        elif clave == "$or":
+            if not any(cumple_filtro(metadata, c) for c in condicion):
+                return False
+        elif isinstance(condicion, dict):
+            valor = metadata.get(clave)
+            for operador, esperado in condicion.items():
+                if operador == "$eq" and valor != esperado:
+                    return False
+                if operador == "$ne" and valor == esperado:
+                    return False
+                if operador == "$in" and valor not in esperado:
+                    return False
+                if operador == "$nin" and valor in esperado:
+                    return False
+        elif metadata.get(clave) != condicion:
+            return False
+    return True
+
+
+def polizas_del_filtro(where: dict) -> Optional[list[str]]:
+    """Pólizas de un filtro que solo restringe `poliza` ({"poliza": X}, $eq o $in); si no, None."""
+    if set(where) != {"poliza"}:
+        return None
+    condicion = where["poliza"]
+    if isinstance(condicion, str):
+        return [condicion]
+    if isinstance(condicion, dict) and len(condicion) == 1:
+        if "$eq" in condicion:
+            return [condicion["$eq"]]
+        if "$in" in condicion:
+            return list(condicion["$in"])
+    return None
+
+
+class MascarasFiltro:
+    """
+    Qué filas de un índice cumplen un filtro `where`. Las filas de cada póliza
+    se agrupan al construirlo, así que un filtro de pólizas (el del alcance
+    del turno, con cualquier combinación de "mis pólizas") se resuelve con
+    ellas sin guardar nada; el resto de filtros se evalúan fila a fila y se
+    guardan en una LRU acotada. Se usa desde el pool de hilos: lleva lock.
+    """
+
+    def __init__(self, metadatas: list[dict], max_entries: int = FILTER_MASK_CACHE_MAX_ENTRIES):
+        self.metadatas = metadatas
+        filas: dict[str, list[int]] = {}
+        for fila, metadata in enumerate(metadatas):
+            poliza = (metadata or {}).get("poliza")
+            if poliza:
+                filas.setdefault(poliza, []).append(fila)
+        self.filas_por_poliza = {p: np.asarray(f, dtype=np.int64) for p, f in filas.items()}
+        self._cache = LRUCache(max_entries)
+        self._lock = threading.Lock()
+
+    def filas_de_polizas(self, polizas: list[str]) -> np.ndarray:
+        """Filas (ordenadas) de las pólizas dadas."""
+        partes = [self.filas_por_poliza[p] for p in dict.fromkeys(polizas) if p in self.filas_por_poliza]
+        if not partes:
+            return np.zeros(0, dtype=np.int64)
+        return np.sort(np.concatenate(partes)) if len(partes) > 1 else partes[0]
+
+    def mascara(self, where: dict) -> np.ndarray:
+        polizas = polizas_del_filtro(where)
+        if polizas is not None:
+            mascara = np.zeros(len(self.metadatas), dtype=bool)
+            mascara[self.filas_de_polizas(polizas)] = True
+            return mascara
+        clave = json.dumps(where, sort_keys=True)
+        with self._lock:
+            mascara = self._cache.get(clave)
+        if mascara is None:
+            mascara = np.array([cumple_filtro(m or {}, where) for m in self.metadatas], dtype=bool)
+            with self._lock:
+                self._cache.put(clave, mascara)
+        return mascara
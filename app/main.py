@@ -1,25 +1,95 @@
-from fastapi import FastAPI, Request, Cookie, Depends, Response
-from fastapi.responses import HTMLResponse, StreamingResponse, RedirectResponse
+import time
+import asyncio
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Request, Cookie, Depends, Response, HTTPException
+from fastapi.responses import HTMLResponse, StreamingResponse, RedirectResponse, JSONResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Optional
 from datetime import timedelta
 import html
 
 
 # --- Importaciones locales (ahora correctas) ---
-from .db import models, crud
-from .db.database import SessionLocal, engine
-from .security import verify_password, create_access_token, ACCESS_TOKEN_EXPIRE_MINUTES
+from .db import crud
+from .db.database import SessionLocal, init_db, close_db
+from .db.history_writer import history_writer
+from .security import (
+    averify_password,
+    aget_password_hash,
+    create_access_token,
+    evict_access_token,
+    get_current_user,
+    get_optional_user,
+    ACCESS_TOKEN_EXPIRE_MINUTES,
+)
 
 
-from .chatbot_logic import get_agent_response
+from . import IMPORT_STARTED_AT
+from .admission import Rechazo, control_admision
+from .article_index import cargador_articulos, codigos_de_poliza, estadisticas_articulos
+from .chatbot_logic import (
+    PROMPT_SISTEMA_AGENTE,
+    get_agent_response,
+    inicializar_agente,
+    answer_cache,
+    memory_store,
+    recuperacion_anticipada,
+    retriever,
+    router,
+    vector_store,
+)
+from .config import ARTICLE_INDEX_ENABLED
+from .context import estadisticas_contexto
+from .embeddings import modelo_embeddings
+from .executors import run_blocking, pool_bloqueante
+from .news_search import buscador_noticias
+from .observability import PETICIONES_CHAT, registro_metricas, trazas
+from .policy_scope import alcance_polizas
+from .singleflight import vuelos_chat, vuelos_herramientas
+from .startup import EstadoArranque
+from .tokens import estimar_tokens
 
 # --- Inicialización ---
-models.Base.metadata.create_all(bind=engine)
-app = FastAPI(title="Insurance Chatbot API")
+# Nada pesado ocurre al importar: la base de datos, el agente, la base
+# vectorial y el modelo de embeddings se inicializan EN PARALELO en segundo
+# plano al arrancar. Mientras tanto la API ya responde (liveness) y
+# /api/health/ready indica cuándo está todo listo (readiness).
+estado_arranque = EstadoArranque()
+estado_arranque.import_segundos = time.perf_counter() - IMPORT_STARTED_AT
+
+
+def _componentes_de_arranque() -> dict:
+    componentes = {
+        "base_de_datos": init_db,
+        "agente": inicializar_agente,
+        "vector_store": vector_store.version,
+        "embeddings": lambda: run_blocking(modelo_embeddings.cargar),
+    }
+    if retriever.bm25 is not None:
+        componentes["bm25"] = lambda: run_blocking(retriever.bm25.obtener)
+    if ARTICLE_INDEX_ENABLED:
+        componentes["articulos"] = lambda: run_blocking(cargador_articulos.obtener)
+    return componentes
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    tarea = asyncio.create_task(estado_arranque.iniciar(_componentes_de_arranque()))
+    history_writer.iniciar()
+    yield
+    tarea.cancel()
+    await history_writer.detener()  # Guarda los mensajes que aún estén en cola
+    await close_db()
+    trazas.cerrar()  # Vuelca al fichero los spans pendientes
+    pool_bloqueante.shutdown(wait=False, cancel_futures=True)
+    buscador_noticias.cerrar()
+
+
+app = FastAPI(title="Insurance Chatbot API", lifespan=lifespan)
 
 
 # --- Montaje de Archivos Estáticos y Plantillas ---
@@ -32,12 +102,9 @@ templates = Jinja2Templates(directory="app/templates")
 
 
 # --- Dependencias ---
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 # --- Modelos Pydantic ---
 class ChatRequest(BaseModel):
@@ -45,44 +112,48 @@ class ChatRequest(BaseModel):
 class UserForm(BaseModel):
     username: str
     password: str
+class PolizasRequest(BaseModel):
+    polizas: list[str]
 
 # ===============================================================
 # === RUTAS DE AUTENTICACIÓN Y PÁGINAS (Definidas PRIMERO) ===
 # ===============================================================
 
 @app.get("/login", response_class=HTMLResponse)
-async def login_page(request: Request, access_token: Optional[str] = Cookie(None)):
-    # Si ya hay un token (el usuario ya ha iniciado sesión),
+async def login_page(request: Request, username: Optional[str] = Depends(get_optional_user)):
+    # Si ya hay un token válido (el usuario ya ha iniciado sesión),
     # lo redirigimos a la página principal.
-    if access_token:
+    if username:
         return RedirectResponse(url="/")
     
     # Si no, mostramos la página de login.
     return templates.TemplateResponse("login.html", {"request": request})
 
 @app.get("/register", response_class=HTMLResponse)
-async def register_page(request: Request, access_token: Optional[str] = Cookie(None)):
+async def register_page(request: Request, username: Optional[str] = Depends(get_optional_user)):
     # Hacemos la misma comprobación para la página de registro.
-    if access_token:
+    if username:
         return RedirectResponse(url="/")
 
     return templates.TemplateResponse("register.html", {"request": request})
 
 @app.post("/register")
-async def handle_register(form_data: UserForm, db: Session = Depends(get_db)):
-    user = crud.get_user_by_username(db, username=form_data.username)
+async def handle_register(form_data: UserForm, db: AsyncSession = Depends(get_db)):
+    user = await crud.get_user_by_username(db, username=form_data.username)
     if user:
         html_content = '<li class="error">El nombre de usuario ya existe.</li>'
         return HTMLResponse(content=html_content)
     
-    crud.create_user(db, username=form_data.username, password=form_data.password)
+    # bcrypt corre en su pool acotado: no bloquea el event loop
+    hashed_password = await aget_password_hash(form_data.password)
+    await crud.create_user(db, username=form_data.username, hashed_password=hashed_password)
     html_content = '<li class="success">¡Registro exitoso! Ahora puedes <a href="/login">iniciar sesión</a>.</li>'
     return HTMLResponse(content=html_content)
 
 @app.post("/login")
-async def handle_login(form_data: UserForm, db: Session = Depends(get_db)):
-    user = crud.get_user_by_username(db, username=form_data.username)
-    if not user or not verify_password(form_data.password, user.hashed_password):
+async def handle_login(form_data: UserForm, db: AsyncSession = Depends(get_db)):
+    user = await crud.get_user_by_username(db, username=form_data.username)
+    if not user or not await averify_password(form_data.password, user.hashed_password):
         # Lógica de error (igual que en /register)
         html_content = '<li class="error">Nombre de usuario o contraseña incorrectos.</li>'
         return Response(content=html_content, media_type="text/html")
@@ -104,7 +175,8 @@ async def handle_login(form_data: UserForm, db: Session = Depends(get_db)):
     
     return response
 @app.get("/logout")
-async def logout():
+async def logout(access_token: Optional[str] = Cookie(None)):
+    evict_access_token(access_token)
     response = RedirectResponse(url="/login")
     response.delete_cookie(key="access_token")
     return response
@@ -113,27 +185,237 @@ async def logout():
 # === RUTAS PRINCIPALES DE LA APLICACIÓN (Protegidas) ===
 # ===============================================================
 
-async def stream_wrapper(question: str, session_id: str):
-    yield '<div class="message bot-message">'
-    async for token in get_agent_response(question, session_id):
-        yield html.escape(token)
-    yield '</div>'
+async def stream_wrapper(question: str, session_id: str, permiso=None):
+    try:
+        yield '<div class="message bot-message">'
+        async for evento in get_agent_response(question, session_id):
+            if evento.tipo == "estado":
+                yield f'<span class="status-message">{html.escape(evento.contenido)}</span>'
+            else:
+                yield html.escape(evento.contenido)
+        yield '</div>'
+    finally:
+        # La plaza se devuelve al acabar el stream (también si el cliente se desconecta)
+        if permiso is not None:
+            permiso.liberar()
+
+
+class StreamConPermiso(StreamingResponse):
+    """
+    Stream que devuelve la plaza de admisión pase lo que pase. El `finally` de
+    `stream_wrapper` no se ejecuta si el cliente se va antes de que empiece el
+    cuerpo o si falla el envío de las cabeceras; aquí sí.
+    """
+
+    def __init__(self, contenido, permiso, **kwargs):
+        super().__init__(contenido, **kwargs)
+        self.permiso = permiso
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.permiso.liberar()
 
 @app.get("/", response_class=HTMLResponse)
-async def root(request: Request, access_token: Optional[str] = Cookie(None)):
-    if not access_token:
+async def root(request: Request, username: Optional[str] = Depends(get_optional_user)):
+    if not username:
         return RedirectResponse(url="/login")
-    # Aquí iría la lógica de validación del token
     return templates.TemplateResponse("index.html", {"request": request})
     
 @app.post("/api/chat")
-async def chat_endpoint(req: ChatRequest, access_token: Optional[str] = Cookie(None)):
-    if not access_token:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    # Aquí iría la lógica de validación del token
-    session_id = "user123" # Placeholder
-    return StreamingResponse(stream_wrapper(req.question, session_id), media_type="text/html")
+async def chat_endpoint(req: ChatRequest, username: str = Depends(get_current_user)):
+    # La memoria de la conversación es por usuario autenticado
+    session_id = username
+    try:
+        permiso = await control_admision.admitir(username)
+    except Rechazo as rechazo:
+        PETICIONES_CHAT.inc(result=f"rechazada_{rechazo.status}")
+        # Respuesta inmediata en lugar de un stream colgado (ver main.js para que htmx la muestre)
+        html_content = f'<div class="message bot-message busy-message">{html.escape(rechazo.motivo)} Inténtalo de nuevo en unos segundos.</div>'
+        return HTMLResponse(content=html_content, status_code=rechazo.status,
+                            headers={"Retry-After": str(rechazo.retry_after)})
+    # Si el cliente se desconecta, Starlette cancela el generador y con él al agente.
+    return StreamConPermiso(
+        stream_wrapper(req.question, session_id, permiso),
+        permiso,
+        media_type="text/html",
+        headers={"X-Accel-Buffering": "no"}, # Evita que un proxy (nginx) acumule la respuesta
+    )
+
+@app.get("/api/me/policies")
+async def get_my_policies(username: str = Depends(get_current_user)):
+    # Pólizas del usuario: acotan sus búsquedas cuando la conversación no cita ninguna
+    return {"polizas": list(await alcance_polizas.polizas_de_usuario(username))}
+
+@app.put("/api/me/policies")
+async def set_my_policies(req: PolizasRequest, username: str = Depends(get_current_user),
+                          db: AsyncSession = Depends(get_db)):
+    polizas = []
+    for texto in req.polizas:
+        codigos = codigos_de_poliza(texto)
+        if len(codigos) != 1:
+            raise HTTPException(status_code=400, detail=f"Código de póliza no válido: '{texto}' (p. ej. POL320190074)")
+        if codigos[0] not in polizas:
+            polizas.append(codigos[0])
+    user_id = await crud.get_user_id(db, username)
+    await crud.set_user_policies(db, user_id, polizas)
+    alcance_polizas.actualizar(username, polizas)
+    return {"polizas": polizas}
 
 @app.get("/api/health")
 def health_check():
-    return {"status": "ok", "message": "API is running!"}
+    return {"status": "ok", "message": "API is running!", "ready": estado_arranque.listo}
+
+@app.get("/api/health/live")
+def liveness():
+    # El proceso está vivo y atiende peticiones (no comprueba dependencias)
+    return {"status": "ok"}
+
+@app.get("/api/health/ready")
+def readiness():
+    # Listo para recibir tráfico: todos los componentes se inicializaron bien
+    codigo = 200 if estado_arranque.listo else 503
+    return JSONResponse(status_code=codigo, content=estado_arranque.as_dict())
+
+@app.get("/api/cache/stats")
+def cache_stats():
+    # Aciertos/fallos de las cachés de respuestas y de recuperación
+    return {
+        "answer_cache": answer_cache.stats_dict(),
+        "retrieval_cache": retriever.cache.stats(),
+    }
+
+@app.get("/api/retrieval/stats")
+def retrieval_stats():
+    # Latencia por etapa de la recuperación (embedding, vectorial, bm25, fusion, rerank)
+    return retriever.latencias.as_dict()
+
+@app.get("/api/memory/stats")
+def memory_stats(username: str = Depends(get_current_user)):
+    # Tokens de historial/prompt por turno (global y del último turno de este usuario) y resúmenes
+    return {**memory_store.stats(), "ultimo_turno": memory_store.ultimo_turno(username)}
+
+@app.get("/api/admission/stats")
+def admission_stats():
+    # Peticiones admitidas/rechazadas por motivo, ejecuciones en vuelo y en cola
+    return control_admision.stats_dict()
+
+@app.get("/api/router/stats")
+def router_stats():
+    # Intenciones decididas (y cómo), y atajos que acabaron recurriendo al agente
+    return router.stats.as_dict()
+
+@app.get("/api/prefetch/stats")
+def prefetch_stats():
+    # Búsquedas adelantadas: usadas por ConsultaPDF, desperdiciadas (y canceladas) y latencia ocultada
+    return recuperacion_anticipada.stats.as_dict()
+
+@app.get("/api/singleflight/stats")
+def singleflight_stats():
+    # Cálculos lanzados y peticiones agrupadas en uno en curso: respuestas del chat y llamadas a herramientas
+    return {"chat": vuelos_chat.stats_dict(), "herramientas": vuelos_herramientas.stats_dict()}
+
+@app.get("/api/scope/stats")
+def scope_stats():
+    # Turnos acotados por póliza según el origen del alcance, y búsquedas acotadas que no encontraron nada
+    return alcance_polizas.stats.as_dict()
+
+@app.get("/api/news/stats")
+def news_stats():
+    # Búsquedas de noticias: caché, timeouts, errores, estado del circuit breaker
+    return buscador_noticias.stats_dict()
+
+@app.get("/api/context/stats")
+def context_stats():
+    # Tokens de los fragmentos recuperados antes y después de compactarlos, y
+    # tamaño del prompt de sistema que acompaña a cada llamada del agente
+    return {
+        **estadisticas_contexto.as_dict(),
+        "tokens_prompt_sistema_agente": estimar_tokens(PROMPT_SISTEMA_AGENTE),
+    }
+
+@app.get("/api/articles/stats")
+def articles_stats():
+    # Consultas resueltas con el índice de artículos (por cita o por pasaje) y tamaño del índice
+    indice = cargador_articulos.obtener()
+    return {
+        **estadisticas_articulos.as_dict(),
+        "polizas": len(indice.polizas) if indice else 0,
+        "articulos": len(indice.articulos) if indice else 0,
+    }
+
+@app.get("/api/history/stats")
+def history_stats():
+    # Cola de escritura diferida del historial (mensajes en cola, lotes, descartes)
+    return history_writer.stats()
+
+# --- Métricas de Prometheus ---
+# Los contadores que ya llevan las cachés, la admisión y el historial se leen
+# en cada scrape; las etapas, tokens y errores los registra `app/observability.py`.
+registro_metricas.calculada(
+    "chatbot_cache_events_total", "Aciertos y fallos de las cachés.", "counter", ("cache", "result"),
+    lambda: {
+        ("respuestas", "acierto_exacto"): answer_cache.stats.exact_hits,
+        ("respuestas", "acierto_semantico"): answer_cache.stats.semantic_hits,
+        ("respuestas", "fallo"): answer_cache.stats.misses,
+        ("respuestas", "descarte_terminos"): answer_cache.stats.descartes_terminos,
+        ("embeddings", "acierto"): retriever.cache.embeddings.hits,
+        ("embeddings", "fallo"): retriever.cache.embeddings.misses,
+        ("recuperacion", "acierto"): retriever.cache.resultados.hits,
+        ("recuperacion", "fallo"): retriever.cache.resultados.misses,
+    },
+)
+registro_metricas.calculada(
+    "chatbot_admission_total", "Decisiones del control de admisión de /api/chat.", "counter", ("result",),
+    lambda: {(motivo,): valor for motivo, valor in control_admision.stats.as_dict().items()},
+)
+registro_metricas.calculada(
+    "chatbot_agent_runs", "Ejecuciones del agente en vuelo y en cola en este worker.", "gauge", ("state",),
+    lambda: {(estado,): control_admision.stats_dict()[estado] for estado in ("en_vuelo", "esperando")},
+)
+registro_metricas.calculada(
+    "chatbot_history_messages_total", "Mensajes del historial guardados o descartados (cola llena).",
+    "counter", ("result",),
+    lambda: {(clave,): history_writer.stats()[clave] for clave in ("escritos", "descartados")},
+)
+
+registro_metricas.calculada(
+    "chatbot_router_decisions_total", "Preguntas por intención decidida en el router.", "counter", ("intent",),
+    lambda: {(intencion,): n for intencion, n in router.stats.por_intencion.items()},
+)
+
+registro_metricas.calculada(
+    "chatbot_news_search_total", "Búsquedas de noticias por resultado.", "counter", ("result",),
+    lambda: {(clave,): valor for clave, valor in buscador_noticias.stats.as_dict().items()},
+)
+
+registro_metricas.calculada(
+    "chatbot_prefetch_total", "Búsquedas adelantadas por resultado.", "counter", ("result",),
+    lambda: {(clave,): getattr(recuperacion_anticipada.stats, clave)
+             for clave in ("lanzados", "aciertos", "desperdiciados", "cancelados", "errores")},
+)
+
+registro_metricas.calculada(
+    "chatbot_policy_scope_total", "Turnos por origen del alcance de póliza.", "counter", ("origin",),
+    lambda: {**{(origen,): n for origen, n in alcance_polizas.stats.por_origen.items()},
+             ("ninguno",): alcance_polizas.stats.sin_alcance},
+)
+
+registro_metricas.calculada(
+    "chatbot_singleflight_total", "Cálculos lanzados y peticiones agrupadas por single-flight.", "counter",
+    ("kind", "result"),
+    lambda: {(tipo, clave): valor
+             for tipo, vuelos in (("chat", vuelos_chat), ("herramientas", vuelos_herramientas))
+             for clave, valor in vuelos.stats.as_dict().items()},
+)
+
+@app.get("/metrics")
+def metrics():
+    # Formato de texto de Prometheus (version 0.0.4)
+    return PlainTextResponse(registro_metricas.exponer(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/api/embeddings/stats")
+def embeddings_stats():
+    # Throughput (vectores/s) y latencia del motor de embeddings local
+    return modelo_embeddings.stats.as_dict()
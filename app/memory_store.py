@@ -0,0 +1,281 @@
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Optional
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+
+from .config import (
+    SESSION_TTL_SECONDS,
+    SESSION_MAX_SESSIONS,
+    SESSION_MAX_MESSAGES,
+    MEMORY_TOKEN_BUDGET,
+    MEMORY_RECENT_TURNS,
+    MEMORY_SUMMARY_MAX_TOKENS,
+    MEMORY_SUMMARY_EVERY_TURNS,
+)
+from .observability import log_evento, percentil
+from .tokens import recortar_a_tokens, tokens_de_mensajes
+
+# (resumen anterior, mensajes a condensar) -> resumen nuevo
+Resumidor = Callable[[str, list[BaseMessage]], Awaitable[str]]
+
+
+class HistorialConResumen(BaseChatMessageHistory):
+    """
+    Historial de una sesión con presupuesto fijo de tokens.
+
+    - Los últimos `turnos_recientes` turnos (pregunta + respuesta) se guardan literales.
+    - Los anteriores se condensan en `resumen`, que calcula el LLM en una tarea
+      en segundo plano: la petición en curso nunca espera al resumen.
+    - `messages` (lo que recibe el prompt como `chat_history`) es el resumen +
+      los mensajes literales, recortado por turnos completos si aún así supera
+      `presupuesto_tokens` (p. ej. mientras el resumen se está calculando).
+
+    Solo hay un resumen en curso por sesión y se aplica de forma atómica: si el
+    historial cambió por debajo (se limpió o se rehidrató) el resultado se descarta.
+    """
+
+    def __init__(self, store: "SessionMemoryStore"):
+        self._store = store
+        self.resumen = ""
+        self._mensajes: list[BaseMessage] = []
+        self._lock = threading.Lock()
+        self._resumiendo = False
+        self.tokens_ultima_vista = 0
+
+    # --- Interfaz de BaseChatMessageHistory ---
+    @property
+    def messages(self) -> list[BaseMessage]:
+        with self._lock:
+            vista = self._vista()
+        self.tokens_ultima_vista = tokens_de_mensajes(vista)
+        return vista
+
+    @messages.setter
+    def messages(self, mensajes: list[BaseMessage]) -> None:
+        with self._lock:
+            self._mensajes = list(mensajes)
+            self.resumen = ""
+
+    async def aget_messages(self) -> list[BaseMessage]:
+        # Es memoria: no hace falta el salto al executor de la implementación base.
+        return self.messages
+
+    def add_messages(self, mensajes) -> None:
+        with self._lock:
+            self._mensajes.extend(mensajes)
+            exceso = len(self._mensajes) - self._store.max_messages
+            if exceso > 0:
+                # Tope de seguridad si el resumen no da abasto (p. ej. el LLM falla)
+                del self._mensajes[:exceso]
+        self._programar_resumen()
+
+    async def aadd_messages(self, mensajes) -> None:
+        self.add_messages(mensajes)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._mensajes = []
+            self.resumen = ""
+
+    # --- Resumen y presupuesto ---
+    def _prefijo_resumen(self) -> list[BaseMessage]:
+        if not self.resumen:
+            return []
+        # Como par pregunta/respuesta (y no como SystemMessage) para que Gemini
+        # reciba turnos alternos y un único mensaje de sistema.
+        return [
+            HumanMessage(content=f"Resumen de nuestra conversación anterior: {self.resumen}"),
+            AIMessage(content="Entendido, lo tengo en cuenta."),
+        ]
+
+    def _vista(self) -> list[BaseMessage]:
+        prefijo = self._prefijo_resumen()
+        # Lo que aún no se ha resumido (más allá de los turnos recientes) también
+        # entra si cabe en el presupuesto; si no, se recorta por el principio.
+        literales = list(self._mensajes)
+        while len(literales) > 2 and tokens_de_mensajes(prefijo + literales) > self._store.presupuesto_tokens:
+            literales = literales[2:]  # Se descarta el turno completo más antiguo
+        return prefijo + literales
+
+    def _programar_resumen(self) -> None:
+        resumidor = self._store.resumidor
+        if resumidor is None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        with self._lock:
+            if self._resumiendo:
+                return
+            n_antiguos = max(0, len(self._mensajes) - 2 * self._store.turnos_recientes)
+            antiguos = self._mensajes[:n_antiguos]
+            desborda = tokens_de_mensajes(self._prefijo_resumen() + self._mensajes) > self._store.presupuesto_tokens
+            if not antiguos or (n_antiguos < 2 * self._store.resumir_cada_turnos and not desborda):
+                return
+            self._resumiendo = True
+            resumen_previo = self.resumen
+        # Contexto vacío: la tarea no hereda los callbacks de la petición que la
+        # lanzó, así que sus tokens no aparecen en el stream del usuario.
+        tarea = loop.create_task(self._resumir(resumidor, resumen_previo, antiguos),
+                                 context=contextvars.Context())
+        self._store._tareas.add(tarea)
+        tarea.add_done_callback(self._store._tareas.discard)
+
+    async def _resumir(self, resumidor: Resumidor, resumen_previo: str, antiguos: list[BaseMessage]) -> None:
+        t0 = time.perf_counter()
+        try:
+            nuevo = recortar_a_tokens((await resumidor(resumen_previo, antiguos)).strip(),
+                                      self._store.max_tokens_resumen)
+            with self._lock:
+                # Solo se añaden mensajes al final: si el prefijo sigue intacto, se sustituye.
+                if (self.resumen == resumen_previo and len(self._mensajes) >= len(antiguos)
+                        and all(a is b for a, b in zip(self._mensajes, antiguos))):
+                    self.resumen = nuevo
+                    del self._mensajes[:len(antiguos)]
+            self._store._registrar_resumen(time.perf_counter() - t0, ok=True)
+        except Exception as e:
+            self._store._registrar_resumen(time.perf_counter() - t0, ok=False)
+            log_evento("memoria.error_resumen", logging.WARNING, error=str(e))
+            return
+        finally:
+            with self._lock:
+                self._resumiendo = False
+        # Pudieron llegar más turnos mientras se resumía
+        self._programar_resumen()
+
+
+class SessionMemoryStore:
+    """
+    Almacén de historiales de conversación por `session_id`.
+
+    - LRU: cuando se supera `max_sessions` se descarta la sesión menos usada.
+    - TTL: una sesión sin actividad durante `ttl_seconds` se considera caducada.
+    - Presupuesto de tokens: cada historial es un `HistorialConResumen`.
+    - Tope de mensajes: red de seguridad si el resumen no consigue seguir el ritmo.
+
+    `resumidor` lo asigna la lógica del agente cuando el LLM está listo; hasta
+    entonces el historial solo se recorta por presupuesto.
+    """
+
+    def __init__(self, ttl_seconds: int = SESSION_TTL_SECONDS,
+                 max_sessions: int = SESSION_MAX_SESSIONS,
+                 max_messages: int = SESSION_MAX_MESSAGES,
+                 presupuesto_tokens: int = MEMORY_TOKEN_BUDGET,
+                 turnos_recientes: int = MEMORY_RECENT_TURNS,
+                 max_tokens_resumen: int = MEMORY_SUMMARY_MAX_TOKENS,
+                 resumir_cada_turnos: int = MEMORY_SUMMARY_EVERY_TURNS):
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self.max_messages = max_messages
+        self.presupuesto_tokens = presupuesto_tokens
+        self.turnos_recientes = turnos_recientes
+        self.max_tokens_resumen = max_tokens_resumen
+        self.resumir_cada_turnos = resumir_cada_turnos
+        self.resumidor: Optional[Resumidor] = None
+        self._sesiones: "OrderedDict[str, tuple[float, HistorialConResumen]]" = OrderedDict()
+        # El agente puede ejecutarse en hilos del executor, así que protegemos el diccionario.
+        self._lock = threading.Lock()
+        self._tareas: set[asyncio.Task] = set()
+        # Tokens por turno: historial enviado (estimado) y prompt total (si el LLM lo informa)
+        self._tokens_historial: deque = deque(maxlen=1000)
+        self._tokens_prompt: deque = deque(maxlen=1000)
+        self._ultimo_turno: "OrderedDict[str, dict]" = OrderedDict()
+        self.resumenes_ok = 0
+        self.resumenes_error = 0
+        self._segundos_resumen: deque = deque(maxlen=200)
+
+    def get_history(self, session_id: str) -> HistorialConResumen:
+        """Devuelve (o crea) el historial de la sesión y la marca como usada recientemente."""
+        ahora = time.monotonic()
+        with self._lock:
+            self._purgar_caducadas(ahora)
+            entrada = self._sesiones.pop(session_id, None)
+            historial = entrada[1] if entrada else HistorialConResumen(self)
+            self._sesiones[session_id] = (ahora, historial)
+            while len(self._sesiones) > self.max_sessions:
+                self._sesiones.popitem(last=False)
+            return historial
+
+    def contiene(self, session_id: str) -> bool:
+        """True si la sesión está en memoria y no ha caducado."""
+        with self._lock:
+            entrada = self._sesiones.get(session_id)
+            return entrada is not None and time.monotonic() - entrada[0] <= self.ttl_seconds
+
+    def hidratar(self, session_id: str, mensajes: list) -> None:
+        """
+        Carga en memoria el historial persistido de una sesión que no estaba
+        (p. ej. tras reiniciar el proceso). Si otra petición ya la creó, no se toca.
+        """
+        with self._lock:
+            if session_id in self._sesiones:
+                return
+            historial = HistorialConResumen(self)
+            historial.messages = mensajes[-self.max_messages:]
+            self._sesiones[session_id] = (time.monotonic(), historial)
+            while len(self._sesiones) > self.max_sessions:
+                self._sesiones.popitem(last=False)
+        # Lo rehidratado puede superar el presupuesto: se resume en segundo plano.
+        historial._programar_resumen()
+
+    def clear(self, session_id: str) -> None:
+        with self._lock:
+            self._sesiones.pop(session_id, None)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sesiones)
+
+    def _purgar_caducadas(self, ahora: float) -> None:
+        # El OrderedDict está ordenado por último uso: basta con mirar el principio.
+        while self._sesiones:
+            session_id, (ultimo_uso, _) = next(iter(self._sesiones.items()))
+            if ahora - ultimo_uso <= self.ttl_seconds:
+                break
+            del self._sesiones[session_id]
+
+    # --- Métricas de tokens ---
+    def registrar_turno(self, session_id: str, tokens_historial: int, tokens_prompt: Optional[int]) -> None:
+        with self._lock:
+            self._tokens_historial.append(tokens_historial)
+            if tokens_prompt:
+                self._tokens_prompt.append(tokens_prompt)
+            self._ultimo_turno.pop(session_id, None)
+            self._ultimo_turno[session_id] = {"tokens_historial": tokens_historial, "tokens_prompt": tokens_prompt}
+            while len(self._ultimo_turno) > self.max_sessions:
+                self._ultimo_turno.popitem(last=False)
+
+    def _registrar_resumen(self, segundos: float, ok: bool) -> None:
+        with self._lock:
+            if ok:
+                self.resumenes_ok += 1
+            else:
+                self.resumenes_error += 1
+            self._segundos_resumen.append(segundos * 1000)
+
+    def ultimo_turno(self, session_id: str) -> Optional[dict]:
+        with self._lock:
+            return self._ultimo_turno.get(session_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            historial = sorted(self._tokens_historial)
+            prompt = sorted(self._tokens_prompt)
+            resumen_ms = sorted(self._segundos_resumen)
+            return {
+                "sesiones": len(self._sesiones),
+                "presupuesto_tokens": self.presupuesto_tokens,
+                "tokens_historial": {"p50": percentil(historial, 0.50), "p95": percentil(historial, 0.95),
+                                     "max": historial[-1] if historial else 0},
+                "tokens_prompt": {"p50": percentil(prompt, 0.50), "p95": percentil(prompt, 0.95),
+                                  "max": prompt[-1] if prompt else 0},
+                "resumenes": {"ok": self.resumenes_ok, "errores": self.resumenes_error,
+                              "en_curso": len(self._tareas), "p50_ms": percentil(resumen_ms, 0.50)},
+            }
@@ -0,0 +1,259 @@
+import time
+import asyncio
+import logging
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+from .answer_cache import normalizar_pregunta
+from .config import (
+    NEWS_SEARCH_BACKEND,
+    NEWS_SEARCH_LOCAL_LATENCY_MS,
+    NEWS_SEARCH_TIMEOUT_SECONDS,
+    NEWS_SEARCH_MAX_WORKERS,
+    NEWS_SEARCH_CACHE_TTL_SECONDS,
+    NEWS_SEARCH_CACHE_MAX_ENTRIES,
+    NEWS_BREAKER_FAILURES,
+    NEWS_BREAKER_COOLDOWN_SECONDS,
+)
+from .observability import etapa, log_evento
+from .singleflight import vuelos_herramientas
+
+# =========================================================================
+# Búsqueda de noticias del sector para la herramienta `buscar_noticias_del_sector`
+# y la respuesta directa del router:
+#   - Un único cliente del buscador, reutilizado entre llamadas.
+#   - Pool de hilos propio y acotado (DuckDuckGo no tiene cliente asíncrono):
+#     una búsqueda colgada no deja sin hilos al resto de la app.
+#   - Plazo estricto por llamada y circuit breaker ante fallos seguidos.
+#   - Caché por consulta normalizada con TTL.
+# Nunca lanza: si no hay resultados a tiempo devuelve una respuesta degradada
+# (los últimos resultados conocidos de esa consulta, o un aviso).
+# =========================================================================
+
+
+class BackendNoticias(ABC):
+    """Buscador síncrono: `buscar(query)` devuelve el texto de los resultados."""
+
+    @abstractmethod
+    def buscar(self, query: str) -> str:
+        ...
+
+
+class DuckDuckGoBackend(BackendNoticias):
+    """DuckDuckGo a través de LangChain. El cliente se crea una vez, en la primera búsqueda."""
+
+    def __init__(self):
+        self._cliente = None
+        self._lock = threading.Lock()
+
+    def buscar(self, query: str) -> str:
+        if self._cliente is None:
+            with self._lock:
+                if self._cliente is None:
+                    from langchain_community.tools.ddg_search import DuckDuckGoSearchRun
+                    self._cliente = DuckDuckGoSearchRun()
+        return self._cliente.run(query)
+
+
+class BackendNoticiasLocal(BackendNoticias):
+    """Sustituto sin red para pruebas y benchmarks: resultado fijo con una latencia configurable."""
+
+    def __init__(self, latencia_ms: float = NEWS_SEARCH_LOCAL_LATENCY_MS):
+        self.latencia_ms = latencia_ms
+
+    def buscar(self, query: str) -> str:
+        if self.latencia_ms:
+            time.sleep(self.latencia_ms / 1000)
+        return (f"Resultados simulados sobre '{query}': el regulador publicó nuevas normas de "
+                "transparencia para seguros de salud y las aseguradoras anuncian coberturas digitales.")
+
+
+def crear_backend_noticias(nombre: str = NEWS_SEARCH_BACKEND) -> BackendNoticias:
+    if nombre == "duckduckgo":
+        return DuckDuckGoBackend()
+    if nombre == "local":
+        return BackendNoticiasLocal()
+    raise ValueError(f"NEWS_SEARCH_BACKEND desconocido: '{nombre}' (usa duckduckgo o local)")
+
+
+class CircuitBreaker:
+    """
+    Cerrado: se busca con normalidad. Tras `umbral_fallos` fallos seguidos se
+    abre y no se intenta nada durante `enfriamiento` segundos; después deja
+    pasar UNA búsqueda de prueba (semiabierto) que lo cierra o lo vuelve a abrir.
+    """
+
+    def __init__(self, umbral_fallos: int = NEWS_BREAKER_FAILURES,
+                 enfriamiento: float = NEWS_BREAKER_COOLDOWN_SECONDS):
+        self.umbral_fallos = umbral_fallos
+        self.enfriamiento = enfriamiento
+        self.fallos_seguidos = 0
+        self._abierto_hasta = 0.0
+        self._sonda_en_curso = False
+
+    @property
+    def estado(self) -> str:
+        if self.fallos_seguidos < self.umbral_fallos:
+            return "cerrado"
+        return "semiabierto" if time.monotonic() >= self._abierto_hasta else "abierto"
+
+    def permitir(self) -> bool:
+        estado = self.estado
+        if estado == "cerrado":
+            return True
+        if estado == "semiabierto" and not self._sonda_en_curso:
+            self._sonda_en_curso = True
+            return True
+        return False
+
+    def liberar_sonda(self) -> None:
+        self._sonda_en_curso = False
+
+    def registrar_exito(self) -> None:
+        self.fallos_seguidos = 0
+        self._sonda_en_curso = False
+
+    def registrar_fallo(self) -> None:
+        self.fallos_seguidos += 1
+        self._sonda_en_curso = False
+        if self.fallos_seguidos >= self.umbral_fallos:
+            self._abierto_hasta = time.monotonic() + self.enfriamiento
+
+
+@dataclass
+class EstadisticasNoticias:
+    busquedas: int = 0
+    aciertos_cache: int = 0
+    timeouts: int = 0
+    errores: int = 0
+    circuito_abierto: int = 0
+    pool_saturado: int = 0
+    degradadas: int = 0  # Respuestas sin resultados frescos (las anteriores de la caché o un aviso)
+
+    def as_dict(self) -> dict:
+        return dict(self.__dict__)
+
+
+@dataclass
+class _Entrada:
+    resultado: str
+    guardada: float
+
+
+class BuscadorNoticias:
+    """Ver el comentario del módulo. Una instancia por proceso (`buscador_noticias`)."""
+
+    def __init__(self, backend: Optional[BackendNoticias] = None,
+                 timeout: float = NEWS_SEARCH_TIMEOUT_SECONDS,
+                 max_workers: int = NEWS_SEARCH_MAX_WORKERS,
+                 ttl_seconds: int = NEWS_SEARCH_CACHE_TTL_SECONDS,
+                 max_entries: int = NEWS_SEARCH_CACHE_MAX_ENTRIES,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.backend = backend or crear_backend_noticias()
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.breaker = breaker or CircuitBreaker()
+        self.stats = EstadisticasNoticias()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="noticias")
+        self._en_curso = 0  # Búsquedas ocupando un hilo (también las que ya superaron el plazo)
+        self._lock = threading.Lock()
+        # Se conservan también las entradas caducadas: sirven de respuesta degradada
+        self._cache: "OrderedDict[str, _Entrada]" = OrderedDict()
+
+    async def buscar(self, query: str) -> str:
+        # La misma búsqueda pedida a la vez por varios turnos se lanza una sola vez
+        clave = normalizar_pregunta(query)
+        return await vuelos_herramientas.ejecutar(("buscar_noticias_del_sector", clave),
+                                                  lambda: self._buscar(query, clave))
+
+    async def _buscar(self, query: str, clave: str) -> str:
+        entrada = self._cache.get(clave)
+        if entrada is not None and time.monotonic() - entrada.guardada <= self.ttl_seconds:
+            self._cache.move_to_end(clave)
+            self.stats.aciertos_cache += 1
+            return entrada.resultado
+
+        if not self.breaker.permitir():
+            self.stats.circuito_abierto += 1
+            return self._degradada(query, entrada, "el servicio de búsqueda no está respondiendo")
+        with self._lock:
+            saturado = self._en_curso >= self.max_workers
+            if not saturado:
+                self._en_curso += 1
+        if saturado:
+            # Todos los hilos siguen ocupados con búsquedas colgadas: no se encola otra más.
+            # Si era la búsqueda de prueba del circuito, otra podrá intentarlo.
+            self.breaker.liberar_sonda()
+            self.stats.pool_saturado += 1
+            return self._degradada(query, entrada, "hay demasiadas búsquedas en curso")
+
+        self.stats.busquedas += 1
+        futuro = asyncio.wrap_future(self._pool.submit(self._buscar_en_hilo, query))
+        # El resultado se guarda en la caché al llegar, aunque sea después del plazo
+        futuro.add_done_callback(lambda f: self._al_terminar(clave, f))
+        try:
+            with etapa("noticias.busqueda"):
+                # `shield` para que el timeout no intente cancelar el hilo (no se puede):
+                # la búsqueda acaba en segundo plano y libera su plaza al terminar.
+                resultado = await asyncio.wait_for(asyncio.shield(futuro), self.timeout)
+        except asyncio.CancelledError:
+            self.breaker.liberar_sonda()  # La petición se canceló: la prueba no llegó a concluir
+            raise
+        except asyncio.TimeoutError:
+            self.stats.timeouts += 1
+            self.breaker.registrar_fallo()
+            log_evento("noticias.timeout", logging.WARNING, query=query, timeout_s=self.timeout)
+            return self._degradada(query, entrada, "la búsqueda tardó demasiado")
+        except Exception as e:
+            self.stats.errores += 1
+            self.breaker.registrar_fallo()
+            log_evento("noticias.error", logging.WARNING, query=query, error=str(e))
+            return self._degradada(query, entrada, "la búsqueda falló")
+
+        self.breaker.registrar_exito()
+        return resultado
+
+    def _buscar_en_hilo(self, query: str) -> str:
+        try:
+            return self.backend.buscar(query)
+        finally:
+            with self._lock:
+                self._en_curso -= 1
+
+    def _al_terminar(self, clave: str, futuro: asyncio.Future) -> None:
+        if futuro.cancelled() or futuro.exception() is not None or self.ttl_seconds <= 0:
+            return  # Leer la excepción evita el aviso de "exception was never retrieved"
+        self._cache[clave] = _Entrada(futuro.result(), time.monotonic())
+        self._cache.move_to_end(clave)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    def _degradada(self, query: str, entrada: Optional[_Entrada], motivo: str) -> str:
+        self.stats.degradadas += 1
+        if entrada is not None:
+            minutos = int((time.monotonic() - entrada.guardada) // 60)
+            return (f"AVISO: no se pudieron obtener noticias actualizadas ({motivo}). "
+                    f"Estos son los últimos resultados disponibles, de hace {minutos} minutos:\n\n{entrada.resultado}")
+        return (f"AVISO: no se pudieron consultar las noticias sobre '{query}' en este momento ({motivo}). "
+                "Indícale al usuario que lo intente de nuevo en unos minutos.")
+
+    def stats_dict(self) -> dict:
+        return {
+            **self.stats.as_dict(),
+            "circuito": self.breaker.estado,
+            "en_curso": self._en_curso,
+            "entradas_cache": len(self._cache),
+            "backend": type(self.backend).__name__,
+        }
+
+    def cerrar(self) -> None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+buscador_noticias = BuscadorNoticias()
@@ -0,0 +1,270 @@
+import os
+import gzip
+import json
+import time
+import shutil
+import threading
+from typing import Optional
+
+import numpy as np
+
+from .config import VECTOR_INDEX_TYPE, IVF_MIN_VECTORS, IVF_NPROBE, POLICY_PARTITIONS_ENABLED
+from .executors import run_blocking
+from .hybrid_search import MascarasFiltro, cumple_filtro, polizas_del_filtro
+from .observability import log_evento
+
+# =========================================================================
+# Índice vectorial local en NumPy, sin red ni servidor.
+#
+# En disco (VECTOR_INDEX_DIR), cada publicación en su propio subdirectorio:
+#   ACTUAL              -> nombre del subdirectorio publicado. Se reemplaza de
+#                          forma atómica al final: un lector nunca mezcla
+#                          ficheros de dos publicaciones distintas.
+#   g<n>/embeddings.npy -> matriz float32 [N, d] normalizada (se abre con mmap)
+#   g<n>/ivf.npz        -> (opcional) centroides y offsets de las listas IVF; las
+#                          filas de embeddings.npy están agrupadas por lista
+#   g<n>/docs.json.gz   -> ids, textos, metadatos y metadatos de la "colección"
+#                          (incluida la versión)
+# Se conservan la publicación actual y la anterior (puede haber lectores
+# cargándola). Sin ACTUAL se leen los ficheros del propio directorio (formato
+# anterior, con los tres ficheros sueltos).
+#
+# Al cargar se agrupan además las filas por póliza (metadato `poliza`): un
+# filtro por póliza recorre solo sus filas en lugar de toda la matriz.
+# =========================================================================
+
+_ARCHIVO_EMBEDDINGS = "embeddings.npy"
+_ARCHIVO_IVF = "ivf.npz"
+_ARCHIVO_DOCS = "docs.json.gz"
+_ARCHIVO_ACTUAL = "ACTUAL"
+_PREFIJO_GENERACION = "g"
+
+
+def _directorio_publicado(directorio: str) -> str:
+    """Subdirectorio con el índice publicado (el propio directorio en el formato anterior)."""
+    try:
+        with open(os.path.join(directorio, _ARCHIVO_ACTUAL), encoding="utf-8") as f:
+            return os.path.join(directorio, f.read().strip())
+    except FileNotFoundError:
+        return directorio
+
+
+def _ruta_marca(directorio: str) -> str:
+    """Fichero cuya fecha de modificación cambia con cada publicación."""
+    ruta = os.path.join(directorio, _ARCHIVO_ACTUAL)
+    return ruta if os.path.exists(ruta) else os.path.join(directorio, _ARCHIVO_DOCS)
+
+
+def _normalizar_filas(matriz: np.ndarray) -> np.ndarray:
+    matriz = np.asarray(matriz, dtype=np.float32)
+    return matriz / np.clip(np.linalg.norm(matriz, axis=1, keepdims=True), 1e-12, None)
+
+
+def _kmeans(vectores: np.ndarray, k: int, iteraciones: int = 10, semilla: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """K-means esférico (similitud coseno) sencillo. Devuelve (centroides, asignación)."""
+    rng = np.random.default_rng(semilla)
+    centroides = vectores[rng.choice(len(vectores), size=k, replace=False)].copy()
+    for _ in range(iteraciones):
+        asignacion = np.argmax(vectores @ centroides.T, axis=1)
+        for c in range(k):
+            miembros = vectores[asignacion == c]
+            if len(miembros):
+                centroides[c] = miembros.mean(axis=0)
+        centroides = _normalizar_filas(centroides)
+    return centroides, np.argmax(vectores @ centroides.T, axis=1)
+
+
+class NumpyIndex:
+    """Lado de lectura: búsqueda exacta (flat) o aproximada (IVF) sobre la matriz mapeada."""
+
+    def __init__(self, directorio: str, nprobe: int = IVF_NPROBE,
+                 particionar: bool = POLICY_PARTITIONS_ENABLED):
+        self.directorio = directorio
+        self.nprobe = nprobe
+        self.particionar = particionar
+        publicado = _directorio_publicado(directorio)
+        with gzip.open(os.path.join(publicado, _ARCHIVO_DOCS), "rt", encoding="utf-8") as f:
+            docs = json.load(f)
+        self.ids: list[str] = docs["ids"]
+        self.textos: list[str] = docs["textos"]
+        self.metadatas: list[dict] = docs["metadatas"]
+        self.metadata: dict = docs.get("metadata", {})
+        self.embeddings = np.load(os.path.join(publicado, _ARCHIVO_EMBEDDINGS), mmap_mode="r")
+        ruta_ivf = os.path.join(publicado, _ARCHIVO_IVF)
+        self.centroides, self.offsets = None, None
+        if os.path.exists(ruta_ivf):
+            ivf = np.load(ruta_ivf)
+            self.centroides, self.offsets = ivf["centroides"], ivf["offsets"]
+        self.mascaras = MascarasFiltro(self.metadatas)
+        # Sub-índice por póliza: sus filas, en orden
+        self.particiones = self.mascaras.filas_por_poliza
+        # Calentamos las páginas del mmap para que la primera consulta no pague el disco.
+        if len(self.embeddings):
+            float(np.asarray(self.embeddings).sum())
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def buscar(self, consultas: np.ndarray, k: int, where: Optional[dict] = None) -> list[list[tuple[int, float]]]:
+        """Para cada consulta, [(fila, distancia coseno)] de los `k` vecinos más cercanos."""
+        consultas = _normalizar_filas(np.atleast_2d(consultas))
+        filas = self._filas_de_polizas(where) if where and self.particionar else None
+        if filas is not None and len(filas) < self._filas_por_consulta():
+            # Las filas de la partición se leen una vez para todas las consultas
+            similitudes = np.asarray(self.embeddings[filas]) @ consultas.T
+            return [self._mejores(filas, similitudes[:, j], k) for j in range(len(consultas))]
+        mascara = self.mascaras.mascara(where) if where else None
+        return [self._buscar_una(q, k, mascara) for q in consultas]
+
+    def _filas_de_polizas(self, where: dict) -> Optional[np.ndarray]:
+        polizas = polizas_del_filtro(where)
+        return self.mascaras.filas_de_polizas(polizas) if polizas is not None else None
+
+    def _filas_por_consulta(self) -> float:
+        """Filas que recorre una búsqueda sin sub-índice: todas (flat) o las de `nprobe` listas (IVF)."""
+        if self.centroides is None:
+            return len(self.ids)
+        return len(self.ids) * min(1.0, self.nprobe / len(self.centroides))
+
+    def _buscar_una(self, q: np.ndarray, k: int, mascara: Optional[np.ndarray]) -> list[tuple[int, float]]:
+        if not len(self.ids):
+            return []
+        if self.centroides is not None:
+            listas = np.argsort(-(self.centroides @ q))[:self.nprobe]
+            filas = np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in listas])
+        else:
+            filas = None
+        candidatos = np.asarray(self.embeddings if filas is None else self.embeddings[filas])
+        similitudes = candidatos @ q
+        if filas is None:
+            filas = np.arange(len(self.ids))
+        if mascara is not None:
+            validas = mascara[filas]
+            filas, similitudes = filas[validas], similitudes[validas]
+        return self._mejores(filas, similitudes, k)
+
+    @staticmethod
+    def _mejores(filas: np.ndarray, similitudes: np.ndarray, k: int) -> list[tuple[int, float]]:
+        if not len(filas):
+            return []
+        k = min(k, len(filas))
+        mejores = np.argpartition(-similitudes, k - 1)[:k]
+        mejores = mejores[np.argsort(-similitudes[mejores])]
+        return [(int(filas[i]), float(1.0 - similitudes[i])) for i in mejores]
+
+
+class NumpyCollection:
+    """
+    Lado de escritura, con la misma interfaz que usa `scripts/ingest_data.py`
+    de una colección de ChromaDB (`upsert`, `delete`, `get`, `modify`).
+    Trabaja en memoria y persiste el índice completo al llamar a `modify`,
+    que es el último paso de la ingesta (publicar la versión).
+    """
+
+    def __init__(self, directorio: str, tipo: str = VECTOR_INDEX_TYPE):
+        self.directorio = directorio
+        self.tipo = tipo
+        self.metadata: dict = {}
+        self._filas: dict[str, tuple[np.ndarray, str, dict]] = {}
+        if os.path.exists(os.path.join(_directorio_publicado(directorio), _ARCHIVO_DOCS)):
+            indice = NumpyIndex(directorio)
+            self.metadata = dict(indice.metadata)
+            for i, id_ in enumerate(indice.ids):
+                self._filas[id_] = (np.array(indice.embeddings[i]), indice.textos[i], indice.metadatas[i])
+
+    def upsert(self, ids, documents, metadatas, embeddings) -> None:
+        for id_, texto, metadata, vector in zip(ids, documents, metadatas, embeddings):
+            self._filas[id_] = (np.asarray(vector, dtype=np.float32), texto, metadata)
+
+    def delete(self, ids=None, where=None) -> None:
+        objetivo = set(ids or [])
+        if where:
+            objetivo |= {id_ for id_, (_, _, m) in self._filas.items() if cumple_filtro(m, where)}
+        for id_ in objetivo:
+            self._filas.pop(id_, None)
+
+    def get(self, include=None, limit=None, offset=0) -> dict:
+        ids = list(self._filas)[offset:None if limit is None else offset + limit]
+        return {
+            "ids": ids,
+            "documents": [self._filas[i][1] for i in ids],
+            "metadatas": [self._filas[i][2] for i in ids],
+        }
+
+    def modify(self, metadata: dict) -> None:
+        self.metadata = dict(metadata)
+        self.guardar()
+
+    def guardar(self) -> None:
+        os.makedirs(self.directorio, exist_ok=True)
+        anterior = _directorio_publicado(self.directorio)
+        generacion = f"{_PREFIJO_GENERACION}{time.time_ns()}"
+        destino = os.path.join(self.directorio, generacion)
+        os.makedirs(destino)
+        ids = list(self._filas)
+        matriz = (_normalizar_filas(np.stack([self._filas[i][0] for i in ids]))
+                  if ids else np.zeros((0, 0), dtype=np.float32))
+
+        usar_ivf = self.tipo == "ivf" or (self.tipo == "auto" and len(ids) >= IVF_MIN_VECTORS)
+        if usar_ivf and len(ids) > 1:
+            # Agrupamos las filas por lista IVF: cada lista es un rango contiguo.
+            n_listas = max(1, int(np.sqrt(len(ids))))
+            centroides, asignacion = _kmeans(matriz, n_listas)
+            orden = np.argsort(asignacion, kind="stable")
+            matriz, ids = matriz[orden], [ids[i] for i in orden]
+            offsets = np.zeros(n_listas + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum(np.bincount(asignacion, minlength=n_listas))
+            np.savez(os.path.join(destino, _ARCHIVO_IVF), centroides=centroides, offsets=offsets)
+
+        np.save(os.path.join(destino, _ARCHIVO_EMBEDDINGS), matriz)
+        with gzip.open(os.path.join(destino, _ARCHIVO_DOCS), "wt", encoding="utf-8") as f:
+            json.dump({
+                "ids": ids,
+                "textos": [self._filas[i][1] for i in ids],
+                "metadatas": [self._filas[i][2] for i in ids],
+                "metadata": self.metadata,
+            }, f, ensure_ascii=False)
+
+        # Publicar: el puntero cambia de una vez a la generación completa
+        ruta_actual = os.path.join(self.directorio, _ARCHIVO_ACTUAL)
+        with open(ruta_actual + ".tmp", "w", encoding="utf-8") as f:
+            f.write(generacion)
+        os.replace(ruta_actual + ".tmp", ruta_actual)
+        self._limpiar({generacion, os.path.basename(anterior)}, anterior == self.directorio)
+
+    def _limpiar(self, conservar: set[str], conservar_sueltos: bool) -> None:
+        """Borra las publicaciones que ya no son ni la actual ni la anterior."""
+        for nombre in os.listdir(self.directorio):
+            ruta = os.path.join(self.directorio, nombre)
+            if nombre.startswith(_PREFIJO_GENERACION) and os.path.isdir(ruta) and nombre not in conservar:
+                shutil.rmtree(ruta, ignore_errors=True)
+            elif nombre in (_ARCHIVO_EMBEDDINGS, _ARCHIVO_IVF, _ARCHIVO_DOCS) and not conservar_sueltos:
+                os.remove(ruta)
+
+
+class NumpyIndexCargador:
+    """Mantiene el `NumpyIndex` en memoria y lo recarga cuando la ingesta publica otro."""
+
+    def __init__(self, directorio: str):
+        self.directorio = directorio
+        self._indice: Optional[NumpyIndex] = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def obtener(self) -> NumpyIndex:
+        mtime = os.path.getmtime(_ruta_marca(self.directorio))
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    self._indice = NumpyIndex(self.directorio)
+                    self._mtime = mtime
+                    log_evento("indice_vectorial.cargado", muestrear=False, chunks=len(self._indice),
+                               tipo="ivf" if self._indice.centroides is not None else "plano")
+        return self._indice
+
+    async def aobtener(self) -> NumpyIndex:
+        """`obtener` desde el event loop: la (re)carga, que lee y precalienta todo el índice, va al pool."""
+        mtime = os.path.getmtime(_ruta_marca(self.directorio))
+        if mtime == self._mtime:
+            return self._indice
+        return await run_blocking(self.obtener)
@@ -0,0 +1,432 @@
+import os
+import sys
+import json
+import time
+import random
+import functools
+import asyncio
+import logging
+import threading
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from .config import LOG_LEVEL, LOG_SAMPLE_RATE, TRACING_ENABLED, TRACE_EXPORT_FILE, OTEL_SERVICE_NAME
+
+# =========================================================================
+# Instrumentación del camino caliente:
+#   - Métricas en memoria expuestas en formato de texto de Prometheus (/metrics).
+#   - Spans de OpenTelemetry por etapa (recuperación, herramientas, llamadas
+#     al LLM, streaming), exportados a un fichero local. Opcional.
+#   - Logs estructurados y muestreados en lugar de `print`s.
+# Con las trazas y los logs desactivados, medir una etapa cuesta dos lecturas
+# del reloj y una observación en un histograma.
+# =========================================================================
+
+
+# --- Métricas (formato de exposición de Prometheus 0.0.4) ---
+
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escapar(valor: str) -> str:
+    return valor.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _formatear_etiquetas(nombres: tuple, valores: tuple, extra: str = "") -> str:
+    partes = [f'{n}="{_escapar(v)}"' for n, v in zip(nombres, valores)]
+    if extra:
+        partes.append(extra)
+    return "{" + ",".join(partes) + "}" if partes else ""
+
+
+def _formatear_numero(valor: float) -> str:
+    if valor == float("inf"):
+        return "+Inf"
+    return repr(float(valor)) if not float(valor).is_integer() else str(int(valor))
+
+
+def percentil(valores_ordenados: list[float], q: float) -> float:
+    """Percentil `q` (0-1) de una muestra ya ordenada, para los `/api/<x>/stats`."""
+    if not valores_ordenados:
+        return 0.0
+    return round(valores_ordenados[min(len(valores_ordenados) - 1, int(q * len(valores_ordenados)))], 2)
+
+
+class _Metrica(ABC):
+    tipo = "untyped"
+
+    def __init__(self, nombre: str, ayuda: str, etiquetas: tuple = ()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._lock = threading.Lock()
+
+    def _clave(self, valores: dict) -> tuple:
+        return tuple(str(valores.get(e, "")) for e in self.etiquetas)
+
+    def exponer(self) -> list[str]:
+        return [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} {self.tipo}", *self._lineas()]
+
+    @abstractmethod
+    def _lineas(self) -> list[str]:
+        ...
+
+
+class Contador(_Metrica):
+    tipo = "counter"
+
+    def __init__(self, nombre: str, ayuda: str, etiquetas: tuple = ()):
+        super().__init__(nombre, ayuda, etiquetas)
+        self._valores: dict[tuple, float] = {}
+
+    def inc(self, cantidad: float = 1.0, **etiquetas) -> None:
+        clave = self._clave(etiquetas)
+        with self._lock:
+            self._valores[clave] = self._valores.get(clave, 0.0) + cantidad
+
+    def _lineas(self) -> list[str]:
+        with self._lock:
+            valores = list(self._valores.items())
+        return [f"{self.nombre}{_formatear_etiquetas(self.etiquetas, k)} {_formatear_numero(v)}" for k, v in valores]
+
+
+class Histograma(_Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nombre: str, ayuda: str, etiquetas: tuple = (), buckets: tuple = BUCKETS_SEGUNDOS):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[tuple, list] = {}  # clave -> [cuentas por bucket (+Inf al final), suma]
+
+    def observar(self, valor: float, **etiquetas) -> None:
+        clave = self._clave(etiquetas)
+        posicion = bisect_left(self.buckets, valor)
+        with self._lock:
+            serie = self._series.get(clave)
+            if serie is None:
+                serie = self._series[clave] = [[0] * (len(self.buckets) + 1), 0.0]
+            serie[0][posicion] += 1
+            serie[1] += valor
+
+    def _lineas(self) -> list[str]:
+        with self._lock:
+            series = [(k, list(cuentas), suma) for k, (cuentas, suma) in self._series.items()]
+        lineas = []
+        for clave, cuentas, suma in series:
+            acumulado = 0
+            for limite, cuenta in zip((*self.buckets, float("inf")), cuentas):
+                acumulado += cuenta
+                le = f'le="{_formatear_numero(limite)}"'
+                lineas.append(f"{self.nombre}_bucket{_formatear_etiquetas(self.etiquetas, clave, le)} {acumulado}")
+            etiquetas = _formatear_etiquetas(self.etiquetas, clave)
+            lineas.append(f"{self.nombre}_sum{etiquetas} {_formatear_numero(suma)}")
+            lineas.append(f"{self.nombre}_count{etiquetas} {acumulado}")
+        return lineas
+
+
+class MetricaCalculada(_Metrica):
+    """Métrica cuyo valor se lee al exponerla (p. ej. contadores que ya llevan las cachés)."""
+
+    def __init__(self, nombre: str, ayuda: str, tipo: str, etiquetas: tuple,
+                 leer: Callable[[], dict]):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.tipo = tipo
+        self._leer = leer  # -> {(valores de etiquetas): número}
+
+    def _lineas(self) -> list[str]:
+        try:
+            valores = self._leer()
+        except Exception as e:
+            log_evento("metricas.error_lectura", logging.WARNING, metrica=self.nombre, error=str(e))
+            return []
+        return [f"{self.nombre}{_formatear_etiquetas(self.etiquetas, tuple(map(str, k)))} {_formatear_numero(v)}"
+                for k, v in valores.items()]
+
+
+class RegistroMetricas:
+    def __init__(self):
+        self._metricas: dict[str, _Metrica] = {}
+
+    def _registrar(self, metrica: _Metrica) -> _Metrica:
+        self._metricas[metrica.nombre] = metrica
+        return metrica
+
+    def contador(self, nombre: str, ayuda: str, etiquetas: tuple = ()) -> Contador:
+        return self._registrar(Contador(nombre, ayuda, etiquetas))
+
+    def histograma(self, nombre: str, ayuda: str, etiquetas: tuple = (),
+                   buckets: tuple = BUCKETS_SEGUNDOS) -> Histograma:
+        return self._registrar(Histograma(nombre, ayuda, etiquetas, buckets))
+
+    def calculada(self, nombre: str, ayuda: str, tipo: str, etiquetas: tuple,
+                  leer: Callable[[], dict]) -> MetricaCalculada:
+        return self._registrar(MetricaCalculada(nombre, ayuda, tipo, etiquetas, leer))
+
+    def exponer(self) -> str:
+        lineas = []
+        for metrica in list(self._metricas.values()):
+            lineas.extend(metrica.exponer())
+        return "\n".join(lineas) + "\n"
+
+
+registro_metricas = RegistroMetricas()
+
+DURACION_ETAPA = registro_metricas.histograma(
+    "chatbot_stage_duration_seconds", "Duración de cada etapa del camino caliente.", ("stage",))
+ERRORES = registro_metricas.contador(
+    "chatbot_errors_total", "Errores por etapa.", ("stage",))
+TOKENS_LLM = registro_metricas.contador(
+    "chatbot_llm_tokens_total", "Tokens de las llamadas al LLM según usage_metadata.", ("type",))
+TOKENS_STREAM = registro_metricas.contador(
+    "chatbot_streamed_tokens_total", "Fragmentos de texto enviados al usuario en streaming.")
+TTFT = registro_metricas.histograma(
+    "chatbot_time_to_first_token_seconds", "Tiempo desde la pregunta hasta el primer token de la respuesta.")
+PETICIONES_CHAT = registro_metricas.contador(
+    "chatbot_chat_requests_total", "Peticiones de chat por resultado.", ("result",))
+TOKENS_CONTEXTO = registro_metricas.contador(
+    "chatbot_context_tokens_total", "Tokens estimados de los fragmentos recuperados antes y después de compactarlos.",
+    ("stage",))
+
+
+# --- Logs estructurados y muestreados ---
+
+_NIVEL_APAGADO = logging.CRITICAL + 10
+logger = logging.getLogger("chatbot")
+
+
+class _FormatoJSON(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        datos = {
+            "ts": round(record.created, 3),
+            "nivel": record.levelname.lower(),
+            "evento": record.getMessage(),
+            **getattr(record, "campos", {}),
+        }
+        if trazas.activo:
+            datos.update(trazas.ids_actuales())
+        return json.dumps(datos, ensure_ascii=False, default=str)
+
+
+def configurar_logs(nivel: str = LOG_LEVEL) -> None:
+    logger.handlers.clear()
+    manejador = logging.StreamHandler(sys.stdout)
+    manejador.setFormatter(_FormatoJSON())
+    logger.addHandler(manejador)
+    logger.setLevel(_NIVEL_APAGADO if nivel == "OFF" else getattr(logging, nivel, logging.INFO))
+    logger.propagate = False
+
+
+def log_evento(evento: str, nivel: int = logging.INFO, *, muestrear: bool = True, **campos) -> None:
+    """
+    Emite `evento` con `campos` como una línea JSON. Si el nivel está
+    desactivado o el evento cae fuera de la muestra, vuelve sin formatear nada.
+    Los eventos puntuales (arranque, cargas de índices) van con `muestrear=False`.
+    """
+    if not logger.isEnabledFor(nivel):
+        return
+    if muestrear and nivel < logging.WARNING and LOG_SAMPLE_RATE < 1.0 and random.random() >= LOG_SAMPLE_RATE:
+        return
+    logger.log(nivel, evento, extra={"campos": campos})
+
+
+# --- Trazas (OpenTelemetry, opcional) ---
+
+class Trazas:
+    """
+    Proveedor de spans de OpenTelemetry con exportación a un fichero JSONL local.
+    El SDK se importa al crear el primer span: si no está instalado o
+    TRACING_ENABLED=false, `activo` queda en False y no se crea ningún span.
+    """
+
+    def __init__(self, activo: bool = TRACING_ENABLED, fichero: str = TRACE_EXPORT_FILE):
+        self.activo = activo
+        self.fichero = fichero
+        self._tracer = None
+        self._proveedor = None
+        self._lock = threading.Lock()
+
+    def _obtener_tracer(self):
+        if self._tracer is None:
+            with self._lock:
+                if self._tracer is None and self.activo:
+                    self._configurar()
+        return self._tracer
+
+    def _configurar(self) -> None:
+        try:
+            from opentelemetry import trace
+            from opentelemetry.sdk.resources import Resource
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+        except ImportError:
+            self.activo = False
+            log_evento("trazas.sdk_no_disponible", logging.WARNING,
+                       detalle="TRACING_ENABLED=true pero opentelemetry-sdk no está instalado")
+            return
+        directorio = os.path.dirname(os.path.abspath(self.fichero))
+        os.makedirs(directorio, exist_ok=True)
+        salida = open(self.fichero, "a", encoding="utf-8")
+        exportador = ConsoleSpanExporter(out=salida, formatter=lambda span: span.to_json(indent=None) + "\n")
+        proveedor = TracerProvider(resource=Resource.create({"service.name": OTEL_SERVICE_NAME}))
+        proveedor.add_span_processor(BatchSpanProcessor(exportador))
+        trace.set_tracer_provider(proveedor)
+        self._proveedor = proveedor
+        self._tracer = proveedor.get_tracer("app")
+
+    def iniciar_span(self, nombre: str, padre=None, atributos: Optional[dict] = None):
+        """Crea un span hijo de `padre` (o del span actual). Devuelve None si las trazas están apagadas."""
+        tracer = self._obtener_tracer() if self.activo else None
+        if tracer is None:
+            return None
+        from opentelemetry import trace
+        contexto = trace.set_span_in_context(padre) if padre is not None else None
+        return tracer.start_span(nombre, context=contexto, attributes=atributos or None)
+
+    @contextmanager
+    def como_actual(self, span):
+        """Hace de `span` el padre de los spans que se creen dentro del bloque (en esta tarea)."""
+        if span is None:
+            yield
+            return
+        from opentelemetry import context, trace
+        token = context.attach(trace.set_span_in_context(span))
+        try:
+            yield
+        finally:
+            context.detach(token)
+
+    def ids_actuales(self) -> dict:
+        from opentelemetry import trace
+        contexto = trace.get_current_span().get_span_context()
+        if not contexto.is_valid:
+            return {}
+        return {"trace_id": f"{contexto.trace_id:032x}", "span_id": f"{contexto.span_id:016x}"}
+
+    def cerrar(self) -> None:
+        """Vacía los spans pendientes al fichero (se llama al apagar la app)."""
+        if self._proveedor is not None:
+            self._proveedor.shutdown()
+
+
+trazas = Trazas()
+
+
+def _registrar_error(span, nombre: str, error: BaseException) -> None:
+    # Cancelar (cliente desconectado) o cerrar un generador no son errores
+    if isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+        return
+    ERRORES.inc(stage=nombre)
+    if span is not None:
+        from opentelemetry.trace import Status, StatusCode
+        span.record_exception(error)
+        span.set_status(Status(StatusCode.ERROR, str(error)))
+
+
+@contextmanager
+def etapa(nombre: str, **atributos):
+    """
+    Mide una etapa: observa su duración en `chatbot_stage_duration_seconds`,
+    cuenta sus errores y, con las trazas activas, la envuelve en un span que
+    es el padre de los que se abran dentro. Devuelve el span (o None).
+    """
+    span = trazas.iniciar_span(nombre, atributos=atributos) if trazas.activo else None
+    t0 = time.perf_counter()
+    try:
+        with trazas.como_actual(span):
+            yield span
+    except BaseException as e:
+        _registrar_error(span, nombre, e)
+        raise
+    finally:
+        DURACION_ETAPA.observar(time.perf_counter() - t0, stage=nombre)
+        if span is not None:
+            span.end()
+
+
+def medido(nombre: str):
+    """Decorador de corrutinas: ejecuta la función dentro de `etapa(nombre)`."""
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        async def envoltorio(*args, **kwargs):
+            with etapa(nombre):
+                return await funcion(*args, **kwargs)
+        return envoltorio
+    return decorador
+
+
+class InstrumentacionLLM(BaseCallbackHandler):
+    """
+    Callback de LangChain que mide cada llamada al LLM (también las que hacen
+    las herramientas): duración, tiempo hasta el primer token, tokens de
+    entrada/salida y errores, con un span por llamada.
+    Se ejecuta en línea en el event loop (no en el pool de hilos de LangChain).
+    """
+
+    run_inline = True
+
+    def __init__(self):
+        self._llamadas: dict = {}  # run_id -> [inicio, span, primer_token]
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs) -> None:
+        self._iniciar(run_id, kwargs)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs) -> None:
+        self._iniciar(run_id, kwargs)
+
+    def _iniciar(self, run_id, kwargs: dict) -> None:
+        atributos = {"llm.tags": ",".join(kwargs.get("tags") or [])}
+        span = trazas.iniciar_span("llm", atributos=atributos) if trazas.activo else None
+        self._llamadas[run_id] = [time.perf_counter(), span, None]
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs) -> None:
+        llamada = self._llamadas.get(run_id)
+        if llamada is not None and llamada[2] is None:
+            llamada[2] = time.perf_counter()
+            DURACION_ETAPA.observar(llamada[2] - llamada[0], stage="llm.primer_token")
+
+    def on_llm_end(self, response, *, run_id, **kwargs) -> None:
+        llamada = self._llamadas.pop(run_id, None)
+        if llamada is None:
+            return
+        inicio, span, primer_token = llamada
+        fin = time.perf_counter()
+        DURACION_ETAPA.observar(fin - inicio, stage="llm")
+        if primer_token is not None:
+            DURACION_ETAPA.observar(fin - primer_token, stage="llm.stream")
+        uso = _uso_de_respuesta(response)
+        if uso:
+            TOKENS_LLM.inc(uso.get("input_tokens", 0), type="input")
+            TOKENS_LLM.inc(uso.get("output_tokens", 0), type="output")
+        if span is not None:
+            for clave in ("input_tokens", "output_tokens"):
+                if clave in uso:
+                    span.set_attribute(f"llm.{clave}", uso[clave])
+            span.end()
+
+    def on_llm_error(self, error, *, run_id, **kwargs) -> None:
+        llamada = self._llamadas.pop(run_id, None)
+        if llamada is None:
+            return
+        _registrar_error(llamada[1], "llm", error)
+        DURACION_ETAPA.observar(time.perf_counter() - llamada[0], stage="llm")
+        if llamada[1] is not None:
+            llamada[1].end()
+
+
+def _uso_de_respuesta(response) -> dict:
+    uso = {}
+    for generaciones in getattr(response, "generations", None) or []:
+        for generacion in generaciones:
+            datos = getattr(getattr(generacion, "message", None), "usage_metadata", None) or {}
+            for clave in ("input_tokens", "output_tokens"):
+                uso[clave] = uso.get(clave, 0) + datos.get(clave, 0)
+    return uso
+
+
+instrumentacion_llm = InstrumentacionLLM()
+
+configurar_logs()
@@ -0,0 +1,143 @@
+import logging
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Optional
+
+from .article_index import codigos_de_poliza
+from .config import POLICY_SCOPE_ENABLED, POLICY_SCOPE_HISTORY_MESSAGES
+from .db import crud
+from .db.database import SessionLocal
+from .observability import log_evento
+
+# =========================================================================
+# Recuperación acotada por póliza. Todos los chunks viven en una sola
+# colección; cuando el turno se refiere a pólizas concretas, las búsquedas de
+# las herramientas se limitan a ellas con un filtro `where` sobre el metadato
+# `poliza` (ChromaDB lo aplica en el servidor; el índice NumPy usa un
+# sub-índice por póliza). De dónde salen las pólizas, por prioridad:
+#   1. Códigos citados en la pregunta ("¿qué cubre la POL320190074?").
+#   2. Códigos citados por el usuario en los últimos mensajes de la conversación.
+#   3. La lista "mis pólizas" del usuario (/api/me/policies).
+# Si el filtro no devuelve nada (código que no está en el corpus, chunks
+# indexados sin metadatos de póliza...), se busca en todo el corpus.
+# =========================================================================
+
+ORIGEN_PREGUNTA = "pregunta"
+ORIGEN_CONVERSACION = "conversacion"
+ORIGEN_USUARIO = "usuario"
+
+
+@dataclass(frozen=True)
+class Alcance:
+    polizas: tuple[str, ...]
+    origen: str  # ORIGEN_PREGUNTA, ORIGEN_CONVERSACION u ORIGEN_USUARIO
+
+    @property
+    def where(self) -> dict:
+        if len(self.polizas) == 1:
+            return {"poliza": self.polizas[0]}
+        return {"poliza": {"$in": list(self.polizas)}}
+
+
+# Alcance del turno en curso. Las herramientas corren en tareas hijas del
+# agente, que heredan una copia del contexto con esta variable.
+alcance_turno: ContextVar[Optional[Alcance]] = ContextVar("alcance_turno", default=None)
+
+
+def filtro_del_turno() -> Optional[dict]:
+    """Filtro `where` de las búsquedas del turno en curso (None: todo el corpus)."""
+    alcance = alcance_turno.get()
+    return alcance.where if alcance is not None else None
+
+
+@dataclass
+class EstadisticasAlcance:
+    por_origen: dict = field(default_factory=dict)  # Turnos acotados por origen del alcance
+    sin_alcance: int = 0
+    busquedas_acotadas: int = 0
+    sin_resultados: int = 0  # Búsquedas acotadas vacías que se repitieron en todo el corpus
+
+    def as_dict(self) -> dict:
+        return {**self.__dict__, "por_origen": dict(self.por_origen)}
+
+
+class AlcancePolizas:
+    """
+    Decide el alcance de cada turno (ver el comentario del módulo). La lista
+    "mis pólizas" de cada usuario se lee de la base de datos la primera vez y
+    se mantiene en memoria; `actualizar` la sustituye al guardarla.
+    """
+
+    def __init__(self, activo: bool = POLICY_SCOPE_ENABLED,
+                 mensajes_historial: int = POLICY_SCOPE_HISTORY_MESSAGES):
+        self.activo = activo
+        self.mensajes_historial = mensajes_historial
+        self.stats = EstadisticasAlcance()
+        self._polizas_usuario: dict[str, tuple[str, ...]] = {}
+
+    async def polizas_de_usuario(self, username: str) -> tuple[str, ...]:
+        polizas = self._polizas_usuario.get(username)
+        if polizas is None:
+            try:
+                async with SessionLocal() as db:
+                    polizas = tuple(await crud.get_user_policies(db, username))
+            except Exception as e:
+                # Sin la lista se busca en todo el corpus; se reintenta en el siguiente turno
+                log_evento("alcance.error_polizas_usuario", logging.WARNING, username=username, error=str(e))
+                return ()
+            self._polizas_usuario[username] = polizas
+        return polizas
+
+    def actualizar(self, username: str, polizas: list[str]) -> None:
+        self._polizas_usuario[username] = tuple(polizas)
+
+    async def resolver(self, pregunta: str, session_id: str, mensajes: list) -> Optional[Alcance]:
+        """Alcance del turno; `mensajes` es el historial de la sesión (el más reciente al final)."""
+        if not self.activo:
+            return None
+        alcance = None
+        polizas = codigos_de_poliza(pregunta)
+        if polizas:
+            alcance = Alcance(tuple(polizas), ORIGEN_PREGUNTA)
+        else:
+            recientes = mensajes[-self.mensajes_historial:] if self.mensajes_historial else []
+            # Solo los mensajes del usuario: las respuestas citan pólizas como fuentes
+            for mensaje in reversed([m for m in recientes if getattr(m, "type", None) == "human"]):
+                polizas = codigos_de_poliza(str(mensaje.content))
+                if polizas:
+                    alcance = Alcance(tuple(polizas), ORIGEN_CONVERSACION)
+                    break
+        if alcance is None:
+            polizas = await self.polizas_de_usuario(session_id)
+            if polizas:
+                alcance = Alcance(polizas, ORIGEN_USUARIO)
+        if alcance is None:
+            self.stats.sin_alcance += 1
+        else:
+            self.stats.por_origen[alcance.origen] = self.stats.por_origen.get(alcance.origen, 0) + 1
+        return alcance
+
+    async def buscar_varios(self, retriever, consultas: list[str], n_results: int,
+                            where: Optional[dict]) -> list[tuple[list, list]]:
+        """
+        `Retriever.buscar_varios` con el filtro del turno; las consultas que no
+        encuentran nada dentro del alcance se repiten en todo el corpus.
+        """
+        if not where:
+            return await retriever.buscar_varios(consultas, n_results=n_results)
+        self.stats.busquedas_acotadas += len(consultas)
+        resultados = await retriever.buscar_varios(consultas, n_results=n_results, where=where)
+        vacias = [i for i, (documentos, _) in enumerate(resultados) if not documentos]
+        if vacias:
+            self.stats.sin_resultados += len(vacias)
+            globales = await retriever.buscar_varios([consultas[i] for i in vacias], n_results=n_results)
+            for i, resultado in zip(vacias, globales):
+                resultados[i] = resultado
+        return resultados
+
+    async def buscar(self, retriever, consulta: str, n_results: int = 3,
+                     where: Optional[dict] = None) -> tuple[list, list]:
+        return (await self.buscar_varios(retriever, [consulta], n_results, where))[0]
+
+
+alcance_polizas = AlcancePolizas()
@@ -0,0 +1,133 @@
+import time
+import asyncio
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional
+
+from .config import PREFETCH_ENABLED, PREFETCH_MIN_SIMILARITY
+from .hybrid_search import tokenizar
+
+# =========================================================================
+# Recuperación especulativa. El agente gasta una llamada completa a Gemini en
+# decidir que va a usar `ConsultaPDF` y solo después empieza la búsqueda.
+# Aquí la búsqueda de la pregunta del usuario arranca a la vez que esa
+# llamada; si la herramienta pide luego la misma consulta (o una parecida),
+# recibe el resultado ya calculado, o espera solo lo que le falte.
+# Si el turno acaba sin usarlo, se cancela. Aciertos y desperdicio se
+# publican en /api/prefetch/stats.
+# =========================================================================
+
+
+def similitud_lexica(a: set, b: set) -> float:
+    """Jaccard entre los términos (sin stopwords) de dos consultas."""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+@dataclass
+class EstadisticasPrefetch:
+    lanzados: int = 0
+    aciertos: int = 0  # La herramienta usó el resultado adelantado
+    desperdiciados: int = 0  # El turno terminó sin usarlo
+    cancelados: int = 0  # De los desperdiciados, los que aún estaban en curso
+    errores: int = 0
+    ms_ocultos: float = 0.0  # Recuperación que ya estaba hecha cuando la herramienta la pidió
+
+    def as_dict(self) -> dict:
+        return {
+            **self.__dict__,
+            "ms_ocultos": round(self.ms_ocultos, 1),
+            "tasa_acierto": round(self.aciertos / self.lanzados, 3) if self.lanzados else None,
+            "tasa_desperdicio": round(self.desperdiciados / self.lanzados, 3) if self.lanzados else None,
+        }
+
+
+class Prefetch:
+    """Una búsqueda adelantada: la consulta, sus términos y la tarea que la ejecuta."""
+
+    def __init__(self, consulta: str, n_results: int, where: Optional[dict], tarea: asyncio.Task):
+        self.consulta = consulta
+        self.n_results = n_results
+        self.where = where
+        self.terminos = set(tokenizar(consulta))
+        self.tarea = tarea
+        self.inicio = time.perf_counter()
+        self.fin: Optional[float] = None
+        self.usos = 0
+
+
+# Búsqueda adelantada del turno en curso. Las herramientas corren en tareas
+# hijas del agente, que heredan una copia del contexto con esta variable.
+prefetch_actual: ContextVar[Optional[Prefetch]] = ContextVar("prefetch_actual", default=None)
+
+
+class RecuperacionAnticipada:
+    """Ver el comentario del módulo. `buscar` tiene la firma de `Retriever.buscar`."""
+
+    def __init__(self, buscar: Callable[..., Awaitable[tuple[list, list]]],
+                 activo: bool = PREFETCH_ENABLED,
+                 min_similitud: float = PREFETCH_MIN_SIMILARITY):
+        self.buscar = buscar
+        self.activo = activo
+        self.min_similitud = min_similitud
+        self.stats = EstadisticasPrefetch()
+
+    def iniciar(self, consulta: str, n_results: int = 3, where: Optional[dict] = None) -> Optional[Prefetch]:
+        """Lanza la búsqueda de `consulta` (con el filtro `where`) en segundo plano y la deja como la del turno."""
+        if not self.activo:
+            return None
+        prefetch = Prefetch(consulta, n_results, where,
+                            asyncio.create_task(self.buscar(consulta, n_results=n_results, where=where)))
+        prefetch.tarea.add_done_callback(lambda tarea: self._al_terminar(prefetch, tarea))
+        self.stats.lanzados += 1
+        prefetch_actual.set(prefetch)
+        return prefetch
+
+    def _al_terminar(self, prefetch: Prefetch, tarea: asyncio.Task) -> None:
+        prefetch.fin = time.perf_counter()
+        # Leer la excepción evita el aviso de "exception was never retrieved"
+        if not tarea.cancelled() and tarea.exception() is not None:
+            self.stats.errores += 1
+
+    async def tomar(self, consulta: str, n_results: int,
+                    where: Optional[dict] = None) -> Optional[tuple[list, list]]:
+        """
+        El resultado adelantado si `consulta` se parece lo bastante a la del
+        turno (y pide los mismos resultados con el mismo filtro); si no, o si
+        falló, None y la herramienta busca por su cuenta.
+        """
+        prefetch = prefetch_actual.get()
+        if prefetch is None or prefetch.n_results != n_results or prefetch.where != where \
+                or prefetch.tarea.cancelled():
+            return None
+        if similitud_lexica(prefetch.terminos, set(tokenizar(consulta))) < self.min_similitud:
+            return None
+        pedido = time.perf_counter()
+        try:
+            # `shield`: si se cancela esta herramienta, la búsqueda sigue para el resto del turno
+            resultado = await asyncio.shield(prefetch.tarea)
+        except asyncio.CancelledError:
+            if prefetch.tarea.cancelled():
+                return None
+            raise
+        except Exception:
+            return None  # Ya contado en `_al_terminar`
+        if prefetch.usos == 0:
+            self.stats.aciertos += 1
+            fin = prefetch.fin or time.perf_counter()
+            self.stats.ms_ocultos += (min(pedido, fin) - prefetch.inicio) * 1000
+        prefetch.usos += 1
+        return resultado
+
+    def terminar(self, prefetch: Optional[Prefetch]) -> None:
+        """Fin del turno: cancela la búsqueda si nadie la usó."""
+        if prefetch is None:
+            return
+        if prefetch_actual.get() is prefetch:
+            prefetch_actual.set(None)
+        if prefetch.usos == 0:
+            self.stats.desperdiciados += 1
+            if not prefetch.tarea.done():
+                prefetch.tarea.cancel()
+                self.stats.cancelados += 1
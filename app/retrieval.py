@@ -0,0 +1,157 @@
+import json
+import time
+import asyncio
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Optional
+
+from .answer_cache import normalizar_pregunta
+from .config import HYBRID_SEARCH_ENABLED, BM25_INDEX_DIR, HYBRID_CANDIDATES, RRF_K, RERANKER_MODEL
+from .embeddings import embed_textos
+from .executors import run_blocking
+from .hybrid_search import BM25Cargador, CrossEncoderReranker, fusion_rrf
+from . import observability
+from .retrieval_cache import RetrievalCache
+from .vector_store import VectorStore
+
+
+class LatenciasPorEtapa:
+    """Guarda las últimas latencias (ms) de cada etapa de la recuperación."""
+
+    def __init__(self, ventana: int = 1000):
+        self.ventana = ventana
+        self._etapas: dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def registrar(self, etapa: str, segundos: float) -> None:
+        with self._lock:
+            self._etapas.setdefault(etapa, deque(maxlen=self.ventana)).append(segundos * 1000)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            resumen = {}
+            for etapa, valores in self._etapas.items():
+                ordenados = sorted(valores)
+                resumen[etapa] = {
+                    "n": len(ordenados),
+                    "p50_ms": observability.percentil(ordenados, 0.50),
+                    "p95_ms": observability.percentil(ordenados, 0.95),
+                }
+            return resumen
+
+
+class Retriever:
+    """
+    Punto único de recuperación de fragmentos de pólizas para las herramientas.
+
+    Etapas (cada una con su latencia medida):
+    1. `embedding`: vector de la consulta (memoizado).
+    2. `vectorial`: vecinos más cercanos en el backend vectorial configurado.
+    3. `bm25`: búsqueda léxica sobre el índice invertido de la ingesta.
+    4. `fusion`: Reciprocal Rank Fusion de ambos rankings.
+    5. `rerank`: cross-encoder opcional sobre los candidatos fusionados.
+
+    El resultado final (documents, metadatas) se memoiza por versión del
+    índice, de modo que la misma consulta, dentro de una conversación o entre
+    usuarios, no vuelve a pasar por ninguna etapa.
+
+    Cada etapa se publica también como métrica `retrieval.<etapa>` (y span, si
+    las trazas están activas) a través de `app/observability.py`.
+    """
+
+    def __init__(self, store: VectorStore, cache: Optional[RetrievalCache] = None,
+                 hibrido: bool = HYBRID_SEARCH_ENABLED):
+        self.store = store
+        self.cache = cache or RetrievalCache()
+        self.bm25 = BM25Cargador(BM25_INDEX_DIR) if hibrido else None
+        self.reranker = CrossEncoderReranker(RERANKER_MODEL) if RERANKER_MODEL else None
+        self.latencias = LatenciasPorEtapa()
+
+    @contextmanager
+    def _medir(self, nombre: str):
+        t0 = time.perf_counter()
+        with observability.etapa(f"retrieval.{nombre}"):
+            yield
+        self.latencias.registrar(nombre, time.perf_counter() - t0)
+
+    async def embedding(self, texto: str) -> list[float]:
+        """Embedding de una consulta, memoizado por su texto normalizado."""
+        return (await self.embeddings([texto]))[0]
+
+    async def embeddings(self, textos: list[str]) -> list[list[float]]:
+        claves = [normalizar_pregunta(t) for t in textos]
+        vectores = [self.cache.embeddings.get(c) for c in claves]
+        pendientes = [i for i, v in enumerate(vectores) if v is None]
+        if pendientes:
+            # Una sola pasada del modelo para todas las consultas que faltan.
+            # Se embebe el texto original (con tildes); la clave es la forma normalizada.
+            with self._medir("embedding"):
+                nuevos = await embed_textos([textos[i] for i in pendientes])
+            for i, vector in zip(pendientes, nuevos):
+                vectores[i] = vector
+                self.cache.embeddings.put(claves[i], vector)
+        return vectores
+
+    async def buscar(self, query: str, n_results: int = 3,
+                     where: Optional[dict] = None) -> tuple[list[str], list[dict]]:
+        """Devuelve (documents, metadatas) de los `n_results` fragmentos más relevantes."""
+        return (await self.buscar_varios([query], n_results, where))[0]
+
+    async def buscar_varios(self, queries: list[str], n_results: int = 3,
+                            where: Optional[dict] = None) -> list[tuple[list[str], list[dict]]]:
+        """Como `buscar`, pero resuelve todas las consultas que falten en UNA llamada al backend vectorial."""
+        self.cache.asegurar_version(await self.store.version())
+        filtro = json.dumps(where, sort_keys=True) if where else ""
+        claves = [(self.cache.version, normalizar_pregunta(q), n_results, filtro) for q in queries]
+        resultados = [self.cache.resultados.get(c) for c in claves]
+        pendientes = [i for i, r in enumerate(resultados) if r is None]
+        if pendientes:
+            nuevos = await self._recuperar([queries[i] for i in pendientes], n_results, where)
+            for i, resultado in zip(pendientes, nuevos):
+                resultados[i] = resultado
+                self.cache.resultados.put(claves[i], resultado)
+        return resultados
+
+    async def _recuperar(self, queries: list[str], n_results: int,
+                         where: Optional[dict]) -> list[tuple[list[str], list[dict]]]:
+        indice_bm25 = await self.bm25.aobtener() if self.bm25 else None
+        n_candidatos = max(n_results, HYBRID_CANDIDATES) if indice_bm25 else n_results
+
+        # Etapa vectorial: una sola llamada al backend para todas las consultas
+        vectores = await self.embeddings(queries)
+        kwargs = {"where": where} if where else {}
+        with self._medir("vectorial"):
+            respuesta = await self.store.query(query_embeddings=vectores, n_results=n_candidatos, **kwargs)
+
+        # Las etapas por consulta (bm25, fusión, rerank) de varias consultas corren en paralelo.
+        return list(await asyncio.gather(*(
+            self._fusionar(query, posicion, respuesta, indice_bm25, n_candidatos, n_results, where)
+            for posicion, query in enumerate(queries)
+        )))
+
+    async def _fusionar(self, query: str, posicion: int, respuesta: dict, indice_bm25,
+                        n_candidatos: int, n_results: int, where: Optional[dict]) -> tuple[list[str], list[dict]]:
+        ids = respuesta["ids"][posicion] if respuesta.get("ids") else []
+        documentos = respuesta["documents"][posicion] if respuesta.get("documents") else []
+        metadatos = (respuesta["metadatas"][posicion] if respuesta.get("metadatas") else None) or [{}] * len(ids)
+        candidatos = {id_: (doc, meta) for id_, doc, meta in zip(ids, documentos, metadatos)}
+        ranking = list(ids)
+
+        if indice_bm25 is not None:
+            with self._medir("bm25"):
+                lexicos = await run_blocking(indice_bm25.buscar, query, n_candidatos, where)
+            ids_lexicos = [indice_bm25.ids[i] for i in lexicos]
+            for i in lexicos:
+                candidatos.setdefault(indice_bm25.ids[i], (indice_bm25.textos[i], indice_bm25.metadatas[i]))
+            with self._medir("fusion"):
+                ranking = fusion_rrf([ranking, ids_lexicos], k=RRF_K)
+
+        if self.reranker is not None and len(ranking) > 1:
+            with self._medir("rerank"):
+                textos = [candidatos[id_][0] for id_ in ranking]
+                puntuaciones = await run_blocking(self.reranker.puntuar, query, textos)
+                ranking = [id_ for _, id_ in sorted(zip(puntuaciones, ranking), key=lambda p: -p[0])]
+
+        elegidos = ranking[:n_results]
+        return [candidatos[i][0] for i in elegidos], [candidatos[i][1] or {} for i in elegidos]
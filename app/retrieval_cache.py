@@ -0,0 +1,71 @@
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+from .config import RETRIEVAL_CACHE_MAX_EMBEDDINGS, RETRIEVAL_CACHE_MAX_RESULTS
+
+
+class LRUCache:
+    """Diccionario acotado con expulsión LRU y contadores de aciertos/fallos."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._datos: "OrderedDict[Hashable, object]" = OrderedDict()
+
+    def get(self, clave: Hashable) -> Optional[object]:
+        if clave in self._datos:
+            self._datos.move_to_end(clave)
+            self.hits += 1
+            return self._datos[clave]
+        self.misses += 1
+        return None
+
+    def put(self, clave: Hashable, valor: object) -> None:
+        self._datos[clave] = valor
+        self._datos.move_to_end(clave)
+        while len(self._datos) > self.max_entries:
+            self._datos.popitem(last=False)
+
+    def clear(self) -> None:
+        self._datos.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "entradas": len(self._datos),
+        }
+
+
+class RetrievalCache:
+    """
+    Caché en proceso de la etapa de recuperación:
+
+    - `embeddings`: texto normalizado de la consulta -> vector de la consulta.
+      No depende del índice (solo del modelo), así que sobrevive a re-ingestas.
+    - `resultados`: (versión del índice, texto normalizado, n_results, filtros)
+      -> (documents, metadatas). Al cambiar la versión se vacía entera.
+
+    Solo se usa desde el event loop, por lo que no necesita locks.
+    """
+
+    def __init__(self, max_embeddings: int = RETRIEVAL_CACHE_MAX_EMBEDDINGS,
+                 max_resultados: int = RETRIEVAL_CACHE_MAX_RESULTS):
+        self.embeddings = LRUCache(max_embeddings)
+        self.resultados = LRUCache(max_resultados)
+        self.version: Optional[str] = None
+
+    def asegurar_version(self, version: str) -> None:
+        if version != self.version:
+            self.resultados.clear()
+            self.version = version
+
+    def stats(self) -> dict:
+        return {
+            "version_indice": self.version,
+            "embeddings": self.embeddings.stats(),
+            "resultados": self.resultados.stats(),
+        }
@@ -0,0 +1,151 @@
+import re
+import asyncio
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional
+
+import numpy as np
+
+from .answer_cache import _unitario, es_pregunta_autonoma
+from .config import ROUTER_ENABLED, ROUTER_MIN_SIMILARITY, ROUTER_MIN_MARGIN
+
+# =========================================================================
+# Enrutador de intenciones delante del agente. El agente gasta una llamada al
+# LLM solo en decidir que hay que usar `ConsultaPDF` (su prompt lo exige para
+# toda pregunta) y otra en responder. Cuando la intención está clara se salta
+# ese paso:
+#   - "poliza":   recuperar fragmentos + UNA llamada al LLM.
+#   - "noticias": búsqueda de noticias + UNA llamada al LLM.
+#   - "agente":   todo lo demás (recombinación, seguimiento de la
+#                 conversación, saludos, fuera de tema, dudas...).
+# Se decide primero por palabras clave y, si no las hay, por similitud del
+# embedding de la pregunta con frases de ejemplo de cada intención.
+# =========================================================================
+
+INTENCION_POLIZA = "poliza"
+INTENCION_NOTICIAS = "noticias"
+INTENCION_AGENTE = "agente"
+
+# Sobre la pregunta ya normalizada (minúsculas y sin tildes)
+_PALABRAS_COMBINAR = re.compile(
+    r"\b(combin\w*|fusion\w*|unific\w*|redact\w*|crea|crear|creame|nueva poliza|nueva cobertura|ejemplo)\b")
+_PALABRAS_NOTICIAS = re.compile(r"\b(noticias?|actualidad|novedad(es)?|ultimas|recientes?|tendencias?)\b")
+_PALABRAS_POLIZA = re.compile(
+    r"\b(polizas?|cobertura\w*|cubre\w*|deducible\w*|reembols\w*|asegurad\w*|siniestro\w*|"
+    r"exclusion\w*|excluid\w*|articulos?|carencia\w*|beneficiari\w*|hospitaliza\w*|indemniza\w*|"
+    r"copago\w*|condiciones (generales|particulares)|clausula\w*)\b")
+
+# Frases de ejemplo para la clasificación por embeddings. "otro" no tiene
+# atajo: si gana, la pregunta va al agente.
+EJEMPLOS_INTENCIONES = {
+    INTENCION_POLIZA: [
+        "¿Qué cubre mi póliza de seguro?",
+        "¿Cuál es el deducible del seguro de salud?",
+        "¿Qué exclusiones tiene la cobertura?",
+        "¿Cómo solicito el reembolso de gastos médicos?",
+        "¿Qué dicen las condiciones generales sobre la hospitalización?",
+        "¿Cuánto tiempo de carencia hay antes de poder usar el seguro?",
+        "¿Cuánto cuesta la prima mensual del seguro?",
+    ],
+    INTENCION_NOTICIAS: [
+        "últimas noticias del sector asegurador",
+        "novedades sobre la regulación de los seguros",
+        "qué está pasando en el mercado de seguros",
+    ],
+    "otro": [
+        "hola, ¿quién eres?",
+        "muchas gracias por tu ayuda",
+        "¿qué tiempo hace hoy?",
+        "cuéntame un chiste",
+    ],
+}
+
+
+@dataclass
+class EstadisticasRouter:
+    por_intencion: dict = field(default_factory=dict)
+    por_metodo: dict = field(default_factory=dict)  # palabras_clave / embedding / seguimiento / desactivado
+    recurridas_al_agente: int = 0  # Atajos que no encontraron información y acabaron en el agente
+
+    def as_dict(self) -> dict:
+        return {
+            "por_intencion": dict(self.por_intencion),
+            "por_metodo": dict(self.por_metodo),
+            "recurridas_al_agente": self.recurridas_al_agente,
+        }
+
+
+class RouterIntenciones:
+    """Ver el comentario del módulo. `embeber` es la función de embeddings de consultas del retriever."""
+
+    def __init__(self, embeber: Callable[[list[str]], Awaitable[list[list[float]]]],
+                 activo: bool = ROUTER_ENABLED,
+                 min_similitud: float = ROUTER_MIN_SIMILARITY,
+                 min_margen: float = ROUTER_MIN_MARGIN):
+        self.embeber = embeber
+        self.activo = activo
+        self.min_similitud = min_similitud
+        self.min_margen = min_margen
+        self.stats = EstadisticasRouter()
+        self._ejemplos: Optional[tuple[list[str], np.ndarray]] = None  # (intención de cada fila, matriz unitaria)
+        self._lock = asyncio.Lock()
+
+    async def clasificar(self, pregunta_normalizada: str, embedding: Optional[list[float]] = None) -> str:
+        """
+        Devuelve la intención de la pregunta. `embedding` es el de la pregunta si
+        ya se calculó (p. ej. en la caché de respuestas); si no, se calcula aquí
+        solo cuando las palabras clave no bastan.
+        """
+        intencion, metodo = await self._decidir(pregunta_normalizada, embedding)
+        self.stats.por_intencion[intencion] = self.stats.por_intencion.get(intencion, 0) + 1
+        self.stats.por_metodo[metodo] = self.stats.por_metodo.get(metodo, 0) + 1
+        return intencion
+
+    async def _decidir(self, pregunta: str, embedding: Optional[list[float]]) -> tuple[str, str]:
+        if not self.activo:
+            return INTENCION_AGENTE, "desactivado"
+        # Las preguntas de seguimiento ("y por qué?") necesitan el historial: agente
+        if not es_pregunta_autonoma(pregunta):
+            return INTENCION_AGENTE, "seguimiento"
+        if _PALABRAS_COMBINAR.search(pregunta):
+            return INTENCION_AGENTE, "palabras_clave"
+        if _PALABRAS_NOTICIAS.search(pregunta):
+            return INTENCION_NOTICIAS, "palabras_clave"
+        if _PALABRAS_POLIZA.search(pregunta):
+            return INTENCION_POLIZA, "palabras_clave"
+        return await self._por_embedding(pregunta, embedding), "embedding"
+
+    async def _por_embedding(self, pregunta: str, embedding: Optional[list[float]]) -> str:
+        intenciones, matriz = await self._matriz_ejemplos()
+        if embedding is None:
+            embedding = (await self.embeber([pregunta]))[0]
+        similitudes = matriz @ _unitario(embedding)
+        # La mejor similitud de cada intención con cualquiera de sus ejemplos
+        mejores: dict[str, float] = {}
+        for intencion, similitud in zip(intenciones, similitudes):
+            mejores[intencion] = max(mejores.get(intencion, -1.0), float(similitud))
+        ranking = sorted(mejores.items(), key=lambda p: -p[1])
+        ganadora, similitud = ranking[0]
+        margen = similitud - ranking[1][1] if len(ranking) > 1 else similitud
+        if ganadora in (INTENCION_POLIZA, INTENCION_NOTICIAS) \
+                and similitud >= self.min_similitud and margen >= self.min_margen:
+            return ganadora
+        return INTENCION_AGENTE
+
+    async def _matriz_ejemplos(self) -> tuple[list[str], np.ndarray]:
+        # Los ejemplos se embeben una sola vez, en la primera pregunta que los necesita
+        if self._ejemplos is None:
+            async with self._lock:
+                if self._ejemplos is None:
+                    intenciones = [i for i, frases in EJEMPLOS_INTENCIONES.items() for _ in frases]
+                    frases = [f for frases in EJEMPLOS_INTENCIONES.values() for f in frases]
+                    vectores = await self.embeber(frases)
+                    self._ejemplos = (intenciones, np.stack([_unitario(v) for v in vectores]))
+        return self._ejemplos
+
+    def registrar_recurso_al_agente(self) -> None:
+        self.stats.recurridas_al_agente += 1
+
+
+def usara_consulta_de_polizas(pregunta_normalizada: str) -> bool:
+    """False si, por sus palabras clave, la pregunta irá a las noticias o al recombinador y no a `ConsultaPDF`."""
+    return not (_PALABRAS_COMBINAR.search(pregunta_normalizada) or _PALABRAS_NOTICIAS.search(pregunta_normalizada))
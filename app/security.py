@@ -1,11 +1,25 @@
+import os
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from typing import Optional
+from fastapi import Cookie, HTTPException
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 
+from .config import (
+    BCRYPT_MAX_WORKERS,
+    BCRYPT_MAX_PENDING,
+    TOKEN_CACHE_TTL_SECONDS,
+    TOKEN_CACHE_MAX_ENTRIES,
+)
+
 # --- CLAVES SECRETAS (¡MUY IMPORTANTE!) ---
 # En un proyecto real, estas claves deben estar en tu archivo .env
-SECRET_KEY = "tu-clave-secreta-super-dificil" # ¡CAMBIA ESTO!
+SECRET_KEY = os.getenv("SECRET_KEY", "tu-clave-secreta-super-dificil") # ¡CAMBIA ESTO!
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30 # La sesión durará 30 minutos
 
@@ -26,3 +40,100 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
+
+# --- bcrypt fuera del event loop ---
+# Pool propio y acotado + semáforo: como mucho BCRYPT_MAX_PENDING hashes en
+# vuelo (el resto espera su turno sin ocupar memoria ni hilos).
+_pool_bcrypt = ThreadPoolExecutor(max_workers=BCRYPT_MAX_WORKERS, thread_name_prefix="bcrypt")
+_semaforo_bcrypt = None
+
+async def _en_pool_bcrypt(func, *args):
+    global _semaforo_bcrypt
+    if _semaforo_bcrypt is None:
+        _semaforo_bcrypt = asyncio.Semaphore(BCRYPT_MAX_PENDING)
+    async with _semaforo_bcrypt:
+        return await asyncio.get_running_loop().run_in_executor(_pool_bcrypt, func, *args)
+
+async def averify_password(plain_password, hashed_password) -> bool:
+    return await _en_pool_bcrypt(verify_password, plain_password, hashed_password)
+
+async def aget_password_hash(password) -> str:
+    return await _en_pool_bcrypt(get_password_hash, password)
+
+# --- Verificación de tokens con caché ---
+class TokenCache:
+    """
+    Tokens ya verificados -> (usuario, instante hasta el que la entrada es válida).
+    Una entrada nunca vive más que TOKEN_CACHE_TTL_SECONDS ni más allá del
+    `exp` del propio token, así que la caché no alarga ninguna sesión.
+    """
+
+    def __init__(self, ttl_seconds: int = TOKEN_CACHE_TTL_SECONDS, max_entries: int = TOKEN_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entradas: "OrderedDict[str, tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token: str) -> Optional[str]:
+        with self._lock:
+            entrada = self._entradas.get(token)
+            if entrada is None:
+                return None
+            if time.time() >= entrada[1]:
+                del self._entradas[token]
+                return None
+            self._entradas.move_to_end(token)
+            return entrada[0]
+
+    def put(self, token: str, username: str, exp: float) -> None:
+        with self._lock:
+            self._entradas[token] = (username, min(time.time() + self.ttl_seconds, exp))
+            self._entradas.move_to_end(token)
+            while len(self._entradas) > self.max_entries:
+                self._entradas.popitem(last=False)
+
+    def invalidate(self, token: str) -> None:
+        with self._lock:
+            self._entradas.pop(token, None)
+
+token_cache = TokenCache()
+
+def _extraer_token(access_token: Optional[str]) -> Optional[str]:
+    if not access_token:
+        return None
+    return access_token.removeprefix("Bearer ").strip() or None
+
+def decode_access_token(access_token: Optional[str]) -> Optional[str]:
+    """Devuelve el usuario (`sub`) si el token es válido y no ha expirado; si no, None."""
+    token = _extraer_token(access_token)
+    if token is None:
+        return None
+    username = token_cache.get(token)
+    if username is not None:
+        return username
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    username = payload.get("sub")
+    if not username:
+        return None
+    token_cache.put(token, username, float(payload.get("exp", time.time())))
+    return username
+
+def evict_access_token(access_token: Optional[str]) -> None:
+    token = _extraer_token(access_token)
+    if token is not None:
+        token_cache.invalidate(token)
+
+# --- Dependencias de FastAPI ---
+# Son `async def` a propósito: verificar un HS256 (o acertar en la caché) cuesta
+# microsegundos y así FastAPI no las manda al threadpool en cada petición.
+async def get_optional_user(access_token: Optional[str] = Cookie(None)) -> Optional[str]:
+    return decode_access_token(access_token)
+
+async def get_current_user(access_token: Optional[str] = Cookie(None)) -> str:
+    username = decode_access_token(access_token)
+    if username is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return username
@@ -0,0 +1,191 @@
+import asyncio
+from dataclasses import dataclass
+from typing import AsyncGenerator, AsyncIterator, Awaitable, Callable, Hashable, Optional, TypeVar
+
+from .config import SINGLEFLIGHT_ENABLED, SINGLEFLIGHT_REPLAY_EVENTS, STREAM_QUEUE_MAXSIZE
+
+# =========================================================================
+# Single-flight: peticiones idénticas que llegan a la vez comparten UN cálculo
+# en curso en lugar de lanzar cada una el suyo (la misma pregunta popular
+# desde muchos usuarios, un doble envío del formulario...).
+#   - `SingleFlight`: corrutinas con resultado (llamadas a herramientas).
+#   - `SingleFlightStream`: streams de eventos (respuestas del chat). Un solo
+#     productor reparte cada evento a todos los suscriptores, y un búfer de
+#     repetición acotado pone al día a los que se unen tarde. Si el stream ya
+#     no cabe en el búfer, el recién llegado calcula su propia respuesta.
+# Solo agrupa lo que está EN CURSO: lo ya terminado lo sirven las cachés.
+# =========================================================================
+
+T = TypeVar("T")
+
+
+@dataclass
+class EstadisticasSingleFlight:
+    ejecuciones: int = 0  # Cálculos lanzados
+    agrupadas: int = 0  # Peticiones que se unieron a un cálculo en curso
+    tarde: int = 0  # Llegaron cuando el stream ya no cabía en el búfer de repetición
+    canceladas: int = 0  # Cálculos cancelados porque ya nadie esperaba su resultado
+
+    def as_dict(self) -> dict:
+        return dict(self.__dict__)
+
+
+class _Llamada:
+    def __init__(self, tarea: asyncio.Task):
+        self.tarea = tarea
+        self.esperando = 0
+
+
+class SingleFlight:
+    """Agrupa las llamadas concurrentes con la misma `clave` en una sola ejecución."""
+
+    def __init__(self, activo: bool = True):
+        self.activo = activo
+        self.stats = EstadisticasSingleFlight()
+        self._en_vuelo: dict[Hashable, _Llamada] = {}
+
+    async def ejecutar(self, clave: Hashable, fabrica: Callable[[], Awaitable[T]]) -> T:
+        if not self.activo:
+            return await fabrica()
+        llamada = self._en_vuelo.get(clave)
+        if llamada is None:
+            llamada = self._en_vuelo[clave] = _Llamada(asyncio.create_task(fabrica()))
+            llamada.tarea.add_done_callback(lambda _: self._olvidar(clave, llamada))
+            self.stats.ejecuciones += 1
+        else:
+            self.stats.agrupadas += 1
+        llamada.esperando += 1
+        try:
+            # `shield`: si un llamante se cancela, los demás siguen esperando el resultado
+            return await asyncio.shield(llamada.tarea)
+        finally:
+            llamada.esperando -= 1
+            if llamada.esperando == 0 and not llamada.tarea.done():
+                llamada.tarea.cancel()
+                self.stats.canceladas += 1
+
+    def _olvidar(self, clave: Hashable, llamada: _Llamada) -> None:
+        if self._en_vuelo.get(clave) is llamada:
+            del self._en_vuelo[clave]
+
+    def stats_dict(self) -> dict:
+        return {**self.stats.as_dict(), "en_vuelo": len(self._en_vuelo)}
+
+
+_FIN = object()
+
+
+class _Difusion:
+    """Un stream en curso: su productor, sus suscriptores y el búfer de repetición."""
+
+    def __init__(self, max_repeticion: int, maxsize: int):
+        self.max_repeticion = max_repeticion
+        self.maxsize = maxsize
+        self.repeticion: list = []
+        self.admite_nuevos = True  # False cuando el stream ya no cabe en `repeticion`
+        self.colas: list[asyncio.Queue] = []
+        self.tarea: Optional[asyncio.Task] = None
+
+    def suscribir(self) -> asyncio.Queue:
+        # Sin `await` entre copiar el búfer y registrar la cola: no se pierde ni repite ningún evento
+        cola: asyncio.Queue = asyncio.Queue(maxsize=self.maxsize + len(self.repeticion))
+        for item in self.repeticion:
+            cola.put_nowait(item)
+        self.colas.append(cola)
+        return cola
+
+    async def producir(self, fuente: AsyncIterator) -> None:
+        final = _FIN
+        try:
+            async for item in fuente:
+                if self.admite_nuevos:
+                    self.repeticion.append(item)
+                    if len(self.repeticion) > self.max_repeticion:
+                        self.admite_nuevos = False
+                        self.repeticion = []
+                # Backpressure: el productor va al ritmo del suscriptor más lento
+                for cola in list(self.colas):
+                    if cola in self.colas:
+                        await cola.put(item)
+        except Exception as e:
+            final = e
+        finally:
+            self.admite_nuevos = False
+            aclose = getattr(fuente, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        for cola in list(self.colas):
+            if cola in self.colas:
+                await cola.put(final)
+
+
+class SingleFlightStream:
+    """
+    Ver el comentario del módulo. `suscribir(clave, crear_fuente)` devuelve los
+    eventos del stream de `clave`: el de un cálculo en curso si lo hay (y aún
+    cabe en el búfer), o uno nuevo creado con `crear_fuente()`. El segundo
+    valor indica si esta petición lo lanzó. Cuando se van todos los
+    suscriptores (clientes desconectados), se cancela el productor.
+    """
+
+    def __init__(self, activo: bool = True, max_repeticion: int = SINGLEFLIGHT_REPLAY_EVENTS,
+                 maxsize: int = STREAM_QUEUE_MAXSIZE):
+        self.activo = activo
+        self.max_repeticion = max_repeticion
+        self.maxsize = maxsize
+        self.stats = EstadisticasSingleFlight()
+        self._en_vuelo: dict[Hashable, _Difusion] = {}
+
+    def suscribir(self, clave: Hashable,
+                  crear_fuente: Callable[[], AsyncIterator]) -> tuple[AsyncGenerator, bool]:
+        difusion = self._en_vuelo.get(clave)
+        if difusion is not None and difusion.admite_nuevos:
+            self.stats.agrupadas += 1
+            return self._consumir(difusion, difusion.suscribir()), False
+        if difusion is not None:
+            self.stats.tarde += 1
+
+        difusion = _Difusion(self.max_repeticion, self.maxsize)
+        cola = difusion.suscribir()
+        if self.activo:
+            self._en_vuelo[clave] = difusion
+        difusion.tarea = asyncio.create_task(difusion.producir(crear_fuente()))
+        difusion.tarea.add_done_callback(lambda _: self._olvidar(clave, difusion))
+        self.stats.ejecuciones += 1
+        return self._consumir(difusion, cola), True
+
+    async def _consumir(self, difusion: _Difusion, cola: asyncio.Queue) -> AsyncGenerator:
+        terminado = False
+        try:
+            while True:
+                item = await cola.get()
+                if item is _FIN:
+                    terminado = True
+                    break
+                if isinstance(item, Exception):
+                    terminado = True
+                    raise item
+                yield item
+        finally:
+            difusion.colas.remove(cola)
+            # Vaciar la cola desbloquea al productor si esperaba hueco en ella
+            while not cola.empty():
+                cola.get_nowait()
+            if not difusion.colas and not terminado and not difusion.tarea.done():
+                difusion.tarea.cancel()
+                self.stats.canceladas += 1
+                try:
+                    await difusion.tarea
+                except asyncio.CancelledError:
+                    pass
+
+    def _olvidar(self, clave: Hashable, difusion: _Difusion) -> None:
+        if self._en_vuelo.get(clave) is difusion:
+            del self._en_vuelo[clave]
+
+    def stats_dict(self) -> dict:
+        return {**self.stats.as_dict(), "en_vuelo": len(self._en_vuelo)}
+
+
+vuelos_chat = SingleFlightStream(SINGLEFLIGHT_ENABLED)
+vuelos_herramientas = SingleFlight(SINGLEFLIGHT_ENABLED)
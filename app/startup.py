@@ -0,0 +1,94 @@
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+from .config import (
+    IMPORT_BUDGET_SECONDS,
+    STARTUP_BUDGET_SECONDS,
+    STARTUP_RETRY_INITIAL_SECONDS,
+    STARTUP_RETRY_MAX_SECONDS,
+)
+from .observability import log_evento
+
+
+class EstadoArranque:
+    """
+    Inicializa en paralelo los componentes pesados (base vectorial, LLM,
+    modelo de embeddings...) y lleva la cuenta de cuáles están listos.
+
+    - Liveness: el proceso responde (no depende de este estado).
+    - Readiness: todos los componentes terminaron de inicializarse sin error.
+
+    Los componentes que fallan se reintentan en segundo plano, con espera
+    exponencial, hasta que arrancan: la readiness pasa a 200 cuando lo hacen.
+    """
+
+    def __init__(self):
+        self.componentes: dict[str, dict] = {}
+        self.import_segundos: float = 0.0
+        self.arranque_segundos: float = 0.0
+        self.terminado = False
+
+    @property
+    def listo(self) -> bool:
+        return self.terminado and all(c["listo"] for c in self.componentes.values())
+
+    async def iniciar(self, componentes: dict[str, Callable[[], Awaitable]]) -> None:
+        t0 = time.perf_counter()
+        for nombre in componentes:
+            self.componentes[nombre] = {"listo": False, "segundos": None, "error": None, "intentos": 0}
+        await asyncio.gather(*(self._iniciar_uno(nombre, fabrica) for nombre, fabrica in componentes.items()))
+        self.arranque_segundos = time.perf_counter() - t0
+        self.terminado = True
+        self._informe()
+        await asyncio.gather(*(self._reintentar(nombre, fabrica) for nombre, fabrica in componentes.items()
+                               if not self.componentes[nombre]["listo"]))
+
+    async def _iniciar_uno(self, nombre: str, fabrica: Callable[[], Awaitable]) -> None:
+        estado = self.componentes[nombre]
+        estado["intentos"] += 1
+        t0 = time.perf_counter()
+        try:
+            await fabrica()
+            estado["listo"] = True
+            estado["error"] = None
+        except Exception as e:
+            # Un componente caído no tumba la API: la readiness lo refleja
+            # mientras `_reintentar` sigue intentándolo.
+            estado["error"] = str(e)
+        finally:
+            estado["segundos"] = round(time.perf_counter() - t0, 3)
+
+    async def _reintentar(self, nombre: str, fabrica: Callable[[], Awaitable]) -> None:
+        espera = STARTUP_RETRY_INITIAL_SECONDS
+        while not self.componentes[nombre]["listo"]:
+            await asyncio.sleep(espera)
+            espera = min(espera * 2, STARTUP_RETRY_MAX_SECONDS)
+            await self._iniciar_uno(nombre, fabrica)
+            if self.componentes[nombre]["listo"]:
+                log_evento("arranque.componente_listo", muestrear=False,
+                           componente=nombre, intentos=self.componentes[nombre]["intentos"])
+
+    def _informe(self) -> None:
+        log_evento(
+            "arranque.informe", muestrear=False,
+            import_segundos=round(self.import_segundos, 3),
+            arranque_segundos=round(self.arranque_segundos, 3),
+            componentes={nombre: {"segundos": estado["segundos"], "listo": estado["listo"], "error": estado["error"]}
+                         for nombre, estado in self.componentes.items()},
+        )
+        if self.import_segundos > IMPORT_BUDGET_SECONDS:
+            log_evento("arranque.import_fuera_de_presupuesto", logging.WARNING,
+                       segundos=round(self.import_segundos, 3), presupuesto=IMPORT_BUDGET_SECONDS)
+        if self.arranque_segundos > STARTUP_BUDGET_SECONDS:
+            log_evento("arranque.inicializacion_fuera_de_presupuesto", logging.WARNING,
+                       segundos=round(self.arranque_segundos, 3), presupuesto=STARTUP_BUDGET_SECONDS)
+
+    def as_dict(self) -> dict:
+        return {
+            "listo": self.listo,
+            "import_segundos": round(self.import_segundos, 3),
+            "arranque_segundos": round(self.arranque_segundos, 3) if self.terminado else None,
+            "componentes": self.componentes,
+        }
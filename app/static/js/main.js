@@ -27,6 +27,17 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 
+    // --- RESPUESTAS "OCUPADO" DEL SERVIDOR ---
+    // htmx no inserta por defecto las respuestas 429/503; el servidor las
+    // manda como un mensaje del bot listo para mostrar.
+    document.body.addEventListener('htmx:beforeSwap', function(event) {
+        const status = event.detail.xhr.status;
+        if (status === 429 || status === 503) {
+            event.detail.shouldSwap = true;
+            event.detail.isError = false;
+        }
+    });
+
     // --- LÓGICA DEL BOTÓN FLOTANTE (FAB) ---
     const chatFab = document.getElementById('chat-fab');
     const chatWindow = document.getElementById('chat-window');
@@ -0,0 +1,61 @@
+import asyncio
+from dataclasses import dataclass
+from typing import AsyncGenerator, AsyncIterator
+
+from .config import STREAM_QUEUE_MAXSIZE
+
+
+@dataclass
+class EventoChat:
+    """
+    Unidad mínima que viaja desde el agente hasta la respuesta HTTP.
+    - tipo="token":  fragmento de la respuesta final del LLM.
+    - tipo="estado": aviso de progreso (p. ej. "Consultando pólizas…").
+    """
+    tipo: str
+    contenido: str
+
+
+_FIN = object()
+
+
+async def stream_con_backpressure(fuente: AsyncIterator, maxsize: int = STREAM_QUEUE_MAXSIZE) -> AsyncGenerator:
+    """
+    Desacopla el productor (el agente) del consumidor (el cliente HTTP) con una
+    cola acotada. Si el cliente lee más lento, la cola se llena y el productor
+    queda bloqueado en `put` (backpressure) en vez de acumular memoria.
+
+    Si el consumidor se cierra o se cancela (el cliente se desconectó), se
+    cancela la tarea productora y se cierra la fuente, lo que aborta la
+    llamada en curso al LLM o a las herramientas.
+    """
+    cola: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+
+    async def productor():
+        # Si nos cancelan, CancelledError se propaga sin tocar la cola: nadie la leerá.
+        try:
+            async for item in fuente:
+                await cola.put(item)
+        except Exception as e:
+            await cola.put(e)
+        await cola.put(_FIN)
+
+    tarea = asyncio.create_task(productor())
+    try:
+        while True:
+            item = await cola.get()
+            if item is _FIN:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        if not tarea.done():
+            tarea.cancel()
+            try:
+                await tarea
+            except asyncio.CancelledError:
+                pass
+        aclose = getattr(fuente, "aclose", None)
+        if aclose is not None:
+            await aclose()
@@ -0,0 +1,28 @@
+import re
+
+# Estimación rápida de tokens sin llamar a la API de Gemini (count_tokens es
+# una petición de red). Para español, ~4 caracteres por token es una buena
+# aproximación; se usa para PRESUPUESTAR el prompt, no para facturar.
+_CARACTERES_POR_TOKEN = 4
+_PALABRA = re.compile(r"\S+")
+
+
+def estimar_tokens(texto: str) -> int:
+    if not texto:
+        return 0
+    return max(len(_PALABRA.findall(texto)), len(texto) // _CARACTERES_POR_TOKEN)
+
+
+def tokens_de_mensajes(mensajes) -> int:
+    """Tokens estimados de una lista de mensajes de LangChain (contenido + ~4 de rol/formato)."""
+    return sum(estimar_tokens(m.content if isinstance(m.content, str) else str(m.content)) + 4
+               for m in mensajes)
+
+
+def recortar_a_tokens(texto: str, max_tokens: int) -> str:
+    """Corta `texto` para que no supere `max_tokens`, sin partir palabras."""
+    if estimar_tokens(texto) <= max_tokens:
+        return texto
+    recortado = texto[:max_tokens * _CARACTERES_POR_TOKEN]
+    espacio = recortado.rfind(" ")
+    return (recortado[:espacio] if espacio > 0 else recortado).rstrip() + "…"
@@ -0,0 +1,163 @@
+import time
+import asyncio
+from abc import ABC, abstractmethod
+
+import chromadb
+
+from .config import (
+    VECTOR_STORE_BACKEND,
+    CHROMA_HOST,
+    CHROMA_PORT,
+    CHROMA_COLLECTION,
+    CHROMA_PERSIST_DIR,
+    CHROMA_VERSION_CHECK_SECONDS,
+    VECTOR_INDEX_DIR,
+)
+from .embeddings import embed_textos
+from .executors import run_blocking
+from .numpy_index import NumpyIndexCargador
+from .observability import log_evento
+
+
+class VectorStore(ABC):
+    """
+    Interfaz común de los backends vectoriales. `query` recibe los mismos
+    argumentos que `collection.query` de ChromaDB (`query_embeddings` o
+    `query_texts`, `n_results`, `where`) y devuelve un dict con la misma forma
+    (`ids`, `documents`, `metadatas`, `distances`).
+
+    `version()` devuelve la versión del índice publicada por la ingesta y la
+    relee como mucho cada CHROMA_VERSION_CHECK_SECONDS.
+    """
+
+    def __init__(self):
+        self._version = None
+        self._version_leida = 0.0
+
+    @abstractmethod
+    async def query(self, n_results: int = 3, **kwargs) -> dict:
+        ...
+
+    @abstractmethod
+    async def _leer_version(self) -> str:
+        ...
+
+    async def version(self) -> str:
+        ahora = time.monotonic()
+        if self._version is None or ahora - self._version_leida >= CHROMA_VERSION_CHECK_SECONDS:
+            self._version = await self._leer_version()
+            self._version_leida = ahora
+        return self._version
+
+
+class AsyncChromaStore(VectorStore):
+    """
+    Acceso asíncrono a la colección de pólizas en el servicio ChromaDB.
+
+    Usa `chromadb.AsyncHttpClient`, que mantiene un pool de conexiones HTTP
+    (httpx) reutilizado por todas las consultas del proceso. La conexión se
+    abre de forma perezosa en la primera consulta, así que importar el módulo
+    no requiere que ChromaDB esté levantado.
+    """
+
+    def __init__(self, host: str = CHROMA_HOST, port: int = CHROMA_PORT,
+                 collection_name: str = CHROMA_COLLECTION):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.collection_name = collection_name
+        self._client = None
+        self._collection = None
+        self._lock = asyncio.Lock()
+
+    async def get_collection(self):
+        if self._collection is None:
+            async with self._lock:
+                if self._collection is None:
+                    self._client = await chromadb.AsyncHttpClient(host=self.host, port=self.port)
+                    self._collection = await self._client.get_collection(self.collection_name)
+                    log_evento("chromadb.conectada", muestrear=False, host=self.host, port=self.port)
+        return self._collection
+
+    async def query(self, n_results: int = 3, **kwargs) -> dict:
+        """Reenvía a `collection.query` (`query_texts` o `query_embeddings`, `where`...)."""
+        collection = await self.get_collection()
+        return await collection.query(n_results=n_results, **kwargs)
+
+    async def _leer_version(self) -> str:
+        await self.get_collection()
+        # Pedimos la colección de nuevo: el objeto cacheado guarda los metadatos antiguos.
+        collection = await self._client.get_collection(self.collection_name)
+        return str((collection.metadata or {}).get("version", "0"))
+
+
+class PersistentChromaStore(VectorStore):
+    """
+    ChromaDB embebido en el propio proceso (`PersistentClient`), sin red.
+    Requiere el paquete completo `chromadb` (no solo `chromadb-client`).
+    Sus llamadas son síncronas, así que corren en el pool acotado.
+    """
+
+    def __init__(self, path: str = CHROMA_PERSIST_DIR, collection_name: str = CHROMA_COLLECTION):
+        super().__init__()
+        self.path = path
+        self.collection_name = collection_name
+        self._client = None
+
+    def _get_collection(self):
+        if self._client is None:
+            self._client = chromadb.PersistentClient(path=self.path)
+            log_evento("chromadb.embebido_abierto", muestrear=False, ruta=self.path)
+        return self._client.get_collection(self.collection_name)
+
+    async def query(self, n_results: int = 3, **kwargs) -> dict:
+        collection = await run_blocking(self._get_collection)
+        return await run_blocking(collection.query, n_results=n_results, **kwargs)
+
+    async def _leer_version(self) -> str:
+        collection = await run_blocking(self._get_collection)
+        return str((collection.metadata or {}).get("version", "0"))
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    Índice plano/IVF en NumPy mapeado en memoria (ver `numpy_index`). Se carga
+    en caliente al arrancar y responde en microsegundos sobre el corpus de
+    pólizas; no necesita ningún servicio externo, ideal para pruebas offline.
+    """
+
+    def __init__(self, directorio: str = VECTOR_INDEX_DIR):
+        super().__init__()
+        self.cargador = NumpyIndexCargador(directorio)
+
+    async def query(self, n_results: int = 3, query_embeddings=None, query_texts=None,
+                    where=None, **kwargs) -> dict:
+        if query_embeddings is None:
+            query_embeddings = await embed_textos(query_texts)
+        # Búsqueda en memoria: sub-milisegundo para este corpus, no merece un salto de hilo
+        # (la carga del índice sí, y `aobtener` la hace en el pool).
+        indice = await self.cargador.aobtener()
+        vecinos = indice.buscar(query_embeddings, n_results, where)
+        return {
+            "ids": [[indice.ids[f] for f, _ in v] for v in vecinos],
+            "documents": [[indice.textos[f] for f, _ in v] for v in vecinos],
+            "metadatas": [[indice.metadatas[f] for f, _ in v] for v in vecinos],
+            "distances": [[d for _, d in v] for v in vecinos],
+        }
+
+    async def _leer_version(self) -> str:
+        return str((await self.cargador.aobtener()).metadata.get("version", "0"))
+
+
+def crear_vector_store(backend: str = VECTOR_STORE_BACKEND) -> VectorStore:
+    """Devuelve el backend vectorial indicado en VECTOR_STORE_BACKEND."""
+    if backend == "http":
+        return AsyncChromaStore()
+    if backend == "persistent":
+        if getattr(chromadb, "is_thin_client", False):
+            raise RuntimeError("VECTOR_STORE_BACKEND=persistent requiere el paquete completo 'chromadb' "
+                               "(pip install chromadb); 'chromadb-client' solo trae el cliente HTTP")
+        return PersistentChromaStore()
+    if backend == "numpy":
+        return NumpyVectorStore()
+    raise ValueError(f"VECTOR_STORE_BACKEND desconocido: '{backend}' (usa http, persistent o numpy)")
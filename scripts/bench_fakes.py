@@ -0,0 +1,146 @@
+# bench_fakes.py - Dobles deterministas para medir la app sin red
+#
+# Sustituyen a los servicios externos (Gemini y el modelo de embeddings) por
+# versiones locales con latencias configurables, de modo que
+# `scripts/benchmark.py` mida el código de la app y no la red. Para las
+# noticias se usa el backend local de la propia app (NEWS_SEARCH_BACKEND=local).
+#   - FakeChatModel: modelo de chat con streaming a N tokens/s y llamadas a
+#     herramientas deterministas según la pregunta.
+#   - embedding_hash: embeddings por "feature hashing" (misma forma que MiniLM).
+
+import json
+import time
+import asyncio
+import zlib
+from typing import Any, AsyncIterator, Iterator, Optional
+
+import numpy as np
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+DIMENSIONES_EMBEDDING = 384  # Las de all-MiniLM-L6-v2
+
+
+def embedding_hash(lote: list[str]) -> np.ndarray:
+    """Bolsa de palabras con hashing (crc32) y normalización L2: determinista y sin modelo."""
+    vectores = np.zeros((len(lote), DIMENSIONES_EMBEDDING), dtype=np.float32)
+    for fila, texto in enumerate(lote):
+        for palabra in texto.lower().split():
+            h = zlib.crc32(palabra.encode("utf-8"))
+            vectores[fila, h % DIMENSIONES_EMBEDDING] += 1.0 if (h >> 16) & 1 else -1.0
+    vectores /= np.clip(np.linalg.norm(vectores, axis=1, keepdims=True), 1e-12, None)
+    return vectores
+
+
+def instalar_embeddings_falsos(modelo) -> None:
+    """Hace que el `OnnxEmbeddingModel` de la app use `embedding_hash` (conserva sus estadísticas)."""
+    modelo.cargar = lambda: None
+    modelo._pasada = embedding_hash
+
+
+def _texto(mensaje: BaseMessage) -> str:
+    return mensaje.content if isinstance(mensaje.content, str) else str(mensaje.content)
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Modelo de chat determinista que imita a Gemini en lo que importa para el rendimiento:
+    - Tiempo hasta el primer token (`primer_token_ms`) y ritmo de generación (`tokens_por_segundo`).
+    - Llamadas a herramientas: si tiene herramientas enlazadas y el último mensaje es del
+      usuario, pide `buscar_noticias_del_sector` para "noticias", el recombinador para
+      "combina/fusiona" y `ConsultaPDF` para el resto (salvo `usar_herramientas=False`).
+      Tras el resultado de la herramienta, responde resumiendo ese resultado.
+    - Informa de `usage_metadata` (tokens de entrada estimados).
+    """
+
+    tokens_por_segundo: float = 200.0
+    primer_token_ms: float = 300.0
+    usar_herramientas: bool = True
+    palabras_respuesta: int = 60
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-benchmark"
+
+    def bind_tools(self, tools, **kwargs):
+        return self.bind(tools=[convert_to_openai_tool(t) for t in tools], **kwargs)
+
+    # --- Decisión determinista ---
+    def _plan(self, mensajes: list[BaseMessage], tools: Optional[list]) -> tuple[str, Optional[dict]]:
+        ultimo = mensajes[-1] if mensajes else HumanMessage(content="")
+        nombres = {t["function"]["name"] for t in tools or []}
+        if isinstance(ultimo, HumanMessage) and nombres and self.usar_herramientas:
+            pregunta = _texto(ultimo)
+            minusculas = pregunta.lower()
+            if "noticia" in minusculas and "buscar_noticias_del_sector" in nombres:
+                nombre = "buscar_noticias_del_sector"
+            elif ("combina" in minusculas or "fusiona" in minusculas) and "crear_nueva_cobertura_combinada" in nombres:
+                nombre = "crear_nueva_cobertura_combinada"
+            else:
+                nombre = "ConsultaPDF"
+            id_llamada = f"call_{zlib.crc32(pregunta.encode('utf-8')):08x}"
+            return "", {"name": nombre, "args": {"__arg1": pregunta}, "id": id_llamada}
+        fuente = _texto(ultimo) if isinstance(ultimo, ToolMessage) else " ".join(_texto(m) for m in mensajes[-2:])
+        palabras = (fuente.split() or ["Entendido."])
+        respuesta = " ".join((palabras * (self.palabras_respuesta // len(palabras) + 1))[:self.palabras_respuesta])
+        return respuesta, None
+
+    def _uso(self, mensajes: list[BaseMessage], respuesta: str) -> dict:
+        entrada = sum(len(_texto(m)) for m in mensajes) // 4
+        salida = len(respuesta) // 4
+        return {"input_tokens": entrada, "output_tokens": salida, "total_tokens": entrada + salida}
+
+    def _fragmentos(self, respuesta: str) -> list[str]:
+        palabras = respuesta.split(" ")
+        return [p if i == 0 else " " + p for i, p in enumerate(palabras)]
+
+    # --- Generación ---
+    def _generate(self, messages: list[BaseMessage], stop=None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        respuesta, llamada = self._plan(messages, kwargs.get("tools"))
+        time.sleep(self.primer_token_ms / 1000 + len(self._fragmentos(respuesta)) / self.tokens_por_segundo)
+        mensaje = AIMessage(content=respuesta, tool_calls=[llamada] if llamada else [],
+                            usage_metadata=self._uso(messages, respuesta))
+        return ChatResult(generations=[ChatGeneration(message=mensaje)])
+
+    def _stream(self, messages: list[BaseMessage], stop=None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        for chunk in self._chunks(messages, kwargs.get("tools")):
+            time.sleep(chunk[1])
+            yield chunk[0]
+
+    async def _astream(self, messages: list[BaseMessage], stop=None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        for chunk, espera in self._chunks(messages, kwargs.get("tools")):
+            await asyncio.sleep(espera)
+            yield chunk
+
+    async def _agenerate(self, messages: list[BaseMessage], stop=None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        final = None
+        async for chunk in self._astream(messages, stop, run_manager, **kwargs):
+            final = chunk if final is None else final + chunk
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(
+            content=final.message.content, tool_calls=final.message.tool_calls,
+            usage_metadata=final.message.usage_metadata))])
+
+    def _chunks(self, messages: list[BaseMessage], tools: Optional[list]) -> list[tuple[ChatGenerationChunk, float]]:
+        respuesta, llamada = self._plan(messages, tools)
+        if llamada:
+            chunk = AIMessageChunk(content="", tool_call_chunks=[{
+                "name": llamada["name"], "args": json.dumps(llamada["args"], ensure_ascii=False),
+                "id": llamada["id"], "index": 0,
+            }], usage_metadata=self._uso(messages, ""))
+            return [(ChatGenerationChunk(message=chunk), self.primer_token_ms / 1000)]
+        fragmentos = self._fragmentos(respuesta)
+        salida = []
+        for i, fragmento in enumerate(fragmentos):
+            espera = self.primer_token_ms / 1000 if i == 0 else 1 / self.tokens_por_segundo
+            uso = self._uso(messages, respuesta) if i == len(fragmentos) - 1 else None
+            salida.append((ChatGenerationChunk(message=AIMessageChunk(content=fragmento, usage_metadata=uso)), espera))
+        return salida
+
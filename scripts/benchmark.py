@@ -0,0 +1,440 @@
+# benchmark.py - Prueba de carga offline de la API (sin Gemini ni ChromaDB)
+#
+# Levanta la app FastAPI EN EL MISMO PROCESO con dobles deterministas
+# (`bench_fakes.py`): modelo de chat con ritmo de tokens configurable,
+# embeddings por hashing, búsqueda de noticias simulada e índice vectorial
+# NumPy construido con la ingesta real a partir de `data/*.pdf`.
+#
+# Lanza peticiones concurrentes a /register, /login y /api/chat a través de
+# un cliente ASGI (sin sockets) y mide, por endpoint, p50/p95/p99 del tiempo
+# hasta el primer byte (TTFB) y del tiempo total, peticiones por segundo y el
+# retraso del event loop mientras dura la carga, más el tiempo medio por
+# etapa (recuperación, herramientas, LLM...) que publica la app en /metrics.
+#
+# Después mide la búsqueda vectorial sobre réplicas sintéticas del corpus de
+# distintos tamaños (--escalado): sin filtro, filtrada por una póliza sobre la
+# matriz completa y con el sub-índice de la póliza.
+#
+# Uso:
+#   python scripts/benchmark.py                                # informe en consola
+#   python scripts/benchmark.py --guardar-baseline scripts/benchmark_baseline.json
+#   python scripts/benchmark.py --comparar scripts/benchmark_baseline.json  # sale con 1 si hay regresión
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import tempfile
+from collections import defaultdict
+from datetime import datetime, timezone
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+sys.path.insert(0, PROJECT_ROOT)
+sys.path.insert(0, SCRIPT_DIR)
+
+PREGUNTAS_POLIZA = [
+    "¿Qué cubre la póliza de hospitalización?",
+    "¿Cuál es el plazo para solicitar un reembolso?",
+    "¿Qué exclusiones tiene el seguro de salud?",
+    "¿Cómo se calcula el deducible anual?",
+    "¿La póliza cubre urgencias en el extranjero?",
+    "¿Qué dice el artículo 2 sobre la cobertura?",
+    "¿Quiénes pueden ser asegurados dependientes?",
+    "¿Cuándo termina la vigencia del contrato?",
+    "¿Qué dice el artículo 6 de la POL320190074?",
+    "¿Qué exclusiones tiene la POL320210063?",
+]
+PREGUNTAS_NOTICIAS = ["Dame noticias sobre seguros de salud", "¿Qué noticias hay del sector asegurador?"]
+PREGUNTAS_COMBINAR = ["Combina la cobertura de hospitalización y la ambulatoria"]
+
+
+def percentiles(valores: list[float]) -> dict:
+    if not valores:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+    ordenados = sorted(valores)
+    def p(q):
+        return round(ordenados[min(len(ordenados) - 1, int(q * len(ordenados)))] * 1000, 1)
+    return {"p50": p(0.50), "p95": p(0.95), "p99": p(0.99), "max": round(ordenados[-1] * 1000, 1)}
+
+
+# --- Preparación del entorno ---
+def preparar_entorno(args, directorio: str) -> None:
+    """Variables de entorno de la app ANTES de importarla: todo en un directorio temporal."""
+    os.environ.update({
+        "VECTOR_STORE_BACKEND": "numpy",
+        "VECTOR_INDEX_DIR": os.path.join(directorio, "vector_index"),
+        "BM25_INDEX_DIR": os.path.join(directorio, "bm25"),
+        "ARTICLE_INDEX_DIR": os.path.join(directorio, "articles"),
+        "INGEST_MANIFEST": os.path.join(directorio, "ingest_manifest.json"),
+        "DATABASE_URL": f"sqlite+aiosqlite:///{os.path.join(directorio, 'bench.db')}",
+        "GOOGLE_API_KEY": "benchmark",
+        "ANSWER_CACHE_ENABLED": "false" if args.sin_cache else "true",
+        # Búsqueda de noticias: backend local de la app, con la latencia pedida
+        "NEWS_SEARCH_BACKEND": "local",
+        "NEWS_SEARCH_LOCAL_LATENCY_MS": str(args.noticias_ms),
+        "NEWS_SEARCH_CACHE_TTL_SECONDS": "0" if args.sin_cache else "900",
+        "CHROMA_VERSION_CHECK_SECONDS": "3600",
+    })
+    if not args.con_limites:
+        # Se mide la app, no el limitador: límites muy por encima de la carga generada.
+        os.environ.update({
+            "RATE_LIMIT_USER_PER_SECOND": "100000", "RATE_LIMIT_USER_BURST": "100000",
+            "RATE_LIMIT_GLOBAL_PER_SECOND": "100000", "RATE_LIMIT_GLOBAL_BURST": "100000",
+            "ADMISSION_MAX_PER_USER": "1000", "ADMISSION_MAX_IN_FLIGHT": str(max(16, args.concurrencia)),
+        })
+
+
+def instalar_fakes(args):
+    import bench_fakes
+    from app import chatbot_logic
+    from app.embeddings import modelo_embeddings
+
+    bench_fakes.instalar_embeddings_falsos(modelo_embeddings)
+    chatbot_logic.crear_llm = lambda: bench_fakes.FakeChatModel(
+        tokens_por_segundo=args.tokens_por_segundo,
+        primer_token_ms=args.primer_token_ms,
+        usar_herramientas=not args.sin_herramientas,
+    )
+
+
+def construir_indice() -> None:
+    """Indexa `data/*.pdf` con la ingesta real (backend NumPy + embeddings falsos)."""
+    import ingest_data
+    ingest_data.construir_y_guardar_vector_index(completo=True, workers=2)
+
+
+# --- Cliente ASGI con medición de TTFB ---
+async def peticion(app, metodo: str, ruta: str, cuerpo: dict = None, cookie: str = None) -> dict:
+    """
+    Llama a la app ASGI directamente (sin red). Devuelve status, cabeceras,
+    cuerpo, TTFB (primer fragmento no vacío del cuerpo), TTFT (primer fragmento
+    de texto, es decir, el primer token de la respuesta y no el HTML que la
+    envuelve ni los avisos de estado) y tiempo total.
+    """
+    datos = json.dumps(cuerpo).encode() if cuerpo is not None else b""
+    cabeceras = [(b"host", b"bench"), (b"content-type", b"application/json"),
+                 (b"content-length", str(len(datos)).encode())]
+    if cookie:
+        cabeceras.append((b"cookie", cookie.encode()))
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": metodo,
+        "scheme": "http", "path": ruta, "raw_path": ruta.encode(), "query_string": b"",
+        "root_path": "", "headers": cabeceras, "client": ("127.0.0.1", 50000), "server": ("bench", 80),
+    }
+    terminado = asyncio.Event()
+    enviado = False
+    resultado = {"status": 0, "headers": {}, "cuerpo": b"", "ttfb": None, "ttft": None}
+
+    async def receive():
+        nonlocal enviado
+        if not enviado:
+            enviado = True
+            return {"type": "http.request", "body": datos, "more_body": False}
+        await terminado.wait()
+        return {"type": "http.disconnect"}
+
+    t0 = time.perf_counter()
+
+    async def send(mensaje):
+        if mensaje["type"] == "http.response.start":
+            resultado["status"] = mensaje["status"]
+            resultado["headers"] = {k.decode().lower(): v.decode() for k, v in mensaje.get("headers", [])}
+        elif mensaje["type"] == "http.response.body":
+            cuerpo = mensaje.get("body", b"")
+            if cuerpo and resultado["ttfb"] is None:
+                resultado["ttfb"] = time.perf_counter() - t0
+            if cuerpo and resultado["ttft"] is None and not cuerpo.lstrip().startswith(b"<"):
+                resultado["ttft"] = time.perf_counter() - t0
+            resultado["cuerpo"] += mensaje.get("body", b"")
+            if not mensaje.get("more_body", False):
+                terminado.set()
+
+    await app(scope, receive, send)
+    resultado["total"] = time.perf_counter() - t0
+    for clave in ("ttfb", "ttft"):
+        if resultado[clave] is None:
+            resultado[clave] = resultado["total"]
+    return resultado
+
+
+# --- Retraso del event loop ---
+class MonitorEventLoop:
+    """Duerme `intervalo` y mide cuánto tarda de más en despertar: lo que el loop estuvo bloqueado."""
+
+    def __init__(self, intervalo: float = 0.01):
+        self.intervalo = intervalo
+        self.retrasos: list[float] = []
+        self._tarea = None
+
+    async def _bucle(self):
+        while True:
+            t0 = time.perf_counter()
+            await asyncio.sleep(self.intervalo)
+            self.retrasos.append(max(0.0, time.perf_counter() - t0 - self.intervalo))
+
+    def iniciar(self):
+        self._tarea = asyncio.create_task(self._bucle())
+
+    async def detener(self):
+        self._tarea.cancel()
+        try:
+            await self._tarea
+        except asyncio.CancelledError:
+            pass
+
+
+def etapas_de_metricas(texto: str) -> dict:
+    """Media por etapa a partir de `chatbot_stage_duration_seconds` (_sum/_count) del /metrics de la app."""
+    sumas, cuentas = {}, {}
+    for linea in texto.splitlines():
+        encontrado = re.match(r'chatbot_stage_duration_seconds_(sum|count)\{stage="([^"]+)"\} (\S+)', linea)
+        if encontrado:
+            tipo, etapa, valor = encontrado.groups()
+            (sumas if tipo == "sum" else cuentas)[etapa] = float(valor)
+    return {
+        etapa: {"n": int(cuentas[etapa]), "media_ms": round(sumas.get(etapa, 0.0) / cuentas[etapa] * 1000, 1)}
+        for etapa in sorted(cuentas) if cuentas[etapa]
+    }
+
+
+# --- Latencia de recuperación según el tamaño del corpus ---
+def medir_escalado(tamanos: list[int], consultas: int = 200, chunks_por_poliza: int = 30,
+                   semilla: int = 42) -> list[dict]:
+    """
+    Replica el corpus indexado (los mismos chunks con ruido en sus embeddings,
+    repartidos en pólizas ficticias de `chunks_por_poliza` chunks) a cada
+    tamaño, con la ingesta del backend NumPy (IVF a partir de IVF_MIN_VECTORS).
+    Mide la búsqueda top-3 sin filtro, con filtro de una póliza sobre la
+    matriz completa (máscara) y con el sub-índice de esa póliza.
+    """
+    import numpy as np
+    from app.config import VECTOR_INDEX_DIR
+    from app.numpy_index import NumpyCollection, NumpyIndex
+
+    base = NumpyIndex(VECTOR_INDEX_DIR)
+    embeddings = np.asarray(base.embeddings)
+    rng = np.random.default_rng(semilla)
+    vectores_consulta = embeddings[rng.integers(0, len(base), consultas)]
+
+    def medir(indice, where, particionar: bool) -> dict:
+        indice.particionar = particionar
+        indice.buscar(vectores_consulta[0], 3, where)  # Calienta la máscara del filtro
+        tiempos = []
+        for q in vectores_consulta:
+            t0 = time.perf_counter()
+            indice.buscar(q, 3, where)
+            tiempos.append((time.perf_counter() - t0) * 1000)
+        tiempos.sort()
+        return {"p50": round(tiempos[len(tiempos) // 2], 3), "p95": round(tiempos[int(len(tiempos) * 0.95)], 3)}
+
+    filas = []
+    for n in tamanos:
+        origen = rng.integers(0, len(base), n)
+        ruido = rng.normal(0, 0.05, (n, embeddings.shape[1])).astype(np.float32)
+        polizas = [f"POL9{i // chunks_por_poliza:08d}" for i in range(n)]
+        with tempfile.TemporaryDirectory(prefix="escalado_") as directorio:
+            coleccion = NumpyCollection(directorio)
+            coleccion.upsert([f"c{i}" for i in range(n)], [base.textos[o] for o in origen],
+                             [{"poliza": p} for p in polizas], embeddings[origen] + ruido)
+            coleccion.guardar()
+            indice = NumpyIndex(directorio)
+            filtro = {"poliza": polizas[n // 2]}
+            filas.append({
+                "chunks": n,
+                "polizas": len(indice.particiones),
+                "indice": "IVF" if indice.centroides is not None else "plano",
+                "global_ms": medir(indice, None, True),
+                "mascara_ms": medir(indice, filtro, False),
+                "subindice_ms": medir(indice, filtro, True),
+            })
+    return filas
+
+
+# --- Escenario de carga ---
+async def ejecutar(args) -> dict:
+    from app.main import app, estado_arranque
+
+    medidas: dict[str, list[dict]] = defaultdict(list)
+    rng = random.Random(args.semilla)
+
+    async with app.router.lifespan_context(app):
+        # Esperamos a que todos los componentes estén listos (readiness)
+        while not estado_arranque.terminado:
+            await asyncio.sleep(0.05)
+        if not estado_arranque.listo:
+            raise RuntimeError(f"La app no arrancó bien: {estado_arranque.as_dict()}")
+
+        # 1. Alta y login de los usuarios (también se miden)
+        cookies = {}
+
+        async def alta_y_login(n: int):
+            usuario = {"username": f"bench_{n}", "password": f"clave-{n}"}
+            r = await peticion(app, "POST", "/register", usuario)
+            medidas["register"].append(r)
+            r = await peticion(app, "POST", "/login", usuario)
+            medidas["login"].append(r)
+            # Se reenvía tal cual, como haría el navegador
+            cookies[n] = r["headers"].get("set-cookie", "").split(";")[0]
+            if n % 5 == 0:
+                # Algunos usuarios tienen "mis pólizas": sus búsquedas se acotan a ellas
+                await peticion(app, "PUT", "/api/me/policies", {"polizas": ["POL320190074"]}, cookies[n])
+
+        monitor = MonitorEventLoop()
+        monitor.iniciar()
+        t_inicio = time.perf_counter()
+        await asyncio.gather(*(alta_y_login(n) for n in range(args.usuarios)))
+
+        # 2. Conversaciones concurrentes
+        mezcla = (PREGUNTAS_POLIZA * 8 + PREGUNTAS_NOTICIAS * args.peso_noticias
+                  + PREGUNTAS_COMBINAR * args.peso_combinar)
+        trabajos = [(rng.randrange(args.usuarios), rng.choice(mezcla)) for _ in range(args.peticiones)]
+        semaforo = asyncio.Semaphore(args.concurrencia)
+
+        async def chat(usuario: int, pregunta: str):
+            async with semaforo:
+                r = await peticion(app, "POST", "/api/chat", {"question": pregunta}, cookies.get(usuario))
+                medidas["chat"].append(r)
+
+        t_chat = time.perf_counter()
+        await asyncio.gather(*(chat(u, p) for u, p in trabajos))
+        fin = time.perf_counter()
+        await monitor.detener()
+        metricas = await peticion(app, "GET", "/metrics")
+        prefetch = await peticion(app, "GET", "/api/prefetch/stats")
+        singleflight = await peticion(app, "GET", "/api/singleflight/stats")
+        alcance = await peticion(app, "GET", "/api/scope/stats")
+
+    informe = {
+        "fecha": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "entorno": {"python": platform.python_version(), "plataforma": platform.platform(),
+                    "cpus": os.cpu_count()},
+        "parametros": {k: v for k, v in vars(args).items() if k not in ("guardar_baseline", "comparar")},
+        "duracion_s": round(fin - t_inicio, 2),
+        "rps_chat": round(len(medidas["chat"]) / (fin - t_chat), 2) if fin > t_chat else 0.0,
+        "event_loop_lag_ms": percentiles(monitor.retrasos),
+        "etapas": etapas_de_metricas(metricas["cuerpo"].decode("utf-8")),
+        "prefetch": json.loads(prefetch["cuerpo"]),
+        "singleflight": json.loads(singleflight["cuerpo"]),
+        "alcance": json.loads(alcance["cuerpo"]),
+        "endpoints": {},
+    }
+    for endpoint, lista in medidas.items():
+        estados = defaultdict(int)
+        for r in lista:
+            estados[str(r["status"])] += 1
+        informe["endpoints"][endpoint] = {
+            "n": len(lista),
+            "estados": dict(estados),
+            "ttfb_ms": percentiles([r["ttfb"] for r in lista]),
+            "ttft_ms": percentiles([r["ttft"] for r in lista]),
+            "total_ms": percentiles([r["total"] for r in lista]),
+        }
+    return informe
+
+
+def imprimir(informe: dict) -> None:
+    print(f"\n📊 Benchmark ({informe['duracion_s']}s, {informe['rps_chat']} peticiones/s de chat)")
+    print(f"{'endpoint':<10}{'n':>6}  {'métrica':<8}{'p50':>10}{'p95':>10}{'p99':>10}  (ms)")
+    for endpoint, datos in informe["endpoints"].items():
+        for metrica in ("ttfb", "ttft", "total"):
+            v = datos[f"{metrica}_ms"]
+            cabeza = f"{endpoint:<10}{datos['n']:>6}" if metrica == "ttfb" else " " * 16
+            print(f"{cabeza}  {metrica:<8}{v['p50']:>10}{v['p95']:>10}{v['p99']:>10}")
+        print(f"{'':<16}  estados: {datos['estados']}")
+    lag = informe["event_loop_lag_ms"]
+    print(f"⏱️ Retraso del event loop: p50 {lag['p50']} ms, p99 {lag['p99']} ms, máx {lag['max']} ms")
+    if informe.get("etapas"):
+        print("🔬 Tiempo medio por etapa (de /metrics):")
+        for etapa, datos in informe["etapas"].items():
+            print(f"   {etapa:<40}{datos['n']:>6}  {datos['media_ms']:>9} ms")
+    prefetch = informe.get("prefetch")
+    if prefetch and prefetch["lanzados"]:
+        print(f"🔮 Búsqueda adelantada: {prefetch['lanzados']} lanzadas, acierto {prefetch['tasa_acierto']:.0%}, "
+              f"desperdicio {prefetch['tasa_desperdicio']:.0%}, {prefetch['ms_ocultos']} ms ocultos")
+    alcance = informe.get("alcance")
+    if alcance:
+        print(f"🎯 Alcance por póliza: {alcance['por_origen']}, {alcance['sin_alcance']} turnos sin alcance, "
+              f"{alcance['sin_resultados']} de {alcance['busquedas_acotadas']} búsquedas acotadas sin resultados")
+    singleflight = informe.get("singleflight")
+    if singleflight:
+        print("🪁 Single-flight: " + "; ".join(
+            f"{tipo} {datos['ejecuciones']} lanzados, {datos['agrupadas']} agrupados"
+            for tipo, datos in singleflight.items()))
+    if informe.get("escalado"):
+        print("📈 Búsqueda vectorial top-3 según el tamaño del corpus (p50 / p95 en ms):")
+        print(f"   {'chunks':>8}{'pólizas':>9}  {'índice':<7}{'global':>18}{'1 póliza (máscara)':>22}"
+              f"{'1 póliza (sub-índice)':>24}")
+        for fila in informe["escalado"]:
+            celdas = [f"{fila[c]['p50']} / {fila[c]['p95']}" for c in ("global_ms", "mascara_ms", "subindice_ms")]
+            print(f"   {fila['chunks']:>8}{fila['polizas']:>9}  {fila['indice']:<7}{celdas[0]:>18}"
+                  f"{celdas[1]:>22}{celdas[2]:>24}")
+
+
+def comparar(informe: dict, ruta_baseline: str, tolerancia: float) -> bool:
+    """Compara p95 (primer token y total) y RPS con el baseline. Devuelve True si no hay regresiones."""
+    with open(ruta_baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    ok = True
+    print(f"\n🔁 Comparación con {ruta_baseline} (tolerancia {tolerancia:.0%})")
+    for endpoint, datos in informe["endpoints"].items():
+        base = baseline.get("endpoints", {}).get(endpoint)
+        if not base:
+            continue
+        for metrica in ("ttft_ms", "total_ms"):
+            actual, antes = datos[metrica]["p95"], base[metrica]["p95"]
+            cambio = (actual - antes) / antes if antes else 0.0
+            regresion = cambio > tolerancia
+            ok &= not regresion
+            print(f"   {'❌' if regresion else '✅'} {endpoint} {metrica} p95: {antes} -> {actual} ({cambio:+.0%})")
+    antes, actual = baseline.get("rps_chat", 0), informe["rps_chat"]
+    if antes:
+        cambio = (actual - antes) / antes
+        regresion = cambio < -tolerancia
+        ok &= not regresion
+        print(f"   {'❌' if regresion else '✅'} rps_chat: {antes} -> {actual} ({cambio:+.0%})")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark offline de la API con dobles de Gemini, embeddings y noticias.")
+    parser.add_argument("--usuarios", type=int, default=20)
+    parser.add_argument("--peticiones", type=int, default=200, help="Peticiones a /api/chat.")
+    parser.add_argument("--concurrencia", type=int, default=20, help="Peticiones de chat simultáneas.")
+    parser.add_argument("--tokens-por-segundo", type=float, default=200.0)
+    parser.add_argument("--primer-token-ms", type=float, default=300.0, help="Latencia de cada llamada al LLM falso.")
+    parser.add_argument("--noticias-ms", type=float, default=400.0, help="Latencia de la búsqueda de noticias falsa.")
+    parser.add_argument("--peso-noticias", type=int, default=2, help="Peso de las preguntas de noticias en la mezcla.")
+    parser.add_argument("--peso-combinar", type=int, default=1, help="Peso de las peticiones de recombinación.")
+    parser.add_argument("--sin-herramientas", action="store_true", help="El LLM responde sin llamar a herramientas.")
+    parser.add_argument("--sin-cache", action="store_true", help="Desactiva las cachés de respuestas y de noticias.")
+    parser.add_argument("--con-limites", action="store_true", help="Mantiene los límites de admisión por defecto.")
+    parser.add_argument("--semilla", type=int, default=42)
+    parser.add_argument("--escalado", default="1000,10000,50000",
+                        help="Tamaños del corpus sintético para medir la búsqueda vectorial ('' para omitirlo).")
+    parser.add_argument("--guardar-baseline", metavar="RUTA", help="Guarda el informe como baseline en RUTA.")
+    parser.add_argument("--comparar", metavar="RUTA", help="Compara con el baseline de RUTA.")
+    parser.add_argument("--tolerancia", type=float, default=0.25, help="Empeoramiento máximo admitido (0.25 = 25%%).")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="bench_") as directorio:
+        preparar_entorno(args, directorio)
+        instalar_fakes(args)
+        construir_indice()
+        informe = asyncio.run(ejecutar(args))
+        tamanos = [int(t) for t in args.escalado.split(",") if t.strip()]
+        if tamanos:
+            informe["escalado"] = medir_escalado(tamanos, semilla=args.semilla)
+
+    imprimir(informe)
+    if args.guardar_baseline:
+        with open(args.guardar_baseline, "w", encoding="utf-8") as f:
+            json.dump(informe, f, indent=2, ensure_ascii=False)
+        print(f"💾 Baseline guardado en {args.guardar_baseline}")
+    if args.comparar and not comparar(informe, args.comparar, args.tolerancia):
+        sys.exit(1)
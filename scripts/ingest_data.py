@@ -1,101 +1,420 @@
-# indexador.py - ChromaDB + Ollama (SIN OpenAI)
+# indexador.py - ChromaDB incremental (SIN OpenAI)
+#
+# Solo re-indexa lo que cambió desde la última ejecución:
+#   - Cada PDF se identifica por el hash SHA-256 de su contenido (manifiesto local).
+#   - Los chunks tienen ids estables derivados de su contenido, así que repetir
+#     la ingesta es idempotente (upsert) y no duplica datos.
+#   - Los PDFs se parsean y dividen en paralelo en un pool de procesos, y los
+#     chunks se embeben y se escriben en lotes acotados a medida que llegan.
+#   - Los chunks de PDFs borrados o modificados se eliminan de la colección
+#     DESPUÉS de escribir los nuevos (si un PDF falla, se conservan los
+#     suyos), igual que los chunks sin `source_file` de versiones anteriores
+#     del indexador, que se purgan sin necesidad de `--full`.
+#   - De cada PDF se extrae también su estructura (artículos con título y
+#     páginas) al índice de artículos que usa el backend para las consultas
+#     que citan un artículo concreto.
+#   - Cada chunk lleva la póliza (código del depósito), el producto y el
+#     artículo al que pertenece: el backend acota las búsquedas por póliza con
+#     filtros `where` sobre esos metadatos.
 
 import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import chromadb
-from langchain_community.document_loaders import PyPDFLoader
-from langchain.text_splitter import CharacterTextSplitter
 from dotenv import load_dotenv
-# --- NUEVAS LÍNEAS ---
+
 # Esto encuentra la ruta del directorio donde está el script (ej: /code/scripts)
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 # Esto sube un nivel para llegar a la raíz del proyecto (ej: /code)
 PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+# Permite importar el motor de embeddings del backend (`app.embeddings`)
+sys.path.insert(0, PROJECT_ROOT)
+# Cargamos el .env ANTES de importar la configuración del backend
+load_dotenv()
+
+from app.config import (
+    ARTICLE_INDEX_DIR,
+    CHROMA_HOST,
+    CHROMA_PORT,
+    CHROMA_COLLECTION as COLLECTION_NAME,
+    EMBEDDING_INGEST_BATCH,
+    BM25_INDEX_DIR,
+    VECTOR_STORE_BACKEND,
+    CHROMA_PERSIST_DIR,
+    VECTOR_INDEX_DIR,
+)
+from app.article_index import (
+    Articulo,
+    CargadorArticulos,
+    IndiceArticulos,
+    codigo_de_poliza,
+    extraer_articulos,
+    producto_de_poliza,
+)
+from app.embeddings import LocalEmbeddingFunction, modelo_embeddings
+from app.hybrid_search import BM25Index
+from app.numpy_index import NumpyCollection
+
 # Definimos la ruta a la carpeta de datos
 DATA_DIR = os.path.join(PROJECT_ROOT, "data")
-load_dotenv()
 
-def construir_y_guardar_vector_index():
-    print("📥 Leyendo PDFs desde 'data/'...")
-    archivos = [f for f in os.listdir(DATA_DIR) if f.endswith(".pdf")]
-    if not archivos:
-        print("❌ No hay archivos PDF en la carpeta 'data'.")
-        return
+# Manifiesto con el hash de cada PDF ya indexado
+MANIFEST_PATH = os.getenv("INGEST_MANIFEST", os.path.join(PROJECT_ROOT, "data_store", "ingest_manifest.json"))
+# Procesos para parsear PDFs en paralelo
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(os.cpu_count() or 2)))
+# Límites de cada llamada a `upsert` (número de chunks y tamaño del texto)
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "256"))
+INGEST_BATCH_MAX_BYTES = int(os.getenv("INGEST_BATCH_MAX_BYTES", str(4 * 1024 * 1024)))
 
-    print(f"📚 Encontrados {len(archivos)} PDFs:")
-    for archivo in archivos:
-        print(f"   - {archivo}")
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 100
+# Versión de los metadatos de cada chunk: los PDFs indexados con una anterior se re-indexan
+METADATA_VERSION = 2
+# Fracción mínima del chunk que debe caer en un artículo para anotarlo como suyo
+ARTICULO_MIN_COBERTURA = 0.3
+
+
+def hash_archivo(ruta: str) -> str:
+    sha = hashlib.sha256()
+    with open(ruta, "rb") as f:
+        for bloque in iter(lambda: f.read(1 << 20), b""):
+            sha.update(bloque)
+    return sha.hexdigest()
+
+
+def id_chunk(archivo: str, texto: str, ocurrencia: int) -> str:
+    """Id estable: mismo archivo + mismo texto => mismo id en cada ejecución."""
+    base = f"{archivo}:{hashlib.sha1(texto.encode('utf-8')).hexdigest()}:{ocurrencia}"
+    return hashlib.sha1(base.encode("utf-8")).hexdigest()
+
+
+def procesar_pdf(ruta: str, file_hash: str) -> tuple[list[tuple[str, str, dict]], list[Articulo]]:
+    """
+    Se ejecuta en un proceso del pool: carga un PDF, lo divide en chunks y
+    devuelve ([(id, texto, metadatos), ...], artículos del PDF). Las
+    importaciones pesadas van aquí dentro para que cada proceso hijo las haga
+    una sola vez.
+    """
+    from langchain_community.document_loaders import PyPDFLoader
+    from langchain.text_splitter import CharacterTextSplitter
+
+    archivo = os.path.basename(ruta)
+    paginas = PyPDFLoader(ruta).load()
+    splitter = CharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    chunks = splitter.split_documents(paginas)
+
+    textos_paginas = [p.page_content for p in paginas]
+    portada = textos_paginas[0] if textos_paginas else ""
+    articulos = extraer_articulos(textos_paginas, ruta)
+    indice = IndiceArticulos(articulos)
+    comunes = {"poliza": codigo_de_poliza(ruta, portada), "producto": producto_de_poliza(portada)}
+
+    vistos: dict[str, int] = {}
+    salida = []
+    for i, chunk in enumerate(chunks):
+        texto = chunk.page_content
+        ocurrencia = vistos.get(texto, 0)
+        vistos[texto] = ocurrencia + 1
+        metadata = {
+            "source": chunk.metadata.get("source", ruta),
+            "source_file": archivo,
+            "file_hash": file_hash,
+            "page": chunk.metadata.get("page", 0),
+            "chunk_id": i,
+            **comunes,
+        }
+        # Artículo con más texto del chunk (ChromaDB no admite None: si no hay, no se anota)
+        localizaciones = indice.localizar(texto, ARTICULO_MIN_COBERTURA, max_resultados=1)
+        if localizaciones:
+            metadata["articulo"] = localizaciones[0].articulo.numero
+        salida.append((id_chunk(archivo, texto, ocurrencia), texto, metadata))
+    return salida, articulos
+
+
+def extraer_articulos_pdf(ruta: str) -> list[Articulo]:
+    """Solo la estructura de artículos, para PDFs ya indexados que aún no están en el índice."""
+    from langchain_community.document_loaders import PyPDFLoader
+
+    return extraer_articulos([p.page_content for p in PyPDFLoader(ruta).load()], ruta)
+
+
+def cargar_manifiesto() -> dict:
+    if os.path.exists(MANIFEST_PATH):
+        with open(MANIFEST_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    return {}
+
+
+def guardar_manifiesto(manifiesto: dict) -> None:
+    # Escritura atómica: un corte a mitad nunca deja un JSON corrupto.
+    os.makedirs(os.path.dirname(MANIFEST_PATH), exist_ok=True)
+    temporal = MANIFEST_PATH + ".tmp"
+    with open(temporal, "w", encoding="utf-8") as f:
+        json.dump(manifiesto, f, indent=2, sort_keys=True)
+    os.replace(temporal, MANIFEST_PATH)
+
+
+class EscritorPorLotes:
+    """
+    Acumula chunks y los embebe + escribe con `upsert` cuando el lote alcanza
+    `max_items` chunks o `max_bytes` de texto, lo que ocurra primero.
+    """
+
+    def __init__(self, collection, embedding_function, max_items: int, max_bytes: int):
+        self.collection = collection
+        self.embedding_function = embedding_function
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.total = 0
+        self._ids, self._textos, self._metadatas = [], [], []
+        self._bytes = 0
+
+    def agregar(self, id_: str, texto: str, metadata: dict) -> None:
+        tamano = len(texto.encode("utf-8"))
+        if self._ids and self._bytes + tamano > self.max_bytes:
+            self.vaciar()
+        self._ids.append(id_)
+        self._textos.append(texto)
+        self._metadatas.append(metadata)
+        self._bytes += tamano
+        if len(self._ids) >= self.max_items:
+            self.vaciar()
+
+    def vaciar(self) -> None:
+        if not self._ids:
+            return
+        self.collection.upsert(
+            ids=self._ids,
+            documents=self._textos,
+            metadatas=self._metadatas,
+            embeddings=self.embedding_function(self._textos),
+        )
+        self.total += len(self._ids)
+        print(f"   💾 Lote de {len(self._ids)} chunks escrito ({self.total} en total)")
+        self._ids, self._textos, self._metadatas = [], [], []
+        self._bytes = 0
+
+
+def abrir_coleccion():
+    """
+    Abre el destino de la ingesta según VECTOR_STORE_BACKEND (el mismo que lee
+    el backend): el servicio ChromaDB, ChromaDB embebido o el índice NumPy
+    local. Devuelve (colección, cliente o None).
+    """
+    if VECTOR_STORE_BACKEND == "numpy":
+        print(f"🗄️ Usando el índice vectorial NumPy local en {VECTOR_INDEX_DIR}")
+        return NumpyCollection(VECTOR_INDEX_DIR), None
 
-    # Cliente ChromaDB persistente
-    print("🗄️ Inicializando ChromaDB...")
-   
-    client = chromadb.HttpClient(host='chromadb', port=8000)
+    if VECTOR_STORE_BACKEND == "persistent":
+        print(f"🗄️ Abriendo ChromaDB embebido en {CHROMA_PERSIST_DIR}...")
+        client = chromadb.PersistentClient(path=CHROMA_PERSIST_DIR)
+    else:
+        print("🗄️ Inicializando ChromaDB...")
+        client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
         # Hacemos un "ping" para asegurarnos de que la conexión funciona
-    client.heartbeat() 
-    print("✅ Conexión con ChromaDB establecida.")
+        client.heartbeat()
+        print("✅ Conexión con ChromaDB establecida.")
 
-    
     # Crear/obtener colección
     collection = client.get_or_create_collection(
-        name="polizas_seguros",
+        name=COLLECTION_NAME,
         metadata={"description": "Documentos de pólizas de seguros"}
     )
-    
-    print("✅ Colección ChromaDB creada/conectada")
-
-    # Cargar PDFs
-    print("📖 Cargando contenido de PDFs...")
-    loaders = [PyPDFLoader(os.path.join(DATA_DIR, f)) for f in archivos]
-    documentos = []
-    for i, loader in enumerate(loaders):
-        print(f"   Procesando {archivos[i]}...")
-        try:
-            docs = loader.load()
-            documentos.extend(docs)
-            print(f"      ✅ {len(docs)} páginas extraídas")
-        except Exception as e:
-            print(f"      ❌ Error: {e}")
-
-    print(f"✅ Total páginas cargadas: {len(documentos)}")
-
-    # Dividir en chunks
-    print("✂️ Dividiendo en chunks...")
-    splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
-    chunks = splitter.split_documents(documentos)
-    
-    print(f"✅ Creados {len(chunks)} chunks de texto")
-
-    # Preparar datos para ChromaDB
-    print("🔄 Preparando datos para ChromaDB...")
-    texts = []
-    metadatas = []
-    ids = []
-    
-    for i, chunk in enumerate(chunks):
-        texts.append(chunk.page_content)
-        metadatas.append({
-            "source": chunk.metadata.get("source", "unknown"),
-            "page": chunk.metadata.get("page", 0),
-            "chunk_id": i
-        })
-        ids.append(f"doc_{i}")
-
-    # Agregar a ChromaDB (usa embeddings automáticos)
-    print("💾 Guardando en ChromaDB...")
-    print("   (ChromaDB generará embeddings automáticamente)")
-    
-    try:
-        collection.add(
-            documents=texts,
-            metadatas=metadatas,
-            ids=ids
-        )
-        
-        print(f"✅ Agregados {len(texts)} chunks a ChromaDB")
-        print("✅ Índice ChromaDB creado exitosamente en './chroma_seguros/'")
-        print("🚀 Ahora puedes ejecutar: python main.py")
-        
-    except Exception as e:
-        print(f"❌ Error guardando en ChromaDB: {e}")
+    return collection, client
+
+
+def purgar_chunks_obsoletos(collection, archivos: list[str], ids_por_archivo: dict[str, set[str]],
+                            max_items: int, pagina: int = 1000) -> int:
+    """
+    Borra de la colección, y devuelve cuántos son, los chunks que ya no
+    corresponden a ningún PDF actual:
+      - sin `source_file` (los `doc_{i}` del indexador anterior),
+      - de PDFs que ya no están en `data/`,
+      - de los PDFs re-indexados en esta ejecución (`ids_por_archivo`) que no
+        están entre sus chunks nuevos.
+    Se llama después de escribir los chunks nuevos: un PDF que falla al
+    procesarse conserva los suyos.
+    """
+    actuales = set(archivos)
+    obsoletos, offset = [], 0
+    while True:
+        lote = collection.get(include=["metadatas"], limit=pagina, offset=offset)
+        if not lote["ids"]:
+            break
+        for id_, metadata in zip(lote["ids"], lote["metadatas"]):
+            archivo = (metadata or {}).get("source_file")
+            if archivo is None or archivo not in actuales \
+                    or (archivo in ids_por_archivo and id_ not in ids_por_archivo[archivo]):
+                obsoletos.append(id_)
+        offset += len(lote["ids"])
+    for inicio in range(0, len(obsoletos), max_items):
+        collection.delete(ids=obsoletos[inicio:inicio + max_items])
+    return len(obsoletos)
+
+
+def construir_indice_bm25(collection, pagina: int = 1000) -> None:
+    """
+    Reconstruye el índice léxico BM25 a partir de TODOS los chunks de la
+    colección (leídos por páginas) y lo guarda en BM25_INDEX_DIR, donde el
+    backend lo recoge automáticamente.
+    """
+    ids, textos, metadatas = [], [], []
+    offset = 0
+    while True:
+        lote = collection.get(include=["documents", "metadatas"], limit=pagina, offset=offset)
+        if not lote["ids"]:
+            break
+        ids.extend(lote["ids"])
+        textos.extend(lote["documents"])
+        metadatas.extend(m or {} for m in lote["metadatas"])
+        offset += len(lote["ids"])
+    indice = BM25Index.construir(ids, textos, metadatas)
+    indice.guardar(BM25_INDEX_DIR)
+    print(f"🔤 Índice BM25 guardado en {BM25_INDEX_DIR}: {len(ids)} chunks, {len(indice.vocabulario)} términos")
+
+
+def actualizar_indice_articulos(archivos: list[str], nuevos: dict[str, list[Articulo]],
+                                manifiesto: dict, workers: int) -> None:
+    """
+    Reescribe el índice de artículos en ARTICLE_INDEX_DIR: conserva los
+    artículos de los PDFs sin cambios, sustituye los de `nuevos`, quita los de
+    PDFs borrados y extrae los que falten (p. ej. si el índice no existía).
+    Anota en el manifiesto cuántos artículos tiene cada PDF.
+    """
+    indice = CargadorArticulos(ARTICLE_INDEX_DIR).obtener()
+    por_archivo: dict[str, list[Articulo]] = {}
+    for articulo in (indice.articulos if indice else []):
+        if articulo.archivo in archivos:
+            por_archivo.setdefault(articulo.archivo, []).append(articulo)
+    por_archivo.update(nuevos)
+
+    # Un PDF sin artículos no aparece en el índice: el manifiesto evita volver a leerlo
+    faltan = [f for f in archivos
+              if f not in por_archivo and manifiesto.get(f, {}).get("articulos", -1) != 0]
+    if faltan:
+        print(f"📑 Extrayendo artículos de {len(faltan)} PDFs ya indexados...")
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futuros = {pool.submit(extraer_articulos_pdf, os.path.join(DATA_DIR, f)): f for f in faltan}
+            for futuro in as_completed(futuros):
+                try:
+                    por_archivo[futuros[futuro]] = futuro.result()
+                except Exception as e:
+                    print(f"   ❌ Error extrayendo artículos de {futuros[futuro]}: {e}")
+
+    for archivo in archivos:
+        if archivo in por_archivo and archivo in manifiesto:
+            manifiesto[archivo]["articulos"] = len(por_archivo[archivo])
+    articulos = [a for f in archivos for a in por_archivo.get(f, [])]
+    IndiceArticulos(articulos).guardar(ARTICLE_INDEX_DIR)
+    print(f"📑 Índice de artículos guardado en {ARTICLE_INDEX_DIR}: {len(articulos)} artículos "
+          f"de {len({a.poliza for a in articulos})} pólizas")
+
+
+def construir_y_guardar_vector_index(completo: bool = False, workers: int = INGEST_WORKERS):
+    print("📥 Leyendo PDFs desde 'data/'...")
+    archivos = sorted(f for f in os.listdir(DATA_DIR) if f.endswith(".pdf"))
+    if not archivos:
+        print("❌ No hay archivos PDF en la carpeta 'data'.")
+        return
+
+    print(f"📚 Encontrados {len(archivos)} PDFs")
+
+    collection, client = abrir_coleccion()
+    print("✅ Colección creada/conectada")
+
+    # 1. Detectar qué cambió comparando hashes con el manifiesto
+    manifiesto = {} if completo else cargar_manifiesto()
+    hashes = {f: hash_archivo(os.path.join(DATA_DIR, f)) for f in archivos}
+    nuevos_o_cambiados = [f for f in archivos if manifiesto.get(f, {}).get("sha256") != hashes[f]
+                          or manifiesto[f].get("metadatos", 1) < METADATA_VERSION]
+    eliminados = [f for f in manifiesto if f not in hashes]
+    sin_cambios = len(archivos) - len(nuevos_o_cambiados)
+    print(f"🔍 {len(nuevos_o_cambiados)} nuevos/modificados, {len(eliminados)} eliminados, {sin_cambios} sin cambios")
+
+    max_items = INGEST_BATCH_SIZE
+    if client is not None and hasattr(client, "get_max_batch_size"):
+        max_items = min(max_items, client.get_max_batch_size())
+
+    if not nuevos_o_cambiados and not eliminados:
+        # Aunque los PDFs estén al día pueden quedar chunks del indexador anterior
+        purgados = purgar_chunks_obsoletos(collection, archivos, {}, max_items)
+        if not purgados:
+            # El índice de artículos puede faltar aunque los chunks estén al día
+            if not os.path.isdir(ARTICLE_INDEX_DIR):
+                actualizar_indice_articulos(archivos, {}, manifiesto, workers)
+                guardar_manifiesto(manifiesto)
+            print("✅ El índice ya está al día. Nada que hacer.")
+            return
+        print(f"🧹 {purgados} chunks obsoletos eliminados")
+
+    for archivo in eliminados:
+        manifiesto.pop(archivo, None)
+
+    # 2. Parsear en paralelo y escribir en lotes a medida que terminan los PDFs
+    # Mismo motor ONNX local que usa el backend para las consultas, con lotes grandes
+    funcion_embedding = LocalEmbeddingFunction(modelo_embeddings, batch_size=EMBEDDING_INGEST_BATCH)
+    escritor = EscritorPorLotes(collection, funcion_embedding, max_items, INGEST_BATCH_MAX_BYTES)
+    articulos_nuevos: dict[str, list[Articulo]] = {}
+    ids_por_archivo: dict[str, set[str]] = {}
+    inicio = time.perf_counter()
+
+    if nuevos_o_cambiados:
+        print(f"📖 Procesando PDFs con {workers} procesos...")
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futuros = {
+            pool.submit(procesar_pdf, os.path.join(DATA_DIR, f), hashes[f]): f
+            for f in nuevos_o_cambiados
+        }
+        for futuro in as_completed(futuros):
+            archivo = futuros[futuro]
+            try:
+                chunks, articulos = futuro.result()
+            except Exception as e:
+                # Sus chunks anteriores se conservan y el manifiesto no cambia: se reintenta en la próxima ejecución
+                print(f"   ❌ Error procesando {archivo}: {e}")
+                continue
+            for id_, texto, metadata in chunks:
+                escritor.agregar(id_, texto, metadata)
+            ids_por_archivo[archivo] = {id_ for id_, _, _ in chunks}
+            articulos_nuevos[archivo] = articulos
+            manifiesto[archivo] = {"sha256": hashes[archivo], "chunks": len(chunks),
+                                   "metadatos": METADATA_VERSION}
+            print(f"   ✅ {archivo}: {len(chunks)} chunks, {len(articulos)} artículos")
+    escritor.vaciar()
+
+    # 3. Con los chunks nuevos ya escritos, borrar los que sobran
+    if nuevos_o_cambiados or eliminados:
+        purgados = purgar_chunks_obsoletos(collection, archivos, ids_por_archivo, max_items)
+        if purgados:
+            print(f"🧹 {purgados} chunks obsoletos eliminados")
+    actualizar_indice_articulos(archivos, articulos_nuevos, manifiesto, workers)
+    guardar_manifiesto(manifiesto)
+
+    duracion = time.perf_counter() - inicio
+    stats = modelo_embeddings.stats.as_dict()
+    print(f"✅ {escritor.total} chunks escritos en ChromaDB en {duracion:.1f}s")
+    print(f"⚡ Embeddings: {stats['vectores']} vectores, {stats['vectores_por_segundo']} vectores/s "
+          f"({stats['vectores_por_pasada']} por pasada)")
+
+    # Índice léxico sobre el corpus completo (para la búsqueda híbrida)
+    construir_indice_bm25(collection)
+
+    # Publicamos una nueva versión del índice: el backend la lee y, al
+    # cambiar, invalida sus cachés de respuestas.
+    version = datetime.now(timezone.utc).isoformat()
+    collection.modify(metadata={**(collection.metadata or {}), "version": version})
+    print(f"🏷️ Versión del índice publicada: {version}")
+
 
 if __name__ == "__main__":
-    construir_y_guardar_vector_index()
+    parser = argparse.ArgumentParser(description="Indexa los PDFs de 'data/' en ChromaDB de forma incremental.")
+    parser.add_argument("--full", action="store_true", help="Ignora el manifiesto y re-indexa todo desde cero.")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS, help="Procesos para parsear PDFs.")
+    args = parser.parse_args()
+    construir_y_guardar_vector_index(completo=args.full, workers=args.workers)
@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+
+from app.admission import BucketBackend, ControlAdmision, MemoriaBucketBackend, Rechazo
+
+
+class _SinLimiteDeRitmo(BucketBackend):
+    """Siempre hay ficha: las pruebas de concurrencia no dependen del token bucket."""
+
+    async def consumir(self, clave: str, tasa: float, capacidad: int) -> float:
+        return 0.0
+
+
+def _control(**kwargs) -> ControlAdmision:
+    opciones = {"max_en_vuelo": 1, "max_por_usuario": 2, "max_cola": 1, "timeout_cola": 0.05, **kwargs}
+    return ControlAdmision(backend=_SinLimiteDeRitmo(), **opciones)
+
+
+def test_timeout_de_la_cola_devuelve_503_y_libera_al_usuario():
+    async def escenario():
+        control = _control()
+        permiso = await control.admitir("ana")
+        with pytest.raises(Rechazo) as rechazo:
+            await control.admitir("luis")
+        cuenta = dict(control._por_usuario)
+        permiso.liberar()
+        return rechazo.value, cuenta, control
+
+    rechazo, cuenta, control = asyncio.run(escenario())
+    assert rechazo.status == 503
+    assert rechazo.retry_after >= 1
+    assert cuenta == {"ana": 1}
+    assert control._por_usuario == {}
+    assert control.stats.timeout_cola == 1
+    assert control.stats_dict()["esperando"] == 0
+
+
+def test_cola_llena_rechaza_al_momento():
+    async def escenario():
+        control = _control(timeout_cola=5)
+        permiso = await control.admitir("ana")
+        en_cola = asyncio.create_task(control.admitir("luis"))
+        await asyncio.sleep(0)
+        with pytest.raises(Rechazo) as rechazo:
+            await control.admitir("eva")
+        permiso.liberar()
+        (await en_cola).liberar()
+        return rechazo.value, control
+
+    rechazo, control = asyncio.run(escenario())
+    assert rechazo.status == 503
+    assert control.stats.cola_llena == 1
+    assert control._por_usuario == {}
+
+
+def test_cancelar_la_espera_devuelve_la_cuenta_del_usuario():
+    async def escenario():
+        control = _control(timeout_cola=5)
+        permiso = await control.admitir("ana")
+        en_cola = asyncio.create_task(control.admitir("luis"))
+        await asyncio.sleep(0)
+        en_espera = dict(control._por_usuario)
+        en_cola.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await en_cola
+        cuenta = dict(control._por_usuario)
+        permiso.liberar()
+        # La plaza cancelada no se queda ocupada: entra otra petición sin esperar
+        (await asyncio.wait_for(control.admitir("luis"), 0.5)).liberar()
+        return en_espera, cuenta, control
+
+    en_espera, cuenta, control = asyncio.run(escenario())
+    assert en_espera == {"ana": 1, "luis": 1}
+    assert cuenta == {"ana": 1}
+    assert control._por_usuario == {}
+    assert control.stats_dict()["en_vuelo"] == 0
+
+
+def test_tope_por_usuario_y_liberar_idempotente():
+    async def escenario():
+        control = _control(max_en_vuelo=4, max_por_usuario=1)
+        permiso = await control.admitir("ana")
+        with pytest.raises(Rechazo) as rechazo:
+            await control.admitir("ana")
+        permiso.liberar()
+        permiso.liberar()
+        return rechazo.value, control
+
+    rechazo, control = asyncio.run(escenario())
+    assert rechazo.status == 429
+    assert control._por_usuario == {}
+    assert control.stats_dict()["en_vuelo"] == 0
+
+
+def test_bucket_en_memoria_limita_la_rafaga_y_esta_acotado():
+    async def escenario():
+        backend = MemoriaBucketBackend(max_buckets=2)
+        esperas = [await backend.consumir("ana", 1.0, 2) for _ in range(3)]
+        for usuario in ("luis", "eva"):
+            await backend.consumir(usuario, 1.0, 2)
+        return esperas, list(backend._buckets)
+
+    esperas, claves = asyncio.run(escenario())
+    assert esperas[:2] == [0.0, 0.0]
+    assert esperas[2] > 0
+    assert claves == ["luis", "eva"]
@@ -0,0 +1,110 @@
+import asyncio
+
+from app.singleflight import SingleFlightStream
+
+
+async def _fuente(eventos: list, paso: asyncio.Event = None, producidos: list = None):
+    """Stream de prueba: emite `eventos` y, si hay `paso`, espera a que se abra antes de cada uno tras el primero."""
+    for i, evento in enumerate(eventos):
+        if paso is not None and i > 0:
+            await paso.wait()
+        if producidos is not None:
+            producidos.append(evento)
+        yield evento
+
+
+async def _leer(gen) -> list:
+    return [evento async for evento in gen]
+
+
+def test_el_que_llega_tarde_recibe_el_stream_completo():
+    async def escenario():
+        vuelos = SingleFlightStream(max_repeticion=10, maxsize=10)
+        paso = asyncio.Event()
+        lider, es_lider = vuelos.suscribir("clave", lambda: _fuente(["a", "b", "c"], paso))
+        primero = await lider.__anext__()
+        seguidor, seguidor_lider = vuelos.suscribir("clave", lambda: _fuente(["otra"]))
+        paso.set()
+        resto_lider, recibido_seguidor = await asyncio.gather(_leer(lider), _leer(seguidor))
+        return es_lider, seguidor_lider, [primero, *resto_lider], recibido_seguidor, vuelos.stats
+
+    es_lider, seguidor_lider, del_lider, del_seguidor, stats = asyncio.run(escenario())
+    assert es_lider and not seguidor_lider
+    assert del_lider == ["a", "b", "c"]
+    assert del_seguidor == ["a", "b", "c"]
+    assert stats.ejecuciones == 1 and stats.agrupadas == 1
+
+
+def test_fuera_del_bufer_el_recien_llegado_calcula_el_suyo():
+    async def escenario():
+        vuelos = SingleFlightStream(max_repeticion=1, maxsize=10)
+        paso = asyncio.Event()
+        lider, _ = vuelos.suscribir("clave", lambda: _fuente(["a", "b", "c"], paso))
+        assert await lider.__anext__() == "a"
+        paso.set()
+        assert await lider.__anext__() == "b"
+        propio, es_lider = vuelos.suscribir("clave", lambda: _fuente(["x"]))
+        return es_lider, await _leer(propio), await _leer(lider), vuelos.stats
+
+    es_lider, propio, resto, stats = asyncio.run(escenario())
+    assert es_lider
+    assert propio == ["x"]
+    assert resto == ["c"]
+    assert stats.tarde == 1
+
+
+def test_si_el_lider_se_cancela_los_seguidores_siguen_recibiendo():
+    async def escenario():
+        vuelos = SingleFlightStream(max_repeticion=10, maxsize=10)
+        paso = asyncio.Event()
+        lider, _ = vuelos.suscribir("clave", lambda: _fuente(["a", "b", "c"], paso))
+        seguidor, _ = vuelos.suscribir("clave", lambda: _fuente(["otra"]))
+        tarea_lider = asyncio.create_task(_leer(lider))
+        await asyncio.sleep(0)
+        tarea_lider.cancel()
+        try:
+            await tarea_lider
+        except asyncio.CancelledError:
+            pass
+        paso.set()
+        return await _leer(seguidor), vuelos.stats
+
+    recibido, stats = asyncio.run(escenario())
+    assert recibido == ["a", "b", "c"]
+    assert stats.canceladas == 0
+
+
+def test_si_se_van_todos_se_cancela_el_productor():
+    async def escenario():
+        vuelos = SingleFlightStream(max_repeticion=10, maxsize=10)
+        paso = asyncio.Event()
+        producidos: list = []
+        lider, _ = vuelos.suscribir("clave", lambda: _fuente(["a", "b", "c"], paso, producidos))
+        seguidor, _ = vuelos.suscribir("clave", lambda: _fuente(["otra"]))
+        await lider.__anext__()
+        await seguidor.__anext__()
+        await lider.aclose()
+        await seguidor.aclose()
+        paso.set()
+        await asyncio.sleep(0)
+        return producidos, vuelos.stats, vuelos.stats_dict()
+
+    producidos, stats, stats_dict = asyncio.run(escenario())
+    assert producidos == ["a"]
+    assert stats.canceladas == 1
+    assert stats_dict["en_vuelo"] == 0
+
+
+def test_el_error_del_productor_llega_a_todos():
+    async def fallida():
+        yield "a"
+        raise RuntimeError("fallo")
+
+    async def escenario():
+        vuelos = SingleFlightStream(max_repeticion=10, maxsize=10)
+        lider, _ = vuelos.suscribir("clave", fallida)
+        seguidor, _ = vuelos.suscribir("clave", fallida)
+        return await asyncio.gather(_leer(lider), _leer(seguidor), return_exceptions=True)
+
+    for resultado in asyncio.run(escenario()):
+        assert isinstance(resultado, RuntimeError)